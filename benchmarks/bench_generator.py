@@ -0,0 +1,166 @@
+"""
+    Time the stages of generating a distro on synthetic snapshots of increasing size: ingesting the snapshot json,
+    Writer.write_srcs_files, Writer.write_packages_files, rosdep resolution of every dependency, and fetching and
+    parsing the rosdep files. Results are printed as json, so they can be stored and compared across commits.
+    Files are written to a temporary directory, or kept in memory with --sink memory to leave out the filesystem.
+
+    Run with: poetry run python benchmarks/bench_generator.py -o results.json
+"""
+import argparse
+import asyncio
+import io
+import itertools
+import json
+import logging
+from pathlib import Path
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+import yaml
+
+from nix_generator.distro_cache import iter_repositories
+from nix_generator.rosdeps import RosdepResolver, fetch_rosdeps_async
+from nix_generator.sinks import MemorySink
+from nix_generator.writer import Writer
+
+from synthetic import make_rosdep_data, make_snapshot
+
+ROSDEP_URL = "http://rosdep.invalid/base.yaml"
+
+
+def measure(fun, repeat, setup=None):
+    """
+        Time fun over repeat runs, calling setup before each run, untimed, for the arguments passed to fun.
+    """
+    times = []
+    for _ in range(repeat):
+        args = setup() if setup is not None else ()
+        start = time.perf_counter()
+        fun(*args)
+        times.append(time.perf_counter() - start)
+    return {"min": min(times), "median": statistics.median(times), "runs": times}
+
+
+def resolve_all(rosdep_mapping, snapshot):
+    resolver = RosdepResolver(rosdep_mapping)
+    for repo_dict in snapshot["repositories"].values():
+        for package_dict in repo_dict["packages"]:
+            for dep_names in package_dict["depends"].values():
+                for dep_name in dep_names:
+                    resolver.resolve(dep_name)
+    return resolver
+
+
+def fetch_rosdeps_mock(rosdep_text):
+    async def run():
+        transport = httpx.MockTransport(lambda request: httpx.Response(200, text=rosdep_text))
+        async with httpx.AsyncClient(transport=transport) as client:
+            return await fetch_rosdeps_async([ROSDEP_URL], client)
+    return asyncio.run(run())
+
+
+def bench_size(package_count, args, work_path):
+    rosdep_data = make_rosdep_data(max(int(package_count * args.rosdep_keys_per_package), 10))
+    rosdep_text = yaml.safe_dump(rosdep_data)
+    rosdep_mapping = fetch_rosdeps_mock(rosdep_text)
+    snapshot = make_snapshot(
+        package_count, packages_per_repo=args.packages_per_repo, fan_out=args.fan_out,
+        rosdep_keys=len(rosdep_data), seed=args.seed,
+    )
+    snapshot_json = json.dumps(snapshot).encode()
+    run_paths = (work_path / f"run{i}" for i in itertools.count())
+
+    def new_sink(path):
+        return MemorySink(path) if args.sink == "memory" else None
+
+    def new_writer():
+        path = next(run_paths) / "noetic"
+        return Writer(path, snapshot["repositories"], jobs=args.jobs, sink=new_sink(path))
+
+    def written_srcs_writer():
+        writer = new_writer()
+        writer.write_srcs_files()
+        return writer, RosdepResolver(rosdep_mapping)
+
+    results = {
+        "repositories": len(snapshot["repositories"]),
+        "rosdep_keys": len(rosdep_data),
+        "snapshot_bytes": len(snapshot_json),
+    }
+    results["ingest"] = measure(
+        lambda: Writer(
+            path := next(run_paths), iter_repositories(io.BytesIO(snapshot_json)), jobs=args.jobs, sink=new_sink(path)
+        ),
+        args.repeat,
+    )
+    results["write_srcs_files"] = measure(
+        lambda writer: writer.write_srcs_files(), args.repeat, lambda: (new_writer(),)
+    )
+    results["write_packages_files"] = measure(
+        lambda writer, resolver: writer.write_packages_files(resolver), args.repeat, written_srcs_writer
+    )
+    results["rosdep_resolution"] = measure(lambda: resolve_all(rosdep_mapping, snapshot), args.repeat)
+    results["fetch_rosdeps"] = measure(lambda: fetch_rosdeps_mock(rosdep_text), args.repeat)
+    return results
+
+
+def git_commit():
+    try:
+        cmd = ["git", "rev-parse", "HEAD"]
+        return subprocess.check_output(cmd, cwd=Path(__file__).parent, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        "-s", "--sizes", type=int, nargs="+", default=[1000, 10000, 50000],
+        help="Package counts of the synthetic distros [%(default)s]."
+    )
+    parser.add_argument("--packages-per-repo", type=int, default=4, help="Packages per repository [%(default)s].")
+    parser.add_argument("--fan-out", type=int, default=6, help="Mean dependencies per kind and package [%(default)s].")
+    parser.add_argument(
+        "--rosdep-keys-per-package", type=float, default=0.2, help="Size of the rosdep data [%(default)s]."
+    )
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="Runs per measurement [%(default)s].")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Writer jobs [%(default)s].")
+    parser.add_argument(
+        "--sink", choices=["directory", "memory"], default="directory", help="Where files are written [%(default)s]."
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic data [%(default)s].")
+    parser.add_argument("-o", "--output", default=None, help="File to write the json results to [stdout].")
+    args = parser.parse_args()
+
+    # The synthetic distros have unresolvable keys on purpose.
+    logging.getLogger("nix_generator").setLevel(logging.ERROR)
+
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "parameters": {k: v for k, v in vars(args).items() if k != "output"},
+        "results": {},
+    }
+    for package_count in args.sizes:
+        print(f"Benchmarking {package_count} packages...", file=sys.stderr)
+        with tempfile.TemporaryDirectory(prefix="bench-generator-") as work_dir:
+            report["results"][str(package_count)] = bench_size(package_count, args, Path(work_dir))
+        for name, result in report["results"][str(package_count)].items():
+            if isinstance(result, dict):
+                print(f"  {name: <22} {result['min'] * 1e3:10.1f}ms", file=sys.stderr)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+    Compare the per-package cost of rendering package.nix and src.nix with a fresh em.Interpreter per file (the
+    previous approach) against a compiled Template that is reused across packages.
+
+    Run with: poetry run python benchmarks/bench_templates.py
+"""
+import argparse
+import io
+from pkgutil import get_data
+import time
+
+import em
+
+from nix_generator.model import Package
+from nix_generator.template import Template
+
+PACKAGE_VARIABLES = {
+    "name": "roscpp",
+    "repo_name": "ros_comm",
+    "inputs": ["boost", "cpp_common", "message_generation", "rosconsole", "roscpp_serialization", "xmlrpcpp"],
+    "buildDepends": ["boost", "cpp_common", "message_generation", "rosconsole", "roscpp_serialization"],
+    "runDepends": ["boost", "cpp_common", "rosconsole", "roscpp_serialization", "xmlrpcpp"],
+    "testDepends": ["rosbash"],
+    "binary": True,
+    "scope_name": "noetic",
+}
+
+SRC_VARIABLES = {
+    "name": "ros_comm",
+    "fetcher": "fetchFromGitHub",
+    "owner": "ros",
+    "repo": "ros_comm",
+    "rev": "1.15.14",
+    "hash": "sha256-AAAA",
+    "safe_owner": "ros",
+    "safe_repo": "ros_comm",
+    "safe_rev": "1.15.14",
+    "packages": [Package(f"pkg{i}", "ros_comm", path=f"pkg{i}", narhash="sha256-BBBB") for i in range(8)],
+}
+
+
+class _CapturingOutput(io.StringIO):
+    # em.Interpreter.shutdown closes its output, keep the file open so it can be reused.
+    def close(self):
+        pass
+
+
+def render_interpreter(text, variables):
+    output = _CapturingOutput()
+    i = em.Interpreter(output=output, globals=dict(variables))
+    i.string(text)
+    i.shutdown()
+    return output.getvalue()
+
+
+def measure(fun, count):
+    start = time.perf_counter()
+    for _ in range(count):
+        fun()
+    return (time.perf_counter() - start) / count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-n", "--count", type=int, default=2000, help="Renders per measurement [%(default)s].")
+    args = parser.parse_args()
+
+    for name, variables in (("package.nix", PACKAGE_VARIABLES), ("src.nix", SRC_VARIABLES)):
+        text = get_data("nix_generator", f"templates/{name}.em").decode()
+        template = Template(text, name)
+        assert render_interpreter(text, variables) == template.render(**variables)
+
+        before = measure(lambda: render_interpreter(text, variables), args.count)
+        after = measure(lambda: template.render(**variables), args.count)
+        print(f"{name: <12} em.Interpreter: {before * 1e6:8.1f}us  Template: {after * 1e6:8.1f}us  ({before / after:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""
+    Synthetic colcon-distro snapshots and rosdep files of configurable size, for benchmarking the generator without
+    any network access. The same arguments always produce the same data.
+"""
+import random
+
+PYTHON_KEY_SHARE = 0.3
+
+
+def make_rosdep_data(key_count):
+    """
+        A rosdep yaml document as a dict, with key_count keys of which some are python packages and some have no
+        nixos mapping at all, like in rosdistro.
+    """
+    data = {}
+    for i in range(key_count):
+        if i % 10 < PYTHON_KEY_SHARE * 10:
+            data[f"python3-key{i}"] = {"ubuntu": [f"python3-key{i}"], "nixos": [f"python3Packages.key{i}"]}
+        elif i % 10 == 9:
+            data[f"key{i}"] = {"ubuntu": [f"libkey{i}-dev"]}
+        else:
+            data[f"key{i}"] = {"ubuntu": [f"libkey{i}-dev"], "nixos": [f"key{i}"]}
+    return data
+
+
+def rosdep_key_names(key_count):
+    names = []
+    for i in range(key_count):
+        if i % 10 < PYTHON_KEY_SHARE * 10:
+            # Half of the python keys are referred to by their old name, which needs the python3 shim.
+            names.append(f"python-key{i}" if i % 2 else f"python3-key{i}")
+        else:
+            names.append(f"key{i}")
+    # Keys which are in no rosdep file.
+    names.extend(f"missing{i}" for i in range(max(key_count // 100, 1)))
+    return names
+
+
+def make_snapshot(package_count, packages_per_repo=4, fan_out=6, rosdep_keys=2000, seed=0):
+    """
+        A colcon-distro snapshot with package_count packages in repositories of packages_per_repo packages each.
+        Every package has around fan_out build, run and test dependencies, split between earlier packages of the
+        workspace and rosdep keys, so the dependency graph is acyclic like that of a real distro.
+    """
+    rnd = random.Random(seed)
+    key_names = rosdep_key_names(rosdep_keys)
+    package_names = []
+    repositories = {}
+
+    for r in range(-(-package_count // packages_per_repo)):
+        # Like in rosdistro, some repository names have an owner prefix.
+        repo_name = f"org{r}/repo{r}" if r % 7 == 0 else f"repo{r}"
+        packages = []
+        for p in range(min(packages_per_repo, package_count - len(package_names))):
+            name = f"pkg{r}_{p}"
+            depends = {}
+            for kind in ("build", "run", "test"):
+                count = rnd.randint(0, fan_out * 2)
+                workspace = rnd.sample(package_names, min(len(package_names), count // 2))
+                depends[kind] = workspace + rnd.sample(key_names, count - len(workspace))
+            metadata = {"narhash": f"sha256-{name}="}
+            if rnd.random() < 0.5:
+                metadata["binary"] = True
+            packages.append({
+                "name": name,
+                "path": name if packages_per_repo > 1 else ".",
+                "depends": depends,
+                "metadata": metadata,
+            })
+        package_names.extend(p["name"] for p in packages)
+        repositories[repo_name] = {
+            "url": f"https://github.com/owner{r}/repo{r}.git",
+            "version": f"1.{r}.0",
+            "metadata": {"narhash": f"sha256-repo{r}="},
+            "packages": packages,
+        }
+    return {"repositories": repositories}
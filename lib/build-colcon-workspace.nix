@@ -17,6 +17,7 @@
   stdenv,
   stdenvNoCC,
   symlinkJoin,
+  uniqueByOutPath,
   writeTextFile,
 }:
 
@@ -39,14 +40,14 @@ with lib; let
   propagateColconPackagesLimitedWorker = packages: current_recursion: max_recursions: let
     validPackages = if ((max_recursions == null) || (current_recursion <= max_recursions)) then (filter (d: d != null) packages) else [];
     propagatedColconRunDepends = if (validPackages != null) then 
-      filter (d: d.colconPackage or false) (unique (concatLists
+      filter (d: d.colconPackage or false) (uniqueByOutPath (concatLists
         (catAttrs "colconRunDepends" validPackages)
       ))
     else [];
     recurse = propagateColconPackagesLimitedWorker propagatedColconRunDepends (current_recursion + 1) max_recursions;
   in
     if length validPackages > 0 then
-      unique (recurse ++ validPackages)
+      uniqueByOutPath (recurse ++ validPackages)
     else
       [];
 
@@ -0,0 +1,51 @@
+{ lib, pkgs, pkgSrc }:
+
+# Builds the scope of a distro from the single json document written by `generate --format=json-index`. The result
+# is the same scope that the package-default.nix of the default output format assembles from one file per package,
+# but nix only has to read and parse one file for it.
+{ index, scopeName }:
+
+with lib; let
+  data = builtins.fromJSON (builtins.readFile index);
+
+  sanitizeRepoName = replaceStrings [ "/" ] [ "_" ];
+
+  # One fetcher per repository, shared by the sources of all of its packages.
+  repoSrcs = mapAttrs (repoName: source: pkgSrc (pkgs.${source.fetcher} {
+    inherit (source) owner repo rev hash name;
+  })) data.sources;
+
+  packageSrc = package: repoSrcs.${package.source} package.narhash package.path;
+
+  srcs = mapAttrs' (repoName: source: nameValuePair (sanitizeRepoName repoName)
+    (genAttrs source.packages (name: packageSrc data.packages.${name}))
+  ) data.sources;
+
+in makeScope (extra: callPackageWith (pkgs // extra)) (self:
+  let
+    # Dependencies are attribute paths like python3Packages.pyyaml, looked up like the arguments of callPackage.
+    scopePkgs = pkgs // self;
+    resolve = attrPath: getAttrFromPath (splitString "." attrPath) scopePkgs;
+
+    packages = mapAttrs (name: package: scopePkgs.buildColconPackage ({
+      inherit name;
+      pkgFinal = pkgs.${scopeName}.${name};
+      src = srcs.${sanitizeRepoName package.source}.${name};
+      colconBuildDepends = map resolve package.buildDepends;
+      colconRunDepends = map resolve package.runDepends;
+      colconTestDepends = map resolve package.testDepends;
+    } // optionalAttrs package.binary {
+      separateDebugInfo = true;
+    })) data.packages;
+
+    callPackage = f: self.callPackage f {
+      inherit srcs;
+      final = pkgs;
+    };
+
+    by_repo = mapAttrs (repoName: packageNames: map (name: self.${name}.pkgFinal) (attrNames packageNames)) srcs;
+
+  in {
+    inherit callPackage srcs by_repo;
+  } // packages
+)
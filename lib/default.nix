@@ -53,6 +53,10 @@ in {
     prev.callPackage ./build-colcon-workspace.nix {}
   ));
 
+  uniqueByOutPath = prev.callPackage ./unique-by-out-path.nix {};
+
+  colconScopeFromJsonIndex = prev.callPackage ./colcon-scope-from-json-index.nix {};
+
   propagateColconRunDepends = prev.callPackage ./propagate-colcon-run-depends.nix {};
 
   flake-overlay = prev.callPackage  ./flake-overlay {};
@@ -1,17 +1,20 @@
-{ lib }:
+{ lib, uniqueByOutPath }:
 
 with lib;
 
 let
+  # The run dependencies are walked level by level, and the deepest levels come first. That order ends up in the
+  # setup hooks and environment of everything built on top, so it must not change; only the deduplication, which
+  # was quadratic with lib.unique, is done by uniqueByOutPath, which keeps the same first occurrences.
   fn = packages: let
     validPackages = filter (d: d != null) packages;
-    propagatedColconRunDepends = unique (concatLists (
+    propagatedColconRunDepends = uniqueByOutPath (concatLists (
       catAttrs "colconRunDepends" validPackages
     ));
     recurse = fn propagatedColconRunDepends;
   in
     if length validPackages > 0 then
-      unique (recurse ++ validPackages)
+      uniqueByOutPath (recurse ++ validPackages)
     else
       [];
 
@@ -0,0 +1,11 @@
+{ lib }:
+
+# Remove duplicates from a list of packages, keeping the first occurrence and the order of the rest. Nix compares
+# derivations by their outPath, so for derivations this gives the same result as lib.unique, but genericClosure
+# keeps the keys it has seen in a set rather than comparing every element against all of the ones before it, so it
+# is not quadratic. genericClosure processes its start set in order and the operator adds nothing, so the order of
+# the result is that of the list.
+packages: map (e: e.value) (builtins.genericClosure {
+  startSet = map (d: { key = d.outPath or (toString d); value = d; }) packages;
+  operator = _: [];
+})
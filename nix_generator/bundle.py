@@ -0,0 +1,105 @@
+import httpx
+import io
+import json
+import logging
+import tarfile
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+
+
+class BundleError(Exception):
+    pass
+
+
+class Bundle:
+    """
+        Everything a generate run consumed from the network: the snapshot tags listing, and the raw http responses
+        for the distro snapshots and rosdep files. Saved as a single compressed tarball, a bundle allows repeating
+        the generation without any network access. If the run had a base ref, its snapshots are in the bundle too.
+    """
+
+    INDEX_NAME = "index.json"
+
+    def __init__(self, ref=None, refs_listing=None, responses=None, base_ref=None):
+        self.ref = ref
+        self.base_ref = base_ref
+        self.refs_listing = refs_listing
+        # url -> (status_code, headers as a list of (name, value) pairs, raw body)
+        self.responses = responses if responses is not None else {}
+
+    @classmethod
+    def load(cls, path):
+        try:
+            with tarfile.open(path, "r:gz") as tar:
+                index = json.load(tar.extractfile(cls.INDEX_NAME))
+                responses = {}
+                for url, response in index["responses"].items():
+                    body = tar.extractfile(response["body"]).read()
+                    headers = response["headers"]
+                    # Bundles written before repeated headers were kept have them as a dict.
+                    headers = list(headers.items()) if isinstance(headers, dict) else [tuple(h) for h in headers]
+                    responses[url] = (response["status_code"], headers, body)
+        except (OSError, KeyError, ValueError, tarfile.TarError) as e:
+            raise BundleError(f"Unable to read offline bundle {path}: {e}")
+        return cls(
+            ref=index.get("ref"), refs_listing=index.get("refs_listing"), responses=responses,
+            base_ref=index.get("base_ref"),
+        )
+
+    def save(self, path):
+        index = {"ref": self.ref, "base_ref": self.base_ref, "refs_listing": self.refs_listing, "responses": {}}
+        with tarfile.open(path, "w:gz") as tar:
+            for i, (url, (status_code, headers, body)) in enumerate(sorted(self.responses.items())):
+                body_name = f"responses/{i}"
+                index["responses"][url] = {"status_code": status_code, "headers": headers, "body": body_name}
+                self._add(tar, body_name, body)
+            self._add(tar, self.INDEX_NAME, json.dumps(index, indent=1, sort_keys=True).encode())
+        logger.info(f"Wrote offline bundle with {len(self.responses)} responses to {path}")
+
+    @staticmethod
+    def _add(tar, name, data):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        tar.addfile(info, io.BytesIO(data))
+
+
+class RecordingTransport(httpx.AsyncBaseTransport):
+    """
+        Passes requests on to the wrapped transport, storing every response in the bundle.
+    """
+
+    def __init__(self, bundle, transport=None):
+        self.bundle = bundle
+        self.transport = transport if transport is not None else httpx.AsyncHTTPTransport()
+
+    async def handle_async_request(self, request):
+        response = await self.transport.handle_async_request(request)
+        try:
+            body = b"".join([chunk async for chunk in response.stream])
+        finally:
+            await response.aclose()
+        # The body is kept as it came over the wire, so the content-encoding header still applies to it.
+        # As a list, a dict would join repeated headers like set-cookie into one.
+        headers = response.headers.multi_items()
+        self.bundle.responses[str(request.url)] = (response.status_code, headers, body)
+        return httpx.Response(response.status_code, headers=response.headers, content=body)
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+class BundleTransport(httpx.AsyncBaseTransport):
+    """
+        Serves the responses stored in a bundle, any request not in it fails rather than going to the network.
+    """
+
+    def __init__(self, bundle):
+        self.bundle = bundle
+
+    async def handle_async_request(self, request):
+        try:
+            status_code, headers, body = self.bundle.responses[str(request.url)]
+        except KeyError:
+            raise httpx.ConnectError(f"{request.url} is not in the offline bundle", request=request)
+        return httpx.Response(status_code, headers=headers, content=body)
@@ -0,0 +1,118 @@
+from collections import namedtuple
+import hashlib
+import io
+import json
+import logging
+import os
+from pathlib import Path
+import shutil
+import tempfile
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+
+CacheEntry = namedtuple("CacheEntry", ("data", "metadata"))
+
+
+class DiskCache:
+    """
+        A directory of cached blobs with a bit of json metadata each, keyed by an arbitrary string. Entries are
+        replaced atomically so that multiple processes can share a cache directory, and the least recently used
+        entries are evicted once the total size of the blobs exceeds max_size bytes.
+
+        The directory is only scanned for eviction once the size of the blobs written since the last scan could have
+        taken it over max_size, so that storing many small entries stays cheap. What other processes write in the
+        meantime is only noticed on the next scan.
+    """
+
+    def __init__(self, path, max_size=1024 * 1024 * 1024):
+        self.path = Path(path)
+        self.max_size = max_size
+        self.path.mkdir(parents=True, exist_ok=True)
+        # Upper bound of the total size of the blobs as of the last scan, None before the first one.
+        self._total_size = None
+
+    def _paths(self, key):
+        name = hashlib.sha256(key.encode()).hexdigest()
+        return self.path / f"{name}.data", self.path / f"{name}.meta"
+
+    def open(self, key):
+        """
+            Like get, but the returned entry holds an open binary file of the data rather than the data itself.
+        """
+        data_path, meta_path = self._paths(key)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            data_file = open(data_path, "rb")
+        except (FileNotFoundError, ValueError):
+            return None
+        if meta.get("key") != key or meta.get("size") != os.fstat(data_file.fileno()).st_size:
+            # Hash collision or a partially replaced entry, either way not usable.
+            data_file.close()
+            return None
+        # The mtime of the data file is what the LRU eviction goes by.
+        os.utime(data_path)
+        return CacheEntry(data_file, meta.get("metadata", {}))
+
+    def get(self, key):
+        entry = self.open(key)
+        if entry is None:
+            return None
+        with entry.data as data_file:
+            return CacheEntry(data_file.read(), entry.metadata)
+
+    def put(self, key, data, metadata=None):
+        self.put_file(key, io.BytesIO(data), metadata)
+
+    def put_file(self, key, data_file, metadata=None):
+        """
+            Store the remaining contents of the binary file data_file.
+        """
+        data_path, meta_path = self._paths(key)
+        size = self._replace(data_path, data_file)
+        meta = {"key": key, "size": size, "metadata": metadata or {}}
+        self._replace(meta_path, io.BytesIO(json.dumps(meta).encode()))
+        if self._total_size is not None:
+            self._total_size += size
+            if self._total_size <= self.max_size:
+                return
+        self.evict()
+
+    def _replace(self, path, data_file):
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                shutil.copyfileobj(data_file, f)
+                size = f.tell()
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        return size
+
+    def evict(self):
+        """
+            Remove least recently used entries until the cache fits in max_size.
+        """
+        entries = []
+        total_size = 0
+        for data_path in self.path.glob("*.data"):
+            try:
+                st = data_path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, data_path))
+            total_size += st.st_size
+
+        entries.sort()
+        while total_size > self.max_size and entries:
+            mtime, size, data_path = entries.pop(0)
+            logger.debug(f"Evicting {data_path} from the cache.")
+            for path in (data_path, data_path.with_suffix(".meta")):
+                try:
+                    path.unlink()
+                except FileNotFoundError:
+                    pass
+            total_size -= size
+        self._total_size = total_size
@@ -1,5 +1,9 @@
 import argparse
+import asyncio
+import atexit
+import functools
 import httpx
+import json
 import logging
 import os
 from pathlib import Path
@@ -9,9 +13,15 @@ import sys
 import time
 import yaml
 
+from . import trace
+from .bundle import Bundle, BundleError, BundleTransport, RecordingTransport
+from .cache import DiskCache
 from .defaults import *
+from .distro_cache import DistroCacheError, fetch_distro, iter_repositories
 from .hydra import Hydra
-from .rosdeps import fetch_rosdeps
+from .manifest import MANIFEST_NAME
+from .rosdeps import RosdepResolver, fetch_rosdep_index
+from .sinks import GitSink, SinkError, TarSink
 from .writer import Writer
 
 logging.basicConfig()
@@ -32,10 +42,15 @@ def retry_subprocess_errors(fun=None, args=[], kwargs={}, retry_count=3):
         Helper function to allow retrying functions in case they throw a CalledProcessError.
     """
     last_error = None
+    cmd = args[0] if args else kwargs.get("args")
     for i in range(retry_count):
         time.sleep(i) # Linear back-off for all but the first attempt.
         try:
-            return fun(*args, **kwargs)
+            with trace.span("subprocess", cmd=str(cmd), attempt=i + 1, retry_count=retry_count) as span:
+                result = fun(*args, **kwargs)
+                if isinstance(result, (str, bytes)):
+                    span.set(bytes=len(result))
+            return result
         except subprocess.CalledProcessError as e:
             last_error = e
             logger.warn(f"Got {e} in retry errors {i + 1}/{retry_count}. ({fun}, {args}, {kwargs}).")
@@ -48,12 +63,224 @@ def retrying_check_call(*args, **kwargs):
 def retrying_check_output(*args, **kwargs):
     return retry_subprocess_errors(subprocess.check_output, args=args, kwargs=kwargs)
 
+def traced_check_call(*args, **kwargs):
+    with trace.span("subprocess", cmd=str(args[0])):
+        return subprocess.check_call(*args, **kwargs)
+
+
+async def load_rosdep_resolver(rosdep_urls, client, rosdep_commit=None, cache=None):
+    with trace.span("fetch_rosdeps") as span:
+        rosdep_mapping = await fetch_rosdep_index(rosdep_urls, client, rosdep_commit, cache)
+        rosdep_mapping.update(ROSDEP_OVERRIDES)
+        span.set(items=len(rosdep_mapping))
+    # Shared by all distros, so keys resolved for one are free for the next.
+    return RosdepResolver(rosdep_mapping)
+
+
+def get_rosdep_urls(rosdep_branch, pin=True):
+    """
+        Returns the rosdep file urls for rosdep_branch, and unless pin is false the rosdistro commit the branch is
+        at, with the urls pointing to that commit rather than the branch. The commit is None if it can't be found.
+    """
+    rosdep_commit = None
+    if pin:
+        cmd = ["git", "ls-remote", DISTRO_URL, f"refs/heads/{rosdep_branch}"]
+        try:
+            with trace.span("ls_remote_rosdistro"):
+                git_output = retrying_check_output(cmd, universal_newlines=True).split()
+        except subprocess.CalledProcessError:
+            git_output = []
+        if git_output:
+            rosdep_commit = git_output[0]
+            logger.info(f"Using rosdep files of rosdistro {rosdep_commit}.")
+        else:
+            logger.warning(f"Unable to find the commit of rosdistro branch {rosdep_branch}, not caching rosdeps.")
+    rosdep_ref = rosdep_commit or rosdep_branch
+    return [v.format(DISTRO_URL=DISTRO_URL, rosdep_branch=rosdep_ref) for v in ROSDEP_URLS], rosdep_commit
+
+
+def hydra_login(hydra):
+    """
+        Log into hydra with the credentials from the environment, returns whether they were set.
+    """
+    try:
+        hydra_username = os.environ["HYDRA_USERNAME"]
+        hydra_password = os.environ["HYDRA_PASSWORD"]
+    except KeyError:
+        logger.error("Auth vars HYDRA_USERNAME and HYDRA_PASSWORD are not set.")
+        return False
+    logger.info(f"Logging into {HYDRA_URL}")
+    with trace.span("hydra_login"):
+        hydra.login(hydra_username, hydra_password)
+    return True
+
+
+def get_nix_base_url(args):
+    """
+        The flake url of the nix base repo given by the --nix-base or --nix-base-remote options, None if there is
+        none.
+    """
+    if args.nix_base:
+      nix_base_url = args.nix_base
+    elif args.nix_base_remote:
+      cmd = ["git", "rev-parse", "HEAD"]
+      with trace.span("subprocess", cmd=str(cmd)):
+        rev = subprocess.check_output(cmd, universal_newlines=True).strip()
+      nix_base_url = f"ros-base/{rev}"
+    else:
+      nix_base_url = Path.cwd()
+      if not (nix_base_url / "flake.nix").exists():
+        logger.error("Current directory does not contain flake.nix. Specify --nix-base option.")
+        return None
+    return nix_base_url
+
+
+def find_unused_tag(output_path, version):
+    """
+        Returns the first of version-0 to version-15 that isn't a tag of the origin of output_path yet, or None.
+    """
+    cmd = ["git", "ls-remote", "origin", f"refs/tags/{version}*"]
+    with trace.span("ls_remote_tags"):
+        remote_tags = retrying_check_output(cmd, universal_newlines=True, cwd=output_path)
+    for tag_suffix in range(16):
+        tag = f"{version}-{tag_suffix}"
+        if tag not in remote_tags:
+            return tag
+    return None
+
+
+def commit_and_push(output_path, tag, sink=None):
+    """
+        Commit everything in output_path, directly from the GitSink if one is given, then tag and push the tag.
+    """
+    with trace.span("git_commit"):
+        if sink is not None:
+            sink.add(output_path / "flake.lock")
+            sink.commit(tag)
+        else:
+            traced_check_call(["git", "add", "-A"], cwd=output_path)
+            traced_check_call(["git", "commit", "--no-verify", "--allow-empty", "-m", tag], cwd=output_path)
+
+        traced_check_call(["git", "tag", tag], cwd=output_path)
+    with trace.span("git_push"):
+        retrying_check_call(["git", "push", "origin", tag], cwd=output_path)
+
+
+async def generate_distros(
+    output_path, ref, rosdep_urls, jobs, cache=None, transport=None, base_ref=None, output_format="nix", sink=None,
+    rosdep_commit=None, only=None, rosdep_resolver=None, base_fingerprints=None,
+):
+    """
+        Fetch the rosdep mappings and the snapshots of all distros concurrently over one client, and write out the
+        package definitions of each distro as soon as its snapshot has arrived.
+
+        With a base_ref, the output is assumed to hold a generation from that ref, and only the files of repositories
+        and packages that changed since are regenerated. Returns the change summary of each distro in that case.
+
+        The output_format is either "nix", a nix file per repository and package, or "json-index", a single
+        index.json per distro that the colconScopeFromJsonIndex function of the lib overlay builds the scope from.
+        The files go to the given sink, or the output directory. With the rosdistro commit the rosdep_urls point
+        to, the rosdep mappings are kept in the cache until that commit changes. The glob patterns in only restrict
+        the distros to the packages they select and the dependency closure of those.
+
+        A long running caller can pass a rosdep_resolver to skip fetching the rosdep files, and keep the state of
+        the previous generation in base_fingerprints, a dict of the repository fingerprints of each distro, instead
+        of a base_ref. It is updated with those of ref as each distro is written.
+    """
+    loop = asyncio.get_running_loop()
+    async with httpx.AsyncClient(transport=transport) as client:
+        async def get_rosdep_resolver():
+            if rosdep_resolver is not None:
+                return rosdep_resolver
+            return await load_rosdep_resolver(rosdep_urls, client, rosdep_commit, cache)
+
+        rosdep_task = asyncio.create_task(get_rosdep_resolver())
+        # Distros are written one at a time, that keeps their log output together and the writers would be
+        # contending for the same cores anyway.
+        write_lock = asyncio.Lock()
+
+        changes = {}
+
+        async def generate_distro(distro_name):
+            with trace.span("distro", distro=distro_name):
+                await write_distro(distro_name)
+
+        async def write_distro(distro_name):
+            base_snapshot = None
+            if base_ref:
+                snapshot, base_snapshot = await asyncio.gather(
+                    fetch_distro(client, distro_name, ref, cache), fetch_distro(client, distro_name, base_ref, cache)
+                )
+            else:
+                snapshot = await fetch_distro(client, distro_name, ref, cache)
+            distro_fingerprints = base_fingerprints.get(distro_name, {}) if base_fingerprints is not None else None
+            async with write_lock:
+                # The snapshot is parsed while it is ingested by the writer, which is blocking as well.
+                with snapshot, trace.span("ingest") as span:
+                    writer = await loop.run_in_executor(None, trace.in_context(functools.partial(
+                        Writer, output_path / distro_name, iter_repositories(snapshot), EXCLUDE_PACKAGES, jobs=jobs,
+                        base_repositories=iter_repositories(base_snapshot) if base_snapshot else None, sink=sink,
+                        only=only, base_fingerprints=distro_fingerprints,
+                    )))
+                    span.set(bytes=snapshot.tell(), repositories=len(writer.repo_names), items=len(writer.packages))
+                if base_snapshot:
+                    base_snapshot.close()
+                if writer.diff is not None:
+                    changes[distro_name] = writer.diff.summary()
+                if output_format == "json-index":
+                    with trace.span("wait_rosdeps"):
+                        resolver = await rosdep_task
+                    with trace.span("write_json_index", items=len(writer.packages)):
+                        await loop.run_in_executor(None, trace.in_context(writer.write_json_index, resolver))
+                    with trace.span("finish"):
+                        writer.finish()
+                    if base_fingerprints is not None:
+                        base_fingerprints[distro_name] = writer.fingerprints
+                    return
+                # Writing is blocking, run it in a thread so the remaining downloads keep going.
+                with trace.span("write_srcs_files", items=len(writer.repositories)) as span:
+                    await loop.run_in_executor(None, trace.in_context(writer.write_srcs_files))
+                    span.set(written=writer.manifest.written)
+                with trace.span("wait_rosdeps"):
+                    resolver = await rosdep_task
+                with trace.span("write_packages_files", items=len(writer.packages)) as span:
+                    written = writer.manifest.written
+                    await loop.run_in_executor(None, trace.in_context(writer.write_packages_files, resolver))
+                    span.set(written=writer.manifest.written - written)
+                with trace.span("finish"):
+                    writer.finish()
+                if base_fingerprints is not None:
+                    base_fingerprints[distro_name] = writer.fingerprints
+
+        try:
+            resolver, *_ = await asyncio.gather(rosdep_task, *[generate_distro(d) for d in DISTRO_NAMES])
+        finally:
+            rosdep_task.cancel()
+    logger.debug(f"Rosdep resolver statistics: {resolver.stats()}")
+    return changes
+
 
 def main():
-    parser = argparse.ArgumentParser()
+    if sys.argv[1:2] == ["serve"]:
+        from .serve import main as serve_main
+        return serve_main(sys.argv[2:])
+    if sys.argv[1:2] == ["graph"]:
+        from .graph_cli import main as graph_main
+        return graph_main(sys.argv[2:])
+
+    parser = argparse.ArgumentParser(
+        epilog="Run 'generate serve --help' for the options of the generator daemon, and 'generate graph --help' for "
+               "the dependency graph statistics of a snapshot."
+    )
     parser.add_argument(
         "-o", "--output", default=None, help="Output path, defaults to cwd/build."
     )
+    parser.add_argument(
+        "--output-archive", default=None, type=Path,
+        help="Stream the generated files into this tar archive instead of writing them to the output path, "
+             "compressed according to its suffix: .tar, .tar.gz, .tar.xz, .tar.bz2 or .tar.zst. The last one needs "
+             "the zstd extra."
+    )
     parser.add_argument(
         "-n", "--nix-base", default=None, help="Flake URL for nix base repo, defaults to cwd."
     )
@@ -63,6 +290,11 @@ def main():
     parser.add_argument(
         "-t", "--push-tag", action='store_true', help="Run flake check, tag, and git push the result."
     )
+    parser.add_argument(
+        "--direct-commit", action="store_true",
+        help="With --push-tag, stream the generated files straight into the commit with git fast-import instead of "
+             "running git add and commit over the whole output tree."
+    )
     parser.add_argument(
         "--create-hydra-job", action='store_true',
         help="Create hydra job for this tag, requires HYDRA_USERNAME and HYDRA_PASSWORD to be set."
@@ -86,49 +318,136 @@ def main():
     parser.add_argument(
         "--ref", default=None, help="Ref to generate for, otherwise uses the latest found."
     )
+    parser.add_argument(
+        "--base-ref", default=None,
+        help="Ref the output was last generated for, only what changed since is regenerated. Changes in the rosdep "
+             "data are not considered."
+    )
+    parser.add_argument(
+        "--change-summary", default="-",
+        help="File to write the json summary of changes since --base-ref to [defaults to stdout]."
+    )
+    parser.add_argument(
+        "--format", default="nix", choices=["nix", "json-index"],
+        help="Write a nix file per repository and package, or a single json index per distro [defaults to %(default)s]."
+    )
+    parser.add_argument(
+        "--only", nargs="+", default=None, metavar="GLOB",
+        help="Only generate the packages with a name or repository name matching one of these globs, and the "
+             "packages they depend on for building, running or testing."
+    )
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=1,
+        help="Number of worker processes used to write package files, 0 uses all cores [defaults to %(default)s]."
+    )
+    parser.add_argument(
+        "--cache-dir", default=CACHE_DIR, type=Path,
+        help="Directory to cache downloaded distro snapshots in, may be shared [defaults to %(default)s]."
+    )
+    parser.add_argument(
+        "--cache-size", default=2048, type=int,
+        help="Size in MB the cache directory is limited to [defaults to %(default)s]."
+    )
+    parser.add_argument("--no-cache", action="store_true", help="Always download distro snapshots.")
+    bundle_group = parser.add_mutually_exclusive_group()
+    bundle_group.add_argument(
+        "--export-bundle", default=None, type=Path,
+        help="Write everything downloaded for this run to a bundle file, implies --no-cache."
+    )
+    bundle_group.add_argument(
+        "--offline-bundle", default=None, type=Path,
+        help="Generate from a bundle written by --export-bundle, without any network access. A --base-ref has to "
+             "be the one the bundle was exported with."
+    )
 
+    parser.add_argument(
+        "--trace-file", default=None, type=Path,
+        help="Write json spans with the timing of each phase, http request and subprocess call to this file."
+    )
     parser.add_argument("--verbose", action="store_true", help="Additional log output.")
     args = parser.parse_args()
 
+    if args.trace_file:
+        # Saved at exit, so that runs which fail or exit early still leave their trace behind.
+        tracer = trace.enable()
+        atexit.register(tracer.save, args.trace_file)
+
     logger.setLevel(logging.DEBUG if args.verbose else logging.INFO)
+    jobs = args.jobs if args.jobs > 0 else os.cpu_count()
 
     hydra = Hydra(HYDRA_URL)
-    if args.create_hydra_job:
+    atexit.register(hydra.close)
+    if args.create_hydra_job and not hydra_login(hydra):
+        return 1
+
+    # Setup output path, with an archive it is only the root the paths in the archive are relative to.
+    output_path = Path(args.output) if args.output else Path.cwd() / "build"
+    sink = None
+    if args.direct_commit and (args.output_archive or not args.push_tag):
+        logger.error("--direct-commit requires --push-tag and an output directory.")
+        return 1
+    if args.output_archive:
+        if args.push_tag or args.create_lock:
+            logger.error("The flake lock can't be created, or a tag pushed, for an archive output.")
+            return 1
         try:
-            hydra_username = os.environ["HYDRA_USERNAME"]
-            hydra_password = os.environ["HYDRA_PASSWORD"]
-        except KeyError:
-            logger.error("Auth vars HYDRA_USERNAME and HYDRA_PASSWORD are not set.")
+            sink = TarSink.open(output_path, args.output_archive)
+        except SinkError as e:
+            logger.error(str(e))
             return 1
-        logger.info(f"Logging into {HYDRA_URL}")
-        hydra.login(hydra_username, hydra_password)
+    else:
+        output_path.mkdir(parents=True, exist_ok=True)
+        if args.direct_commit:
+            # Committed after the flake lock is updated, until then the fast-import stream is left open.
+            sink = GitSink(output_path, untracked=[MANIFEST_NAME])
+            atexit.register(sink.close)
 
-    # Setup output path.
-    output_path = Path(args.output) if args.output else Path.cwd() / "build"
-    output_path.mkdir(parents=True, exist_ok=True)
+    nix_base_url = get_nix_base_url(args)
+    if nix_base_url is None:
+        return 1
 
-    if args.nix_base:
-      nix_base_url = args.nix_base
-    elif args.nix_base_remote:
-      cmd = ["git", "rev-parse", "HEAD"]
-      rev = subprocess.check_output(cmd, universal_newlines=True).strip()
-      nix_base_url = f"ros-base/{rev}"
+    # Setup where the network inputs come from.
+    cache = None
+    if args.offline_bundle:
+        try:
+            bundle = Bundle.load(args.offline_bundle)
+        except BundleError as e:
+            logger.error(str(e))
+            return 1
+        transport = BundleTransport(bundle)
+    elif args.export_bundle:
+        bundle = Bundle()
+        transport = RecordingTransport(bundle)
     else:
-      nix_base_url = Path.cwd()
-      if not (nix_base_url / "flake.nix").exists():
-        logger.error("Current directory does not contain flake.nix. Specify --nix-base option.")
-        return 1
+        bundle = None
+        transport = None
+        if not args.no_cache:
+            cache = DiskCache(args.cache_dir, max_size=args.cache_size * 1024 * 1024)
 
     # Determine distro snapshot and version string.
     if args.ref:
         ref = sanitize_ref(args.ref)
         if ref != args.ref:
             logging.warn(f"Provided ref '{args.ref}' was not a full ref, using '{ref}'.")
+    elif args.offline_bundle:
+        # Use the tags listing stored in the bundle if it has one, otherwise the ref it was made for.
+        ref = bundle.refs_listing.split()[-1] if bundle.refs_listing else bundle.ref
     else:
         # Use git to determine the latest tag.
         git_cmd = ["git", "ls-remote", DISTRO_SNAPSHOTS_URL, "refs/tags/*"]
-        git_output = retrying_check_output(git_cmd, universal_newlines=True).strip()
+        with trace.span("ls_remote_snapshots"):
+            git_output = retrying_check_output(git_cmd, universal_newlines=True).strip()
         ref = git_output.split()[-1]
+        if args.export_bundle:
+            bundle.refs_listing = git_output
+
+    base_ref = None
+    if args.base_ref:
+        base_ref = sanitize_ref(args.base_ref)
+        if args.offline_bundle and base_ref != bundle.base_ref:
+            logger.error(f"The offline bundle has no snapshots of {base_ref}, export it with the same --base-ref.")
+            return 1
+        logger.info(f"Generating changes since {base_ref}.")
 
     version = ref
 
@@ -139,13 +458,8 @@ def main():
         if str(nix_base_url).startswith("/"):
             logger.error("Unwilling to create and push tag with nix-base on a local path.");
             sys.exit(1)
-        cmd = ["git", "ls-remote", "origin", f"refs/tags/{version}*"]
-        remote_tags = retrying_check_output(cmd, universal_newlines=True, cwd=output_path)
-        for tag_suffix in range(16):
-            tag = f"{version}-{tag_suffix}"
-            if tag not in remote_tags:
-                break
-        else:
+        tag = find_unused_tag(output_path, version)
+        if tag is None:
             logger.error(f"Unable to find unused tag for version {version}.")
             sys.exit(1)
     else:
@@ -154,34 +468,50 @@ def main():
 
     # The final version is now available, write out the top level flake and release files.
     overlay_paths = DISTRO_NAMES
-    Writer.write_base_files(output_path, nix_base_url, overlay_paths, flake_tag=tag, rosdistro_ref=ref)
-
-    # Fetch rosdep information from rosdistro.
-    rosdep_urls = (v.format(DISTRO_URL=DISTRO_URL, rosdep_branch=args.rosdep_branch) for v in ROSDEP_URLS)
-    rosdep_mapping = fetch_rosdeps(rosdep_urls)
-    rosdep_mapping.update(ROSDEP_OVERRIDES)
-
-    # Fetch distro information and write out src/package definitions.
-    for distro_name in DISTRO_NAMES:
-        url = DISTRO_CACHE_URL.format(distro=distro_name, ref=ref)
-        logger.info(f"Loading distro snapshot: {url}")
-        req = httpx.get(url, timeout=420.0)
-        if req.status_code == httpx.codes.OK:
-            logger.debug(f"Distro cache request completed: {req}")
-            info = req.json()
-            writer = Writer(output_path / distro_name, info["repositories"], EXCLUDE_PACKAGES)
-            writer.write_srcs_files()
-            writer.write_packages_files(rosdep_mapping)
+    with trace.span("write_base_files"):
+        Writer.write_base_files(output_path, nix_base_url, overlay_paths, flake_tag=tag, rosdistro_ref=ref, sink=sink)
+
+    # Fetch rosdep and distro information and write out src/package definitions.
+    # The rosdep files are pinned to the commit the branch is at, which the cached rosdep mappings are keyed by.
+    rosdep_urls, rosdep_commit = get_rosdep_urls(args.rosdep_branch, pin=cache is not None)
+    try:
+        with trace.span("generate_distros"):
+            changes = asyncio.run(generate_distros(
+                output_path, ref, rosdep_urls, jobs, cache, transport, base_ref, output_format=args.format, sink=sink,
+                rosdep_commit=rosdep_commit, only=args.only,
+            ))
+    except DistroCacheError as e:
+        logger.error(str(e))
+        logger.error(f"Exiting, failure may be due to an incorrect snapshot reference.")
+        sys.exit(2)
+    finally:
+        if isinstance(sink, TarSink):
+            sink.close()
+
+    if base_ref:
+        summary = {
+            "base_ref": base_ref,
+            "ref": ref,
+            "changed": any(c["changed"] for c in changes.values()),
+            "distros": changes,
+        }
+        if args.change_summary == "-":
+            json.dump(summary, sys.stdout, indent=2, sort_keys=True)
+            print()
         else:
-            logger.error(f"Failed to retrieve distro snapshot {url}, status code: {req.status_code}.")
-            logger.error(f"Exiting, failure may be due to an incorrect snapshot reference.")
-            sys.exit(2)
+            with open(args.change_summary, "w") as f:
+                json.dump(summary, f, indent=2, sort_keys=True)
+
+    if args.export_bundle:
+        bundle.ref, bundle.base_ref = ref, base_ref
+        bundle.save(args.export_bundle)
 
     logger.info(f"Successful generation for tag {tag}")
 
     if args.push_tag or args.create_lock:
         logger.info("Updating flake lock.");
-        subprocess.check_call(["nix", "flake", "update"], cwd=output_path)
+        with trace.span("flake_update"):
+            traced_check_call(["nix", "flake", "update"], cwd=output_path)
 
     if args.push_tag:
         hydra_project = args.hydra_project
@@ -189,15 +519,12 @@ def main():
             logger.error("Unwilling to create and push tag with nix-base on a local path.");
             sys.exit(1)
 
-        subprocess.check_call(["git", "add", "-A"], cwd=output_path)
-        subprocess.check_call(["git", "commit", "--no-verify", "--allow-empty", "-m", tag], cwd=output_path)
-
-        subprocess.check_call(["git", "tag", tag], cwd=output_path)
-        retrying_check_call(["git", "push", "origin", tag], cwd=output_path)
+        commit_and_push(output_path, tag, sink if args.direct_commit else None)
 
         if args.create_hydra_job:
             logger.info(f"Creating and evaluating jobset {hydra_project}:v{tag}")
-            hydra.push_jobset_tag(hydra_project, tag)
+            with trace.span("hydra_push_jobset"):
+                hydra.push_jobset_tag(hydra_project, tag)
     if args.write_hydra_jobset_name_file:
         with open(args.write_hydra_jobset_name_file, "w") as f:
             f.write(f"v{tag}")
@@ -1,9 +1,16 @@
 import os
+from pathlib import Path
 
 DISTRO_CACHE_URL = "http://colcon-distro.ext.ottomotors.com/get/{distro}/{ref}.json"
 HYDRA_URL = os.environ.get("HYDRA_URL", None)
+# The api of the gitlab instance that the pipelines watched by 'hydra ci_watcher' run on, in CI this is set.
+GITLAB_API_URL = os.environ.get("CI_API_V4_URL", "https://gitlab.com/api/v4")
+
+CACHE_DIR = Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")) / "nix-generator"
 
 DISTRO_SNAPSHOTS_URL = "https://github.com/clearpathrobotics/rosdistro-snapshots"
+# Snapshot tags are named by date below this prefix, like refs/tags/snapshot/20220329.
+SNAPSHOT_TAG_PREFIX = "refs/tags/snapshot/"
 
 DISTRO_URL = "https://github.com/ros/rosdistro"
 DISTRO_NAMES = ("noetic", "rolling")
@@ -0,0 +1,223 @@
+import asyncio
+import codecs
+import httpx
+import json
+import logging
+import re
+import tempfile
+
+from . import trace
+from .defaults import DISTRO_CACHE_URL
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+
+
+class DistroCacheError(Exception):
+    pass
+
+
+def is_immutable_ref(ref):
+    # Snapshot tags are never moved, anything else, like a branch, may point elsewhere by now.
+    return ref.startswith("refs/tags/")
+
+
+async def fetch_distro(client, distro_name, ref, cache=None):
+    """
+        Download the colcon-distro snapshot of distro_name at ref with the given httpx.AsyncClient. The body is
+        streamed to a temporary file as it arrives, which is returned as an open binary file for iter_repositories,
+        so the snapshot is never held in memory as a whole.
+
+        If a DiskCache is passed, snapshots of immutable refs are served from it without any request, and those of
+        other refs are revalidated with the ETag and Last-Modified headers of the cached response.
+    """
+    url = DISTRO_CACHE_URL.format(distro=distro_name, ref=ref)
+    cache_key = f"distro/{distro_name}/{ref}"
+    # The cache reads and writes files, that is done off the event loop so the other transfers aren't stalled.
+    loop = asyncio.get_running_loop()
+    cached = await loop.run_in_executor(None, cache.open, cache_key) if cache is not None else None
+
+    if cached is not None and is_immutable_ref(ref):
+        logger.info(f"Using cached distro snapshot: {url}")
+        with trace.span("cache_hit", url=url):
+            return cached.data
+
+    headers = {}
+    if cached is not None:
+        if cached.metadata.get("etag"):
+            headers["If-None-Match"] = cached.metadata["etag"]
+        if cached.metadata.get("last_modified"):
+            headers["If-Modified-Since"] = cached.metadata["last_modified"]
+
+    logger.info(f"Loading distro snapshot: {url}")
+    snapshot = None
+    try:
+        with trace.span("http", method="GET", url=url) as span:
+            async with client.stream("GET", url, headers=headers, timeout=420.0) as resp:
+                span.set(status_code=resp.status_code)
+                if cached is not None and resp.status_code == httpx.codes.NOT_MODIFIED:
+                    logger.debug(f"Distro snapshot not modified, using cached copy: {resp}")
+                    return cached.data
+                if cached is not None:
+                    cached.data.close()
+                if resp.status_code != httpx.codes.OK:
+                    raise DistroCacheError(
+                        f"Failed to retrieve distro snapshot {url}, status code: {resp.status_code}."
+                    )
+
+                snapshot = tempfile.TemporaryFile()
+                async for chunk in resp.aiter_bytes():
+                    snapshot.write(chunk)
+                span.set(bytes=snapshot.tell())
+        logger.debug(f"Distro cache request completed: {resp} ({snapshot.tell()} bytes)")
+
+        if cache is not None:
+            snapshot.seek(0)
+            metadata = {
+                "etag": resp.headers.get("etag"),
+                "last_modified": resp.headers.get("last-modified"),
+            }
+            await loop.run_in_executor(None, cache.put_file, cache_key, snapshot, metadata)
+        snapshot.seek(0)
+        return snapshot
+    except BaseException:
+        # Neither the cached copy nor the partial download are left open if the request or the caching fails.
+        if cached is not None:
+            cached.data.close()
+        if snapshot is not None:
+            snapshot.close()
+        raise
+
+
+def iter_repositories(snapshot, chunk_size=1 << 16):
+    """
+        Incrementally parse the binary file of a colcon-distro snapshot, yielding (repo_name, repo_dict) for each
+        entry of its "repositories" object. Other top level keys are skipped.
+
+        Only one repository is decoded at a time, and the text buffer is bounded by chunk_size plus the size of the
+        largest single repository entry, so the memory used for parsing does not grow with the size of the distro.
+    """
+    reader = _JsonReader(snapshot, chunk_size)
+    reader.expect("{")
+    while not reader.consume("}"):
+        key = reader.decode()
+        reader.expect(":")
+        if key == "repositories":
+            reader.expect("{")
+            while not reader.consume("}"):
+                repo_name = reader.decode()
+                reader.expect(":")
+                yield repo_name, reader.decode()
+                reader.consume(",")
+        else:
+            reader.decode()
+        reader.consume(",")
+
+
+class _JsonReader:
+    """
+        A window onto a binary file of json, from which values are decoded one at a time.
+    """
+
+    WHITESPACE = re.compile(r"[ \t\n\r]*")
+    # What matters for finding the end of an object, array or string: outside of strings the brackets and quotes,
+    # inside of them the closing quote and escapes.
+    STRUCTURE = re.compile(r'[{}\[\]"]')
+    STRING_STRUCTURE = re.compile(r'["\\]')
+
+    def __init__(self, f, chunk_size):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self.json_decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        if self.eof:
+            return False
+        # Drop what has been consumed already, so that the buffer only ever holds the value being decoded.
+        self.buffer = self.buffer[self.pos:]
+        self.pos = 0
+        data = self.f.read(self.chunk_size)
+        if not data:
+            self.eof = True
+        self.buffer += self.text_decoder.decode(data, final=self.eof)
+        return True
+
+    def skip_whitespace(self):
+        while True:
+            self.pos = self.WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer) or not self.fill():
+                return
+
+    def consume(self, char):
+        self.skip_whitespace()
+        if self.buffer.startswith(char, self.pos):
+            self.pos += 1
+            return True
+        return False
+
+    def expect(self, char):
+        if not self.consume(char):
+            found = self.buffer[self.pos:self.pos + 20]
+            raise ValueError(f"Expected '{char}' in distro snapshot json, found '{found}'.")
+
+    def value_end(self):
+        """
+            Reads until the object, array or string at pos is complete, returns the offset in the buffer it ends at,
+            or None if the file ends before. Each chunk is only scanned once, so that a value spanning many chunks
+            is decoded in linear time, rather than trying to decode it again from the start after every read.
+        """
+        depth = 0
+        in_string = False
+        # How far the buffer has been scanned, relative to pos, as fill moves the buffer.
+        scanned = 0
+        while True:
+            i = self.pos + scanned
+            while True:
+                match = (self.STRING_STRUCTURE if in_string else self.STRUCTURE).search(self.buffer, i)
+                if match is None:
+                    i = len(self.buffer)
+                    break
+                char = match.group()
+                i = match.end()
+                if char == "\\":
+                    if i == len(self.buffer):
+                        # The escaped character is in the next chunk.
+                        i -= 1
+                        break
+                    i += 1
+                    continue
+                if char == '"':
+                    in_string = not in_string
+                elif char in "{[":
+                    depth += 1
+                else:
+                    depth -= 1
+                if depth == 0 and not in_string:
+                    return i
+            scanned = i - self.pos
+            if not self.fill():
+                return None
+
+    def decode(self):
+        self.skip_whitespace()
+        if self.buffer.startswith(("{", "[", '"'), self.pos):
+            # Decoded once it is complete, raw_decode raises if it never is.
+            self.value_end()
+            value, self.pos = self.json_decoder.raw_decode(self.buffer, self.pos)
+            return value
+        # Numbers and literals are short, they are retried until they no longer run up to the end of the buffer.
+        while True:
+            try:
+                value, end = self.json_decoder.raw_decode(self.buffer, self.pos)
+                # A number running up to the end of the buffer may continue in the next chunk.
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.fill()
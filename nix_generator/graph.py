@@ -0,0 +1,154 @@
+def strongly_connected_components(edges):
+    """
+        Tarjan's algorithm, without recursion so that deep dependency chains don't hit the recursion limit. edges
+        maps each node to the nodes it depends on, nodes only appearing as a dependency are leaves. Returns the
+        components as lists of nodes, every component after all the components it depends on.
+    """
+    index = {}
+    lowlink = {}
+    stack = []
+    on_stack = set()
+    components = []
+
+    for root in edges:
+        if root in index:
+            continue
+        index[root] = lowlink[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(edges.get(root, ())))]
+        while work:
+            node, successors = work[-1]
+            for successor in successors:
+                if successor not in index:
+                    index[successor] = lowlink[successor] = len(index)
+                    stack.append(successor)
+                    on_stack.add(successor)
+                    work.append((successor, iter(edges.get(successor, ()))))
+                    break
+                if successor in on_stack:
+                    lowlink[node] = min(lowlink[node], index[successor])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    components.append(component)
+    return components
+
+
+def transitive_closures(edges):
+    """
+        The transitive dependencies of every node in edges, each as a list ordered so that dependencies come before
+        the nodes depending on them. A node is never part of its own closure, even if it is on a cycle.
+
+        The closures are built bottom up over the condensation of the graph, as bitsets indexed by topological
+        position, so each one costs a few big integer ors per edge rather than a walk over the dependencies.
+    """
+    bits, position, order = _closure_bits(edges)
+    closures = {}
+    for node in edges:
+        closures[node] = _positions(bits[node] & ~(1 << position[node]), order)
+    return closures
+
+
+def closure_sizes(edges):
+    """
+        The number of transitive dependencies of every node in edges, without building the closures themselves.
+    """
+    bits, position, _ = _closure_bits(edges)
+    return {node: bin(bits[node] & ~(1 << position[node])).count("1") for node in edges}
+
+
+def _closure_bits(edges):
+    components = strongly_connected_components(edges)
+    order = []
+    position = {}
+    for component in components:
+        for node in sorted(component):
+            position[node] = len(order)
+            order.append(node)
+
+    bits = {}
+    for component in components:
+        reachable = 0
+        for node in component:
+            for successor in edges.get(node, ()):
+                reachable |= bits.get(successor, 0) | (1 << position[successor])
+        for node in component:
+            bits[node] = reachable
+    return bits, position, order
+
+
+def dependency_levels(edges):
+    """
+        The level of every node, 0 for nodes without dependencies and otherwise one more than the highest level among
+        its dependencies. All nodes of a cycle share a level. The nodes of one level only depend on lower levels, so
+        they can all be built at the same time once those are done.
+    """
+    components = strongly_connected_components(edges)
+    component_index = {node: i for i, component in enumerate(components) for node in component}
+    component_levels = []
+    for i, component in enumerate(components):
+        level = 0
+        for node in component:
+            for successor in edges.get(node, ()):
+                j = component_index[successor]
+                if j != i:
+                    level = max(level, component_levels[j] + 1)
+        component_levels.append(level)
+    return {node: component_levels[i] for node, i in component_index.items()}
+
+
+def critical_path(edges, levels=None):
+    """
+        A longest chain of dependencies, as a list of nodes from the one nothing further depends on down to one
+        without dependencies, one node per level. Its length bounds how far building the nodes can be parallelized.
+    """
+    if levels is None:
+        levels = dependency_levels(edges)
+    if not levels:
+        return []
+    node = max(levels, key=lambda n: (levels[n], str(n)))
+    path = [node]
+    while levels[node] > 0:
+        node = max(
+            (s for s in edges.get(node, ()) if levels[s] == levels[node] - 1),
+            key=str,
+            default=None,
+        )
+        if node is None:
+            # The dependency on the next level down is that of another node on the same cycle.
+            break
+        path.append(node)
+    return path
+
+
+def cycles(edges):
+    """
+        The strongly connected components of more than one node, or of a node depending on itself, each sorted.
+    """
+    return [
+        sorted(component, key=str)
+        for component in strongly_connected_components(edges)
+        if len(component) > 1 or component[0] in edges.get(component[0], ())
+    ]
+
+
+def _positions(bitset, order):
+    # Scanning the binary digits with str.find is far quicker than peeling off one bit at a time.
+    digits = bin(bitset)[:1:-1]
+    nodes = []
+    i = digits.find("1")
+    while i != -1:
+        nodes.append(order[i])
+        i = digits.find("1", i + 1)
+    return nodes
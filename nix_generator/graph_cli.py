@@ -0,0 +1,205 @@
+"""
+    Dependency graph statistics of the distro snapshots, run as 'generate graph'. For each distro it reports the
+    depth of the graph of workspace packages and its width per level, a critical path, the packages with the largest
+    transitive closures and the most dependents, and any dependency cycles. The graph can also be exported as json or
+    as a graphviz dot file.
+"""
+import argparse
+import asyncio
+from collections import Counter
+import json
+import logging
+from pathlib import Path
+
+import httpx
+
+from . import cli
+from .cache import DiskCache
+from .defaults import *
+from .distro_cache import DistroCacheError, fetch_distro, iter_repositories
+from .graph import closure_sizes, critical_path, cycles, dependency_levels
+from .model import Package
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+
+DEPEND_KINDS = ("build", "run", "test")
+
+
+def package_graph(repositories, kinds=("build", "run"), exclude_packages=EXCLUDE_PACKAGES):
+    """
+        The dependency graph of the workspace packages of a snapshot, given as (repo_name, repo_dict) pairs like
+        iter_repositories produces. Returns a dict mapping each package name to the sorted names of the workspace
+        packages it depends on with one of the given kinds of dependency, system dependencies are left out.
+    """
+    packages = []
+    for repo_name, repo_dict in repositories:
+        packages.extend(
+            Package.from_dict(repo_name, d) for d in repo_dict.get("packages", []) if d["name"] not in exclude_packages
+        )
+    names = set(p.name for p in packages)
+    edges = {}
+    for package in packages:
+        depends = set()
+        for kind in kinds:
+            depends.update(name for name in getattr(package, kind) if name in names)
+        edges[package.name] = sorted(depends)
+    return edges
+
+
+def reverse_edges(edges):
+    reverse = {node: [] for node in edges}
+    for node, successors in edges.items():
+        for successor in successors:
+            reverse[successor].append(node)
+    return reverse
+
+
+def _top(counts, top):
+    return [[name, count] for name, count in sorted(counts.items(), key=lambda item: (-item[1], item[0]))[:top]]
+
+
+def analyze(edges, top=10):
+    """
+        The statistics of the graph in edges, as a json serializable dict. Levels are counted from 0, the packages
+        without workspace dependencies, so the depth is the number of levels; all packages of one level can be
+        built in parallel once the lower levels are done.
+    """
+    levels = dependency_levels(edges)
+    width = Counter(levels.values())
+    reverse = reverse_edges(edges)
+    return {
+        "packages": len(edges),
+        "edges": sum(len(successors) for successors in edges.values()),
+        "depth": max(width) + 1 if width else 0,
+        "width": [width[level] for level in range(len(width))],
+        "critical_path": critical_path(edges, levels),
+        "largest_closures": _top(closure_sizes(edges), top),
+        "most_dependents": _top({node: len(nodes) for node, nodes in reverse.items()}, top),
+        "most_transitive_dependents": _top(closure_sizes(reverse), top),
+        "cycles": cycles(edges),
+    }
+
+
+def format_report(distro_name, report):
+    lines = [
+        f"{distro_name}: {report['packages']} packages, {report['edges']} dependencies, depth {report['depth']}",
+        f"  width per level: {' '.join(str(w) for w in report['width'])}",
+        f"  critical path ({len(report['critical_path'])}): {' -> '.join(report['critical_path'])}",
+    ]
+    for key, title in (
+        ("largest_closures", "largest transitive closures"),
+        ("most_dependents", "most direct dependents"),
+        ("most_transitive_dependents", "most transitive dependents"),
+    ):
+        lines.append(f"  {title}:")
+        lines.extend(f"    {count:6} {name}" for name, count in report[key])
+    lines.append(f"  cycles: {len(report['cycles'])}")
+    lines.extend(f"    {' '.join(cycle)}" for cycle in report["cycles"])
+    return "\n".join(lines)
+
+
+def to_json(edges):
+    levels = dependency_levels(edges)
+    return json.dumps(
+        {node: {"level": levels[node], "depends": successors} for node, successors in sorted(edges.items())},
+        indent=1,
+    )
+
+
+def to_dot(edges, name="distro"):
+    """
+        The graph as a graphviz digraph, with the packages of each level on the same rank.
+    """
+    levels = dependency_levels(edges)
+    by_level = {}
+    for node in sorted(edges):
+        by_level.setdefault(levels[node], []).append(node)
+    lines = [f"digraph {json.dumps(name)} {{", "  rankdir=BT;"]
+    for level, nodes in sorted(by_level.items()):
+        lines.append(f"  {{ rank=same; {' '.join(json.dumps(n) + ';' for n in nodes)} }}")
+    for node, successors in sorted(edges.items()):
+        lines.extend(f"  {json.dumps(node)} -> {json.dumps(s)};" for s in successors)
+    lines.append("}")
+    return "\n".join(lines) + "\n"
+
+
+async def load_graphs(distro_names, ref, kinds, cache=None):
+    async with httpx.AsyncClient() as client:
+        snapshots = await asyncio.gather(*[fetch_distro(client, d, ref, cache) for d in distro_names])
+    graphs = {}
+    for distro_name, snapshot in zip(distro_names, snapshots):
+        with snapshot:
+            graphs[distro_name] = package_graph(iter_repositories(snapshot), kinds)
+    return graphs
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="generate graph", description=__doc__)
+    parser.add_argument("--ref", default=None, help="Snapshot ref to analyze, defaults to the latest tag.")
+    parser.add_argument(
+        "--distro", action="append", choices=DISTRO_NAMES, default=None,
+        help="Distro to analyze, can be given more than once [defaults to all of them]."
+    )
+    parser.add_argument(
+        "--depends", action="append", choices=DEPEND_KINDS, default=None,
+        help="Kind of dependency to include as an edge, can be given more than once [defaults to build and run]."
+    )
+    parser.add_argument(
+        "--top", type=int, default=10, help="Number of packages listed per ranking [defaults to %(default)s]."
+    )
+    parser.add_argument("--json", action="store_true", help="Print the report as json.")
+    parser.add_argument(
+        "--export", default=None, type=Path, help="Write the graph of each distro to a file in this directory."
+    )
+    parser.add_argument(
+        "--export-format", default="json", choices=["json", "dot"],
+        help="Format of the exported graphs [defaults to %(default)s]."
+    )
+    parser.add_argument(
+        "--cache-dir", default=CACHE_DIR, type=Path,
+        help="Directory to cache the snapshots in [defaults to %(default)s]."
+    )
+    parser.add_argument(
+        "--cache-size", default=2048, type=int,
+        help="Size in MB the cache directory is limited to [defaults to %(default)s]."
+    )
+    parser.add_argument("--no-cache", action="store_true", help="Always download distro snapshots.")
+    parser.add_argument("--verbose", action="store_true", help="Additional log output.")
+    args = parser.parse_args(argv)
+
+    logging.getLogger("nix_generator").setLevel(logging.DEBUG if args.verbose else logging.INFO)
+
+    if args.ref:
+        ref = cli.sanitize_ref(args.ref)
+    else:
+        git_cmd = ["git", "ls-remote", DISTRO_SNAPSHOTS_URL, "refs/tags/*"]
+        ref = cli.retrying_check_output(git_cmd, universal_newlines=True).strip().split()[-1]
+    logger.info(f"Analyzing snapshot {ref}.")
+
+    distro_names = args.distro or DISTRO_NAMES
+    kinds = tuple(args.depends or ("build", "run"))
+    cache = None if args.no_cache else DiskCache(args.cache_dir, max_size=args.cache_size * 1024 * 1024)
+    try:
+        graphs = asyncio.run(load_graphs(distro_names, ref, kinds, cache))
+    except DistroCacheError as e:
+        logger.error(str(e))
+        return 1
+
+    reports = {}
+    for distro_name, edges in graphs.items():
+        reports[distro_name] = analyze(edges, args.top)
+        if args.export:
+            args.export.mkdir(parents=True, exist_ok=True)
+            if args.export_format == "dot":
+                path, data = args.export / f"{distro_name}.dot", to_dot(edges, distro_name)
+            else:
+                path, data = args.export / f"{distro_name}.json", to_json(edges)
+            path.write_text(data)
+            logger.info(f"Wrote the graph of {distro_name} to {path}.")
+
+    if args.json:
+        print(json.dumps({"ref": ref, "distros": reports}, indent=1))
+    else:
+        print("\n\n".join(format_report(d, r) for d, r in reports.items()))
+    return 0
@@ -1,7 +1,16 @@
+import asyncio
 import contextlib
 import httpx
+import json
+import logging
 import time
 
+from . import trace
+from .polling import THROTTLE_STATUS_CODES
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+
 class HydraException(BaseException):
     pass
 
@@ -15,8 +24,21 @@ class HydraResponseException(HydraException):
         # Print the response, original request and returned text.
         return f"{self.response} {self.request} ({self.response.text})"
 
+def is_throttled(resp):
+    """
+        Whether the server asked to come back later, rather than to retry right away.
+    """
+    return resp.status_code == 429 or (resp.status_code in THROTTLE_STATUS_CODES and "retry-after" in resp.headers)
+
 def client_wrapper(cls, retries=3):
     class Wrapper(cls):
+        # Every request is a span of its own, including each retry.
+        def request(self, method, url, *args, **kwargs):
+            with trace.span("http", method=method, url=str(url)) as span:
+                resp = super().request(method, url, *args, **kwargs)
+                span.set(status_code=resp.status_code, bytes=len(resp.content))
+            return resp
+
         # For get methods, retry up to the allowed number of times.
         def get(self, *args, **kwargs):
             for i in range(retries - 1):
@@ -24,9 +46,9 @@ def client_wrapper(cls, retries=3):
                 # Return if the request was successful
                 if not resp.is_error:
                     return resp
-                if resp.status_code in (404, 403):
-                    # Not found, or permission denied shouldn't need to be retried.
-                    # break to fall through to the exception.
+                if resp.status_code in (404, 403) or is_throttled(resp):
+                    # Not found, or permission denied shouldn't need to be retried, and when asked to slow down the
+                    # caller has to decide how long to wait. break to fall through to the exception.
                     break
                 time.sleep(0.3)
             # Did not get a non-error response in number of retries, fail with error.
@@ -48,26 +70,130 @@ def client_wrapper(cls, retries=3):
 
     return Wrapper
 
+def async_client_wrapper(cls, retries=3):
+    """
+        The same retries and errors as client_wrapper, for an httpx.AsyncClient.
+    """
+    class Wrapper(cls):
+        async def request(self, method, url, *args, **kwargs):
+            with trace.span("http", method=method, url=str(url)) as span:
+                resp = await super().request(method, url, *args, **kwargs)
+                span.set(status_code=resp.status_code, bytes=len(resp.content))
+            return resp
+
+        async def get(self, *args, **kwargs):
+            for i in range(retries - 1):
+                resp = await super().get(*args, **kwargs)
+                if not resp.is_error:
+                    return resp
+                if resp.status_code in (404, 403) or is_throttled(resp):
+                    break
+                await asyncio.sleep(0.3)
+            raise HydraResponseException(resp)
+
+        async def post(self, *args, **kwargs):
+            resp = await super().post(*args, **kwargs)
+            if resp.is_error:
+                raise HydraResponseException(resp)
+            return resp
+
+        async def delete(self, *args, **kwargs):
+            resp = await super().delete(*args, **kwargs)
+            if resp.is_error:
+                raise HydraResponseException(resp)
+            return resp
+
+    return Wrapper
+
 class Hydra:
-    def __init__(self, url, dry_run=False, retries=3):
+    """
+        Client of the hydra api. All requests go through one httpx client that is created on first use and kept
+        until close, so its pool of keep-alive connections, and the session cookie from login, are shared by every
+        call rather than each call doing its own TCP and TLS handshake. It can be used as a context manager to close
+        the connections when done.
+
+        HTTP/2 is used with http2 if the h2 module is installed and the server offers it. At most max_connections
+        are opened at the same time, and timeout is in seconds for each of connecting, reading and writing.
+
+        With a DiskCache as cache, the builds that finished and the evals are kept in it, as those don't change
+        anymore, and only builds that are still going are requested again.
+    """
+
+    def __init__(self, url, dry_run=False, retries=3, http2=False, max_connections=10, timeout=30.0, transport=None,
+                 cache=None):
         self.dry_run = dry_run
-        self.client_cls = DryRunClient if self.dry_run else httpx.Client
-        self.client_cls = client_wrapper(self.client_cls, retries=retries)
+        self.retries = retries
+        self.cache = cache
+        self.client_cls = self._client_cls()
+
+        if http2:
+            try:
+                import h2
+            except ImportError:
+                logger.warning("HTTP/2 requires the h2 module, using HTTP/1.1 for hydra.")
+                http2 = False
 
         self.client_args = {
             "base_url": url,
             "headers": {"Referer": url, "Accept": "application/json"},
             "cookies": None,
+            "http2": http2,
+            "limits": httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            "timeout": httpx.Timeout(timeout),
+            "transport": transport,
         }
+        self._client = None
+
+    def _client_cls(self):
+        return client_wrapper(DryRunClient if self.dry_run else httpx.Client, retries=self.retries)
+
+    def asynchronous(self, max_concurrency=None):
+        """
+            An AsyncHydra for the same server with the same options, logged in with the session cookie of this one.
+            By default it has as many requests in flight as this one has connections. A transport is only shared if
+            it can serve async requests too, otherwise the AsyncHydra makes its own connections.
+        """
+        if max_concurrency is None:
+            max_concurrency = self.client_args["limits"].max_connections
+        other = AsyncHydra(
+            self.client_args["base_url"], dry_run=self.dry_run, retries=self.retries, max_concurrency=max_concurrency
+        )
+        cookies = self._client.cookies if self._client is not None else self.client_args["cookies"]
+        transport = self.client_args["transport"]
+        if not isinstance(transport, httpx.AsyncBaseTransport):
+            transport = None
+        other.client_args.update(self.client_args, cookies=cookies, transport=transport)
+        other.cache = self.cache
+        return other
 
     @contextlib.contextmanager
     def client(self):
-        with self.client_cls(**self.client_args) as client:
-            yield client
+        """
+            Yields the shared client, which is left open for the next call.
+        """
+        if self._client is None:
+            self._client = self.client_cls(**self.client_args)
+        yield self._client
+
+    def close(self):
+        """
+            Close the pooled connections. The cookies are kept, a later call logs in with them on new connections.
+        """
+        if self._client is not None:
+            self.client_args["cookies"] = self._client.cookies
+            self._client.close()
+            self._client = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
     def login(self, username, password):
         login_data = {"username": username, "password": password}
         with self.client() as c:
+            # The session cookie is stored in the cookie jar of the client, and sent along with every later request.
             resp = c.post("/login", data=login_data)
         self.client_args["cookies"] = resp.cookies
 
@@ -134,28 +260,75 @@ class Hydra:
         with self.client() as c:
             resp = c.delete(f"/jobset/{project}/{jobset_name}")
 
+    def _cache_key(self, kind, id):
+        return f"hydra/{self.client_args['base_url']}/{kind}/{id}"
+
+    def _cache_get(self, kind, id):
+        if self.cache is None:
+            return None
+        cached = self.cache.get(self._cache_key(kind, id))
+        if cached is None:
+            return None
+        try:
+            return json.loads(cached.data)
+        except ValueError:
+            return None
+
+    def _cache_put(self, kind, id, data, resp):
+        if self.cache is not None and Hydra.is_immutable(kind, data):
+            self.cache.put(self._cache_key(kind, id), resp.content)
+
+    @staticmethod
+    def is_immutable(kind, data):
+        """
+            Whether the record of the given kind won't change anymore, evals never do and builds once finished.
+        """
+        if kind == "eval":
+            return True
+        # The get-info payload doesn't have the finished flag, the status is only set when the build finished.
+        return bool(data.get("finished", True)) and data.get("buildstatus") is not None
+
+    def _get_cached(self, kind, id, url):
+        data = self._cache_get(kind, id)
+        if data is None:
+            with self.client() as c:
+                resp = c.get(url)
+            data = resp.json()
+            self._cache_put(kind, id, data, resp)
+        return data
+
     def get_build(self, build):
-        with self.client() as c:
-            resp = c.get(f"/build/{build}")
-        return resp.json()
+        return self._get_cached("build", build, f"/build/{build}")
 
     def get_build_info(self, build):
-        with self.client() as c:
-            resp = c.get(f"/build/{build}/api/get-info")
-        return resp.json()
+        return self._get_cached("build-info", build, f"/build/{build}/api/get-info")
 
-    def add_propagated_step_info(self, build_info):
+    def add_propagated_step_info(self, build_info, retrieved_builds=None):
         """
             This function augments the build_info by retrieving the build info for each step that had a propagatedfrom
             element populated. It also attemps to determine which step from the propagated build is associated to the
-            original step.
+            original step. Builds already in retrieved_builds, a dict of build info by id, aren't retrieved again.
         """
-        retrieved_builds = {}
+        if retrieved_builds is None:
+            retrieved_builds = {}
+        for build_id in Hydra.propagated_build_ids(build_info):
+            if not build_id in retrieved_builds:
+                retrieved_builds[build_id] = self.get_build_info(build_id)
+        Hydra.attach_propagated_builds(build_info, retrieved_builds)
+
+    @staticmethod
+    def propagated_build_ids(build_info):
+        return [
+            step["propagatedfrom"]["id"]
+            for step in build_info["steps"]
+            if "propagatedfrom" in step and step["propagatedfrom"]
+        ]
+
+    @staticmethod
+    def attach_propagated_builds(build_info, retrieved_builds):
         for step in build_info["steps"]:
             if "propagatedfrom" in step and step["propagatedfrom"]:
                 build_id = step["propagatedfrom"]["id"]
-                if not build_id in retrieved_builds:
-                    retrieved_builds[build_id] = self.get_build_info(build_id)
                 step["propagatedfrom"]["build_info"] = retrieved_builds[build_id]
 
                 # The next step is a bit of an extra for this function, but it makes sense to do the matching here.
@@ -191,9 +364,7 @@ class Hydra:
         return True
 
     def get_eval(self, evaluation):
-        with self.client() as c:
-            resp = c.get(f"/eval/{evaluation}")
-        return resp.json()
+        return self._get_cached("eval", evaluation, f"/eval/{evaluation}")
 
     def get_projects(self):
         with self.client() as c:
@@ -308,6 +479,165 @@ class Hydra:
         
 
 
+class AsyncHydra(Hydra):
+    """
+        The Hydra client with coroutines for the api calls, to run many of them concurrently. At most
+        max_concurrency requests are in flight at any time, by default as many as there are connections in the pool,
+        so that a large fan-out queues here rather than timing out waiting for a connection. The client and the
+        concurrency limit belong to the event loop of the first call, close it with aclose before that loop ends.
+    """
+
+    def __init__(self, url, dry_run=False, retries=3, http2=False, max_connections=10, timeout=30.0, transport=None,
+                 cache=None, max_concurrency=None):
+        super().__init__(url, dry_run=dry_run, retries=retries, http2=http2, max_connections=max_connections,
+                         timeout=timeout, transport=transport, cache=cache)
+        self.max_concurrency = max_concurrency or max_connections
+        self._semaphore = None
+
+    def _client_cls(self):
+        return async_client_wrapper(AsyncDryRunClient if self.dry_run else httpx.AsyncClient, retries=self.retries)
+
+    def asynchronous(self, max_concurrency=None):
+        return self
+
+    @contextlib.asynccontextmanager
+    async def client(self):
+        """
+            Yields the shared client for one request, waiting while max_concurrency others are in flight.
+        """
+        if self._client is None:
+            self._client = self.client_cls(**self.client_args)
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        async with self._semaphore:
+            yield self._client
+
+    def close(self):
+        raise TypeError("Use aclose to close an AsyncHydra.")
+
+    async def aclose(self):
+        if self._client is not None:
+            self.client_args["cookies"] = self._client.cookies
+            await self._client.aclose()
+            self._client = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    async def login(self, username, password):
+        login_data = {"username": username, "password": password}
+        async with self.client() as c:
+            resp = await c.post("/login", data=login_data)
+        self.client_args["cookies"] = resp.cookies
+
+    async def push_jobset(self, project, flake, jobset_name, description=""):
+        jobset_data = {
+            "description": description,
+            "enabled": 1,
+            "visible": True,
+            "keepnr": 3,
+            "checkinterval": 0,
+            "schedulingshares": 10,
+            "startime": 0,
+            "type": 1,
+            "flake": flake,
+            "inputs": {},
+        }
+
+        async with self.client() as c:
+            resp = await c.put(f"/jobset/{project}/{jobset_name}", data=jobset_data)
+            resp = await c.post(f"/api/push?jobsets={project}:{jobset_name}&force=1")
+        return jobset_name
+
+    async def _get_json(self, url):
+        async with self.client() as c:
+            resp = await c.get(url)
+        return resp.json()
+
+    async def get_jobsets(self, project):
+        return (await self._get_json(f"/project/{project}"))["jobsets"]
+
+    async def get_jobsets_status(self, project):
+        return await self._get_json(f"/api/jobsets?project={project}")
+
+    async def get_jobset_evals(self, project, jobset_name):
+        return await self._get_json(f"/jobset/{project}/{jobset_name}/evals")
+
+    async def delete_jobset(self, project, jobset_name):
+        async with self.client() as c:
+            resp = await c.delete(f"/jobset/{project}/{jobset_name}")
+
+    async def _get_cached(self, kind, id, url):
+        data = self._cache_get(kind, id)
+        if data is None:
+            async with self.client() as c:
+                resp = await c.get(url)
+            data = resp.json()
+            self._cache_put(kind, id, data, resp)
+        return data
+
+    async def get_build(self, build):
+        return await self._get_cached("build", build, f"/build/{build}")
+
+    async def get_build_info(self, build):
+        return await self._get_cached("build-info", build, f"/build/{build}/api/get-info")
+
+    async def get_builds(self, build_ids):
+        """
+            The build of each of build_ids as a dict by id, fetched concurrently.
+        """
+        build_ids = list(dict.fromkeys(build_ids))
+        return dict(zip(build_ids, await asyncio.gather(*[self.get_build(b) for b in build_ids])))
+
+    async def get_builds_info(self, build_ids, propagated=True):
+        """
+            The build info of each of build_ids as a dict by id, fetched concurrently. With propagated, the info of
+            the builds their steps propagated from is added like add_propagated_step_info does, with every such build
+            fetched only once and all of them at the same time.
+        """
+        build_ids = list(dict.fromkeys(build_ids))
+        builds = dict(zip(build_ids, await asyncio.gather(*[self.get_build_info(b) for b in build_ids])))
+        if propagated:
+            propagated_ids = [i for build_info in builds.values() for i in Hydra.propagated_build_ids(build_info)]
+            retrieved_builds = await self.get_builds_info(propagated_ids, propagated=False)
+            for build_info in builds.values():
+                Hydra.attach_propagated_builds(build_info, retrieved_builds)
+        return builds
+
+    async def add_propagated_step_info(self, build_info, retrieved_builds=None):
+        if retrieved_builds is None:
+            retrieved_builds = {}
+        missing = [i for i in Hydra.propagated_build_ids(build_info) if i not in retrieved_builds]
+        retrieved_builds.update(await self.get_builds_info(missing, propagated=False))
+        Hydra.attach_propagated_builds(build_info, retrieved_builds)
+
+    async def get_cancel_build(self, build):
+        if self.dry_run:
+            return True
+        async with self.client() as c:
+            resp = await c.get(f"/build/{build}/cancel")
+        return True
+
+    async def get_eval(self, evaluation):
+        return await self._get_cached("eval", evaluation, f"/eval/{evaluation}")
+
+    async def get_projects(self):
+        return await self._get_json(f"/")
+
+    async def cancel_jobset(self, project, jobset_name):
+        jobset_evals = await self.get_jobset_evals(project=project, jobset_name=jobset_name)
+        if not jobset_evals["evals"]:
+            return
+        await self.cancel_evaluations(jobset_evals["evals"])
+
+    async def cancel_evaluations(self, evaluations):
+        build_ids = [build_id for eval in evaluations for build_id in eval["builds"]]
+        builds = await self.get_builds(build_ids)
+        await asyncio.gather(*[self.get_cancel_build(i) for i, build in builds.items() if not build["finished"]])
+
+
 class DryRunClient(httpx.Client):
     requests = []
 
@@ -325,3 +655,14 @@ class DryRunClient(httpx.Client):
     put = _mock
     post = _mock
     delete = _mock
+
+
+class AsyncDryRunClient(httpx.AsyncClient):
+    requests = DryRunClient.requests
+
+    async def _mock(self, url, **kwargs):
+        return DryRunClient._mock(self, url, **kwargs)
+
+    put = _mock
+    post = _mock
+    delete = _mock
@@ -1,7 +1,10 @@
 import argparse
+import asyncio
 from datetime import datetime
 import fnmatch
+import logging
 import os
+from pathlib import Path
 import sys
 import time
 import json
@@ -11,12 +14,15 @@ import httpx
 # This should switch once we have the actual build step info endpoint.
 HAVE_BUILDSTEP_ENDPOINT = True
 
+from .cache import DiskCache
 from .cli import HYDRA_URL
 from .cli import logger
-from .hydra import Hydra
-from .defaults import GITLAB_API_URL
+from .hydra import Hydra, HydraResponseException
+from .polling import THROTTLE_STATUS_CODES, PollScheduler, retry_after
+from .defaults import CACHE_DIR, GITLAB_API_URL
 
 from rich.tree import Tree
+import rich.live
 import rich.tree
 from rich.table import Table
 
@@ -162,17 +168,27 @@ def add_steps_to_tree(tree, client, build_id, steps, summarize_successful=True,
 
 
 
-def print_jobset_jobs(client, project, jobset_name, summary_buildsteps=True, always_report_steps=True, console=None, eol_status=True):
+async def print_jobset_jobs(client, project, jobset_name, summary_buildsteps=True, always_report_steps=True, console=None, eol_status=True):
     if console is None:
         console = rich.console.Console()
 
-    info = get_jobset_jobs(client=client, project=project, jobset_name=jobset_name)
-
+    info = await get_jobset_jobs(client=client, project=project, jobset_name=jobset_name)
     if not "evals" in info:
         print(f"No evals in {project}/{jobset_name}, job not picked up yet?")
         return
 
-    for eval in info["evals"]:
+    for tree_eval in jobset_trees(client, info, summary_buildsteps, always_report_steps, eol_status):
+        console.print(tree_eval)
+    console.print("", end='')
+
+
+def jobset_trees(client, info, summary_buildsteps=True, always_report_steps=True, eol_status=True, build_ids=None):
+    """
+        A tree for each evaluation in info, as get_jobset_jobs returns it. With build_ids, only the builds in it are
+        shown, and evaluations without any of them are left out.
+    """
+    trees = []
+    for eval in info.get("evals", []):
         t = format_time(time.time())
         tree_eval = Tree(f"Evaluation #{eval['id']} at {t}")
 
@@ -181,6 +197,8 @@ def print_jobset_jobs(client, project, jobset_name, summary_buildsteps=True, alw
         alignment_offset = start_of_line - indentation
 
         for build_id in eval["builds"]:
+            if build_ids is not None and build_id not in build_ids:
+                continue
             build_info = info["builds_retrieved"][build_id]
 
             # New way after build step info.
@@ -190,33 +208,70 @@ def print_jobset_jobs(client, project, jobset_name, summary_buildsteps=True, alw
             if always_report_steps or nice_state is False:
                 add_steps_to_tree(z, client, build_id=build_id, steps=build_info["steps"], summarize_successful=summary_buildsteps, indentation=" ")
 
+        if tree_eval.children:
+            trees.append(tree_eval)
+    return trees
+
+
+class JobsetState:
+    """
+        The evaluations of a jobset and the info of their builds, kept between the polls of the monitor. A refresh
+        requests the evaluations and only the builds that are new or weren't finished yet, the info of the others
+        stays as it was.
+    """
+
+    def __init__(self, project, jobset_name):
+        self.project = project
+        self.jobset_name = jobset_name
+        # The same dict as get_jobset_jobs returns.
+        self.info = {}
+
+    async def refresh(self, client):
+        """
+            Bring the state up to date, returns the set of ids of the builds whose info changed.
+        """
+        jobset_evals = await client.get_jobset_evals(project=self.project, jobset_name=self.jobset_name)
+        if not "evals" in jobset_evals:
+            self.info = {}
+            return set()
+        builds = self.info.get("builds_retrieved", {})
+        build_ids = [build_id for eval in jobset_evals["evals"] for build_id in eval["builds"]]
+        pending = [b for b in build_ids if b not in builds or not Hydra.is_immutable("build", builds[b])]
+        if HAVE_BUILDSTEP_ENDPOINT:
+            # This also retrieves any propagated build information to direct link logs from propagated builds.
+            fetched = await client.get_builds_info(pending)
+        else:
+            fetched = await client.get_builds(pending)
+            for build_info in fetched.values():
+                build_info["steps"] = []
+        changed = set(b for b, build_info in fetched.items() if builds.get(b) != build_info)
+        jobset_evals["builds_retrieved"] = {b: fetched[b] if b in fetched else builds[b] for b in build_ids}
+        self.info = jobset_evals
+        return changed
 
-        console.print(tree_eval)
-    console.print("", end='')
 
 """
-    Collect all information about the jobs in the jobsets.
+    Collect all information about the jobs in the jobsets, the builds of all evals are retrieved concurrently with the
+    AsyncHydra client.
 """
-def get_jobset_jobs(client, project, jobset_name):
-    jobset_evals = client.get_jobset_evals(project=project, jobset_name=jobset_name)
-    if not "evals" in jobset_evals:
-        return {}
-    for eval in jobset_evals["evals"]:
-        jobset_evals["builds_retrieved"] = {}
-        for build_id in eval["builds"]:
-            if HAVE_BUILDSTEP_ENDPOINT:
-                build_info = client.get_build_info(build_id)
-                # retrieve any propagated build information to direct link logs from propagated builds.
-                client.add_propagated_step_info(build_info)
-            else:
-                build_info = client.get_build(build_id)
-                build_info["steps"] = []
-            jobset_evals["builds_retrieved"][build_id] = build_info
-    return jobset_evals
+async def get_jobset_jobs(client, project, jobset_name):
+    state = JobsetState(project, jobset_name)
+    await state.refresh(client)
+    return state.info
+
+
+def run_async(client, fun, *args, **kwargs):
+    """
+        Run the coroutine function fun with an AsyncHydra for the server of client as its first argument.
+    """
+    async def run():
+        async with client.asynchronous() as async_client:
+            return await fun(async_client, *args, **kwargs)
+    return asyncio.run(run())
 
 
 def run_jobset_jobs(args, client):
-    print_jobset_jobs(client, project=args.project, jobset_name=args.jobset)
+    run_async(client, print_jobset_jobs, project=args.project, jobset_name=args.jobset)
 
 
 def run_jobset_cancel(args, client):
@@ -283,6 +338,10 @@ def add_json_report(args, add_report):
             json.dump(report, f, indent=1)
 
 def run_hydra_monitor(args, client, jobset_name_override=None):
+    run_async(client, monitor_jobset, args, jobset_name_override)
+
+
+async def monitor_jobset(client, args, jobset_name_override=None):
     jobset_name = jobset_name_override if jobset_name_override is not None else args.jobset_name
     jobset_url = client.format_url_jobset(project=args.project, jobset_name=jobset_name)
     print(jobset_url)
@@ -293,10 +352,17 @@ def run_hydra_monitor(args, client, jobset_name_override=None):
     # And for state tracking.
     old_state = (0, 0, 0)  # success, fail, scheduled
     old_report_time = now
+    jobset_state = JobsetState(args.project, jobset_name)
+    scheduler = PollScheduler(args.sleep_period, args.max_sleep_period, name=f"poll of {jobset_name}")
     console = rich.console.Console(color_system=None, width=200)
-
-    def exit_status_message(exit_code, message, job):
-        # Create our report and add it to the current reporting.
+    # On a terminal the jobset is shown in place and redrawn as it changes, in a log only the builds that changed are
+    # printed, with the whole jobset every report interval.
+    live = rich.live.Live(console=console, auto_refresh=False) if console.is_terminal else None
+
+    async def exit_status_message(exit_code, message, job):
+        if live is not None:
+            live.stop()
+        # Create our report and add it to the current reporting, the builds are as retrieved by the last refresh.
         our_report = {
             "jobset_name": jobset_name,
             "jobset_url": jobset_url,
@@ -305,7 +371,7 @@ def run_hydra_monitor(args, client, jobset_name_override=None):
             "duration": duration,
             "exit_code": exit_code,
             "message": message,
-            "hydra_jobset_jobs": get_jobset_jobs(client, project=args.project, jobset_name=jobset_name),
+            "hydra_jobset_jobs": jobset_state.info,
             "job": job,
         }
         add_json_report(args, our_report)
@@ -313,43 +379,80 @@ def run_hydra_monitor(args, client, jobset_name_override=None):
         print(message)
         sys.exit(exit_code)
 
-    job = {}
-    while duration < args.timeout:
-        now = time.time()
-        duration = now - start
-        took_string = f" (took {duration:.1f}s)"
-
-        # Get status of jobsets, check if our job still exists.
-        jobsets = client.get_jobsets_status(project=args.project)
-        jobsets_by_name = {job["name"]: job for job in jobsets}
-        if not jobset_name in jobsets_by_name:
-            exit_status_message(2, f"Job '{jobset_name}' disappeared{took_string}, reporting failure {jobset_url}", job)
-        else:
-            # The job exists, we can now determine the state.
-            job = jobsets_by_name[jobset_name]
-            job_state, job_emoji, text_status = Hydra.determine_job_status(job)
-
-            # If the build numbers changed, or we have should update according to the report interval.
-            current_state = (job["nrsucceeded"], job["nrfailed"], job["nrscheduled"])
-            if old_state != current_state or (now - old_report_time) > args.report_interval:
-                # Print the status of all jobs in the jobset.
-                print_jobset_jobs(client, project=args.project, jobset_name=jobset_name, console=console)
-                old_state = current_state
-                old_report_time = now
-
-            # Check if we reached a termination state.
-            if job_state is False:
-                exit_status_message(3, f"Job reports failure {job_emoji}{took_string}, reporting failure for {jobset_url}", job)
-            elif job_state is True:
-                exit_status_message(0, f"Job reports success 🎉{took_string} for {jobset_url}", job)
+    async def throttled(e):
+        # When hydra asks to slow down, back off and poll again later, other errors are fatal.
+        if e.status_code not in THROTTLE_STATUS_CODES:
+            raise e
+        scheduler.throttle(retry_after(e.response))
+        await asyncio.sleep(scheduler.next_interval())
+
+    if live is not None:
+        live.start()
+    try:
+        job = {}
+        while duration < args.timeout:
+            now = time.time()
+            duration = now - start
+            took_string = f" (took {duration:.1f}s)"
+
+            # Get status of jobsets, check if our job still exists.
+            try:
+                jobsets = await client.get_jobsets_status(project=args.project)
+            except HydraResponseException as e:
+                await throttled(e)
+                continue
+            jobsets_by_name = {job["name"]: job for job in jobsets}
+            if not jobset_name in jobsets_by_name:
+                await exit_status_message(2, f"Job '{jobset_name}' disappeared{took_string}, reporting failure {jobset_url}", job)
             else:
-                pass  # Job state is None means pending, loops around.
-        time.sleep(args.sleep_period)
-
-    # If we got here, we timed out... in that case, lets cancel the job, hope that works.
-    print(f"Job exceeded allowed runtime, cancelling and timing out with failure for {jobset_url}")
-    client.cancel_jobset(project=args.project, jobset_name=jobset_name)
-    exit_status_message(4, f"Job exceeded allowed runtime{took_string}, cancelled and timing out with failure for {jobset_url}", job)
+                # The job exists, we can now determine the state.
+                job = jobsets_by_name[jobset_name]
+                job_state, job_emoji, text_status = Hydra.determine_job_status(job)
+
+                # If the build numbers changed, or we have should update according to the report interval, and always
+                # once it is done so that the report has the final state of the builds.
+                current_state = (job["nrsucceeded"], job["nrfailed"], job["nrscheduled"])
+                report_due = (now - old_report_time) > args.report_interval
+                scheduler.update(old_state != current_state)
+                if old_state != current_state or report_due or job_state is not None:
+                    try:
+                        changed = await jobset_state.refresh(client)
+                    except HydraResponseException as e:
+                        # The old state is kept, so the next poll refreshes again.
+                        await throttled(e)
+                        continue
+                    if live is not None:
+                        live.update(rich.console.Group(*jobset_trees(client, jobset_state.info)), refresh=True)
+                    elif changed or report_due:
+                        for tree_eval in jobset_trees(client, jobset_state.info, build_ids=None if report_due else changed):
+                            console.print(tree_eval)
+                    old_state = current_state
+                    if report_due:
+                        old_report_time = now
+
+                # Check if we reached a termination state.
+                if job_state is False:
+                    await exit_status_message(3, f"Job reports failure {job_emoji}{took_string}, reporting failure for {jobset_url}", job)
+                elif job_state is True:
+                    await exit_status_message(0, f"Job reports success 🎉{took_string} for {jobset_url}", job)
+                else:
+                    pass  # Job state is None means pending, loops around.
+            await asyncio.sleep(scheduler.next_interval())
+
+        # If we got here, we timed out... in that case, lets cancel the job, hope that works.
+        print(f"Job exceeded allowed runtime, cancelling and timing out with failure for {jobset_url}")
+        await client.cancel_jobset(project=args.project, jobset_name=jobset_name)
+        # A throttled refresh is retried a few times, after that the report has the builds of the last refresh.
+        for _ in range(3):
+            try:
+                await jobset_state.refresh(client)
+                break
+            except HydraResponseException as e:
+                await throttled(e)
+        await exit_status_message(4, f"Job exceeded allowed runtime{took_string}, cancelled and timing out with failure for {jobset_url}", job)
+    finally:
+        if live is not None:
+            live.stop()
 
 
 def run_hydra_watcher(args, client):
@@ -360,13 +463,20 @@ def run_hydra_watcher(args, client):
 
     # The url where we can get the sub-pipeline statusses for the pipeline to be tracked.
     status_api = f"{GITLAB_API_URL}/projects/{args.gitlab_project}/pipelines/{args.gitlab_pipeline}/jobs"
+    gitlab = httpx.Client(headers={"Accept": "application/json"})
+    scheduler = PollScheduler(args.sleep_period, args.max_sleep_period, name=f"poll of {args.gitlab_job}")
+    old_status = None
 
     while duration < args.timeout:
         now = time.time()
         duration = now - start
 
         # Grab the current status.
-        resp = httpx.Client(headers={"Accept": "application/json"}).get(status_api)
+        resp = gitlab.get(status_api)
+        if resp.status_code in THROTTLE_STATUS_CODES:
+            scheduler.throttle(retry_after(resp))
+            time.sleep(scheduler.next_interval())
+            continue
         if resp.is_error:
             print(f"Pipeline url retrieval failed {resp}, exiting with 3")
             sys.exit(3)
@@ -409,7 +519,9 @@ def run_hydra_watcher(args, client):
             # Not a termination state, pass and keep watching.
             pass
 
-        time.sleep(args.sleep_period)
+        scheduler.update(status != old_status)
+        old_status = status
+        time.sleep(scheduler.next_interval())
 
     print(f"Timing out, exiting with 4.")
     sys.exit(4)
@@ -593,6 +705,26 @@ def add_json_report_arguments(argparser):
 def main():
     parser = argparse.ArgumentParser(description="Hydra command line utility")
     parser.add_argument("-n", "--dry-run", default=False, action="store_true", help="Dry run only.")
+    parser.add_argument("--verbose", action="store_true", help="Additional log output.")
+    parser.add_argument(
+        "--http2", default=False, action="store_true", help="Use HTTP/2 with hydra, requires the h2 module."
+    )
+    parser.add_argument(
+        "--max-connections", default=10, type=int,
+        help="Number of connections to hydra kept open at most [default: %(default)s]",
+    )
+    parser.add_argument(
+        "--cache-dir", default=CACHE_DIR / "hydra", type=Path,
+        help="Directory to keep finished builds and evals in [default: %(default)s]",
+    )
+    parser.add_argument(
+        "--cache-size", default=256, type=int, help="Size in MB the cache is limited to [default: %(default)s]"
+    )
+    parser.add_argument("--no-cache", action="store_true", help="Always retrieve builds and evals from hydra.")
+    parser.add_argument(
+        "--http-timeout", default=30.0, type=float,
+        help="Seconds to wait for connecting to hydra or for any data from it [default: %(default)s]",
+    )
     subparsers = parser.add_subparsers(dest="command")
 
     # Start of jobset subcommand.
@@ -655,7 +787,14 @@ def main():
         nargs="?",
         type=float,
         default=5.0,
-        help="Sleep period in the poll loop. [%(default)ss]",
+        help="Sleep period in the poll loop right after a change, it grows while nothing changes. [%(default)ss]",
+    )
+    jobset_hydra_monitor.add_argument(
+        "--max-sleep-period",
+        nargs="?",
+        type=float,
+        default=60.0,
+        help="Longest sleep period in the poll loop, unless the server asks to wait longer. [%(default)ss]",
     )
     add_json_report_arguments(jobset_hydra_monitor)
     jobset_hydra_monitor.set_defaults(func=run_hydra_monitor)
@@ -676,7 +815,14 @@ def main():
         nargs="?",
         type=float,
         default=5.0,
-        help="Sleep period in the poll loop. [%(default)ss]",
+        help="Sleep period in the poll loop right after a change, it grows while nothing changes. [%(default)ss]",
+    )
+    jobset_hydra_watcher.add_argument(
+        "--max-sleep-period",
+        nargs="?",
+        type=float,
+        default=60.0,
+        help="Longest sleep period in the poll loop, unless the server asks to wait longer. [%(default)ss]",
     )
     jobset_hydra_watcher.add_argument(
         "--timeout",
@@ -762,29 +908,32 @@ def main():
         parser.exit()
 
 
-    client = Hydra(HYDRA_URL, dry_run=args.dry_run)
-
-    # Check if we have to login, if so login or bail out.
-    requires_login = hasattr(args, "requires_login") and args.requires_login
-    if requires_login and not args.dry_run:
-        try:
-            hydra_username = os.environ["HYDRA_USERNAME"]
-            hydra_password = os.environ["HYDRA_PASSWORD"]
-            logger.info(f"Logging into {HYDRA_URL}")
-            client.login(hydra_username, hydra_password)
-        except KeyError:
-            logger.warn("Auth vars HYDRA_USERNAME and HYDRA_PASSWORD are not set, cannot login, please provide these.")
-            sys.exit(1)
-
     subparser_commands = {"jobset": jobset_parser, "build": build_parser, "maintenance": maintenance_subparser}
-
-    if args.command in subparser_commands:
+    if args.command in subparser_commands and args.sub_command is None:
         # This has a subparser, if there's no command, print a help.
         subparser = subparser_commands[args.command]
-        if args.sub_command is None:
-            subparser.print_help()
-            subparser.exit()
-        else:
-            args.func(args, client)
-    else:
+        subparser.print_help()
+        subparser.exit()
+
+    logging.getLogger("nix_generator").setLevel(logging.DEBUG if args.verbose else logging.INFO)
+
+    # The connections to hydra are pooled for the whole command, and closed when it is done.
+    cache = None if args.no_cache else DiskCache(args.cache_dir, max_size=args.cache_size * 1024 * 1024)
+    client = Hydra(
+        HYDRA_URL, dry_run=args.dry_run, http2=args.http2, max_connections=args.max_connections,
+        timeout=args.http_timeout, cache=cache,
+    )
+    with client:
+        # Check if we have to login, if so login or bail out.
+        requires_login = hasattr(args, "requires_login") and args.requires_login
+        if requires_login and not args.dry_run:
+            try:
+                hydra_username = os.environ["HYDRA_USERNAME"]
+                hydra_password = os.environ["HYDRA_PASSWORD"]
+                logger.info(f"Logging into {HYDRA_URL}")
+                client.login(hydra_username, hydra_password)
+            except KeyError:
+                logger.warn("Auth vars HYDRA_USERNAME and HYDRA_PASSWORD are not set, cannot login, please provide these.")
+                sys.exit(1)
+
         args.func(args, client)
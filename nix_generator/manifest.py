@@ -0,0 +1,121 @@
+import hashlib
+import json
+import logging
+
+from .sinks import DirectorySink, MemorySink
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = ".generate-manifest.json"
+
+
+class Manifest:
+    """
+        Tracks the content hash, size and mtime of every file generated below root. Files are only written if their
+        content changed since the previous generation, or if they were modified on disk since, and files that were
+        generated last time but not this time are removed by remove_stale.
+
+        The files go to the sink, a DirectorySink writing them below root unless another one is given.
+    """
+
+    def __init__(self, root, previous=None, sink=None):
+        self.root = root
+        self.previous = previous if previous is not None else {}
+        self.sink = sink if sink is not None else DirectorySink(root)
+        self.current = {}
+        self.written = 0
+
+    @classmethod
+    def load(cls, root, sink=None, tracked=False):
+        """
+            Returns a manifest with the entries of the previous generation saved below root. The manifest isn't
+            committed, so with tracked, a root without one takes the files under version control below it as the
+            previous generation, which are then all written again and removed if they are stale. Only meant for
+            roots that contain nothing but generated files.
+        """
+        if sink is None:
+            sink = DirectorySink(root)
+        data = sink.read(root / MANIFEST_NAME)
+        try:
+            previous = json.loads(data) if data is not None else {}
+        except ValueError:
+            logger.warning(f"Ignoring unreadable manifest in {root}, rewriting all files.")
+            previous = {}
+        if data is None and tracked:
+            # Entries without a hash or stat, so that none of them counts as unchanged.
+            previous = {relative_path: [None] for relative_path in sink.tracked(root)}
+        return cls(root, previous, sink)
+
+    def shard(self, worker=False):
+        """
+            Returns a manifest for writing a subset of the files, like in a worker process. Its entries are merged
+            back into this manifest with update. A shard for a worker process writes to a MemorySink if the sink
+            can't be written to from there, its files are then passed to update as well.
+        """
+        sink = self.sink
+        if worker and not sink.shared:
+            sink = MemorySink(self.root)
+        return Manifest(self.root, self.previous, sink)
+
+    def update(self, current, written, files=None):
+        for relative_path, data in (files or {}).items():
+            # The worker had no way to tell which files are unchanged in the sink, that's only known here.
+            path = self.root / relative_path
+            previous = self.previous.get(relative_path)
+            digest = current[relative_path][0]
+            if previous is not None and previous[0] == digest and self.sink.stat(path) == previous[1:]:
+                current[relative_path] = previous
+                written -= 1
+                self.sink.unchanged(path, data)
+            else:
+                current[relative_path] = [digest] + self.sink.write(path, data)
+        self.current.update(current)
+        self.written += written
+
+    def write_file(self, path, content):
+        """
+            Write content to path unless it is unchanged since the previous generation. Returns whether the file was
+            written.
+        """
+        relative_path = path.relative_to(self.root).as_posix()
+        data = content.encode()
+        digest = hashlib.sha256(data).hexdigest()
+
+        previous = self.previous.get(relative_path)
+        if previous is not None and previous[0] == digest and self.sink.stat(path) == previous[1:]:
+            self.current[relative_path] = previous
+            self.sink.unchanged(path, data)
+            return False
+
+        self.current[relative_path] = [digest] + self.sink.write(path, data)
+        self.written += 1
+        return True
+
+    def keep(self, path):
+        """
+            Carry the entry of path over from the previous generation without rendering its content again. Only
+            possible if the file is still as it was generated then, returns whether it was kept.
+        """
+        relative_path = path.relative_to(self.root).as_posix()
+        previous = self.previous.get(relative_path)
+        if previous is None or self.sink.stat(path) != previous[1:]:
+            return False
+        self.current[relative_path] = previous
+        self.sink.unchanged(path)
+        return True
+
+    def remove_stale(self):
+        """
+            Remove the files from the previous generation that were not generated this time, returns their count.
+        """
+        stale = sorted(set(self.previous) - set(self.current))
+        for relative_path in stale:
+            path = self.root / relative_path
+            if self.sink.remove(path, self.root):
+                logger.debug(f"Removed stale file {path}")
+        return len(stale)
+
+    def save(self):
+        data = json.dumps(self.current, sort_keys=True, separators=(",", ":")).encode()
+        self.sink.write(self.root / MANIFEST_NAME, data)
@@ -0,0 +1,118 @@
+import re
+import sys
+
+URL_REGEX = re.compile(
+    r"(?:\w+:\/\/|git@)(?P<server>[\w.-]+)[:/](?P<owner>[\w/_.-]*)/(?P<repo>[\w_.-]*)(?:\.git)?$"
+)
+FETCHERS = {
+    "github.com": "fetchFromGitHub",
+    "gitlab.com": "fetchFromGitLab",
+    "bitbucket.org": "fetchFromBitbucket",
+}
+
+
+def sanitize_store_name(name):
+    return name.replace("~", "-").replace("/", "-")
+
+
+def _intern_names(names):
+    return tuple(sys.intern(name) for name in names)
+
+
+class Package:
+    """
+        A package of a distro snapshot, with only the fields the generator uses. The package and dependency names
+        are interned, as the same few thousand names recur across all the dependency lists of a distro, and the
+        dependency lists are tuples.
+    """
+
+    __slots__ = ("name", "repo_name", "path", "narhash", "build", "run", "test", "binary")
+
+    def __init__(self, name, repo_name, path=None, narhash=None, build=(), run=(), test=(), binary=None):
+        self.name = sys.intern(name)
+        self.repo_name = sys.intern(repo_name)
+        self.path = path
+        self.narhash = narhash
+        self.build = _intern_names(build)
+        self.run = _intern_names(run)
+        self.test = _intern_names(test)
+        self.binary = binary
+
+    @classmethod
+    def from_dict(cls, repo_name, package_dict):
+        depends = package_dict["depends"]
+        metadata = package_dict["metadata"]
+        return cls(
+            name=package_dict["name"],
+            repo_name=repo_name,
+            path=package_dict.get("path"),
+            narhash=metadata.get("narhash"),
+            build=depends.get("build", ()),
+            run=depends.get("run", ()),
+            test=depends.get("test", ()),
+            binary=metadata.get("binary"),
+        )
+
+    def __eq__(self, other):
+        if not isinstance(other, Package):
+            return NotImplemented
+        return all(getattr(self, field) == getattr(other, field) for field in self.__slots__)
+
+    def __repr__(self):
+        return f"Package({self.name!r}, {self.repo_name!r})"
+
+
+class Repository:
+    """
+        A repository of a distro snapshot, with what its srcs file needs to fetch it and its packages, sorted by
+        name.
+    """
+
+    __slots__ = ("name", "fetcher", "owner", "repo", "rev", "hash", "packages")
+
+    def __init__(self, name, fetcher, owner, repo, rev, hash, packages=()):
+        self.name = sys.intern(name)
+        self.fetcher = fetcher
+        self.owner = owner
+        self.repo = repo
+        self.rev = rev
+        self.hash = hash
+        self.packages = tuple(packages)
+
+    @classmethod
+    def from_dict(cls, name, repo_dict, packages):
+        """
+            Build the repository from its snapshot dict and its Package objects. Raises KeyError if it lacks any of
+            the fields needed to fetch it, or is on a host there's no fetcher for.
+        """
+        git_parts = URL_REGEX.match(repo_dict["url"])
+        for package in packages:
+            if package.path is None or package.narhash is None:
+                raise KeyError(f"path or narhash of {package.name}")
+        return cls(
+            name=name,
+            fetcher=FETCHERS[git_parts.group("server")],
+            owner=git_parts.group("owner"),
+            repo=git_parts.group("repo").split(".git")[0],
+            rev=repo_dict["version"],
+            hash=repo_dict["metadata"]["narhash"],
+            packages=sorted(packages, key=lambda p: p.name),
+        )
+
+    @property
+    def store_name(self):
+        return f"{sanitize_store_name(self.owner)}-{sanitize_store_name(self.repo)}-{sanitize_store_name(self.rev)}"
+
+    def template_variables(self):
+        return {
+            "name": self.name,
+            "fetcher": self.fetcher,
+            "owner": self.owner,
+            "repo": self.repo,
+            "rev": self.rev,
+            "hash": self.hash,
+            "safe_owner": sanitize_store_name(self.owner),
+            "safe_repo": sanitize_store_name(self.repo),
+            "safe_rev": sanitize_store_name(self.rev),
+            "packages": self.packages,
+        }
@@ -0,0 +1,79 @@
+from email.utils import parsedate_to_datetime
+import logging
+import math
+import random
+import time
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+
+# Responses that ask the client to come back later, possibly with a Retry-After header saying when.
+THROTTLE_STATUS_CODES = (429, 503)
+
+
+def retry_after(resp):
+    """
+        The seconds to wait before the next request according to the Retry-After header of resp, which is either a
+        number of seconds or a http date. None if it has no such header, or one that can't be parsed.
+    """
+    value = resp.headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        pass
+    else:
+        # float also parses nan and inf, which no server means.
+        return max(0.0, seconds) if math.isfinite(seconds) else None
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class PollScheduler:
+    """
+        Picks the interval between the polls of something that changes in bursts. After a poll that saw a change the
+        next one follows after min_interval, each poll without a change multiplies the interval by factor up to
+        max_interval. A throttled poll backs off the same way, and waits at least as long as the server asked for,
+        up to max_retry_after_factor times max_interval. The intervals are spread by up to jitter times their length
+        either way, so that many pollers started at the same time don't keep hitting the server together.
+    """
+
+    # The longest wait a server can ask for, as a multiple of max_interval.
+    max_retry_after_factor = 10
+
+    def __init__(self, min_interval, max_interval, factor=2.0, jitter=0.2, name="poll", random=random.random):
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.factor = factor
+        self.jitter = jitter
+        self.name = name
+        self.random = random
+        self.interval = min_interval
+        self.reason = "first poll"
+        self._floor = 0.0
+
+    def update(self, changed):
+        if changed:
+            self.interval = self.min_interval
+            self.reason = "changed"
+        else:
+            self.interval = min(self.interval * self.factor, self.max_interval)
+            self.reason = "no change"
+
+    def throttle(self, retry_after=None):
+        self.interval = min(self.interval * self.factor, self.max_interval)
+        self._floor = min(retry_after or 0.0, self.max_interval * self.max_retry_after_factor)
+        self.reason = "throttled" if retry_after is None else f"throttled, retry after {retry_after:.1f}s"
+
+    def next_interval(self):
+        """
+            The seconds to wait until the next poll, logged along with why.
+        """
+        interval = self.interval * (1 + self.jitter * (2 * self.random() - 1))
+        interval = max(interval, self._floor)
+        self._floor = 0.0
+        logger.info(f"Next {self.name} in {interval:.1f}s ({self.reason}).")
+        return interval
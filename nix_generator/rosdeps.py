@@ -1,29 +1,118 @@
 import asyncio
+from collections import namedtuple
 import httpx
 import itertools
+import json
 import logging
 import yaml
 
+from . import trace
+
 logging.basicConfig()
 logger = logging.getLogger(__name__)
 
+# The libyaml based loader is many times quicker on files the size of base.yaml, if PyYAML was built with it.
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
 
-async def _fetch_rosdep_urls(urls):
-    async with httpx.AsyncClient() as client:
 
-        async def _fetch(url):
+async def fetch_rosdeps_async(urls, client):
+    loop = asyncio.get_running_loop()
+
+    async def _fetch(url):
+        with trace.span("http", method="GET", url=url) as span:
             result = await client.get(url, timeout=10.0, follow_redirects=True)
-            data = yaml.safe_load(result.text)
-            pairs = []
-            for name, os_packages in data.items():
-                if "nixos" in os_packages:
-                    pairs.append((name, os_packages["nixos"]))
-            logger.info(f"Loaded rosdep mappings: {url}")
-            return pairs
+            span.set(status_code=result.status_code, bytes=len(result.content))
+        # Parse off the event loop, so that other transfers on the client aren't stalled meanwhile.
+        data = await loop.run_in_executor(None, yaml.load, result.content, YAML_LOADER)
+        pairs = []
+        for name, os_packages in data.items():
+            if "nixos" in os_packages:
+                pairs.append((name, os_packages["nixos"]))
+        logger.info(f"Loaded rosdep mappings: {url}")
+        return pairs
+
+    pairs = await asyncio.gather(*[_fetch(u) for u in urls])
+    return dict(itertools.chain(*pairs))
+
+
+async def fetch_rosdep_index(urls, client, commit=None, cache=None):
+    """
+        Like fetch_rosdeps_async, but if the rosdistro commit the urls point to is given, the mapping is stored in
+        the DiskCache keyed by it. The rosdep files are then only fetched and parsed again once that commit changes.
+    """
+    if commit is None or cache is None:
+        return await fetch_rosdeps_async(urls, client)
+
+    cache_key = f"rosdep-index/{commit}/{' '.join(urls)}"
+    cached = cache.get(cache_key)
+    if cached is not None:
+        try:
+            rosdep_mapping = json.loads(cached.data)
+            logger.info(f"Using cached rosdep mappings of rosdistro {commit}.")
+            return rosdep_mapping
+        except ValueError:
+            logger.warning(f"Ignoring unreadable cached rosdep mappings of rosdistro {commit}.")
+
+    rosdep_mapping = await fetch_rosdeps_async(urls, client)
+    data = json.dumps(rosdep_mapping, separators=(",", ":")).encode()
+    cache.put(cache_key, data, {"commit": commit, "keys": len(rosdep_mapping)})
+    return rosdep_mapping
+
 
-        pairs = await asyncio.gather(*[_fetch(u) for u in urls])
-        return dict(itertools.chain(*pairs))
+async def _fetch_rosdep_urls(urls):
+    async with httpx.AsyncClient() as client:
+        return await fetch_rosdeps_async(urls, client)
 
 
 def fetch_rosdeps(urls):
     return asyncio.run(_fetch_rosdep_urls(urls))
+
+
+# The nix attributes a rosdep key maps to, and the input attribute roots those need, like python3Packages.
+Resolution = namedtuple("Resolution", ("attrs", "inputs"))
+
+
+class RosdepResolver:
+    """
+        Resolves rosdep keys to nix attributes. The mapping is indexed once, and every lookup is memoized, so that
+        resolving the same key again for another package or another distro is a single dictionary lookup.
+    """
+
+    def __init__(self, rosdep_mapping):
+        self.index = {
+            name: Resolution(tuple(attrs), frozenset(attr.split(".")[0] for attr in attrs))
+            for name, attrs in rosdep_mapping.items()
+            # A key mapped to null, like `nixos: null`, is left unresolved rather than resolved to nothing.
+            if attrs is not None
+        }
+        self.resolved = {}
+        self.hits = 0
+        self.misses = 0
+
+    def resolve(self, dep_name):
+        """
+            Returns the Resolution for dep_name, or None if it can't be resolved.
+        """
+        try:
+            resolution = self.resolved[dep_name]
+            self.hits += 1
+            return resolution
+        except KeyError:
+            self.misses += 1
+
+        # Many internal packages have not been updated for python3-xx rosdep keys, so
+        # we provide a shim for that here. Explicit is not None check is needed here
+        # because an empty resolution is still a resolution.
+        resolution = self.index.get(dep_name.replace("python-", "python3-", 1))
+        if resolution is None:
+            resolution = self.index.get(dep_name)
+        self.resolved[dep_name] = resolution
+        return resolution
+
+    def stats(self):
+        return {
+            "keys": len(self.index),
+            "hits": self.hits,
+            "misses": self.misses,
+            "unresolved": sum(1 for r in self.resolved.values() if r is None),
+        }
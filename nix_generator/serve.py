@@ -0,0 +1,392 @@
+"""
+    The generator daemon, run as 'generate serve'. It polls for new snapshot tags and generates each one as it
+    appears, keeping the rosdep resolver and the repository fingerprints of the previous generation in memory, so a
+    new tag only costs the download of its snapshots and the files that changed. Metrics are served over http.
+"""
+import argparse
+import asyncio
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import os
+from pathlib import Path
+import subprocess
+import threading
+import time
+
+import httpx
+
+from . import cli, trace
+from .cache import DiskCache
+from .defaults import *
+from .hydra import Hydra, HydraException
+from .writer import Writer
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+
+
+class TagPoller:
+    """
+        Finds the latest snapshot tag with an incremental fetch into a bare repository at path, rather than listing
+        every tag of the snapshots repository with ls-remote. Once a tag is known, only the tags of its year and
+        those since are requested, which the server filters by prefix, so the check stays small however many tags
+        accumulate. Only the tag and commit objects are fetched where the server supports filtering.
+    """
+
+    def __init__(self, url, path, prefix=SNAPSHOT_TAG_PREFIX):
+        self.url = url
+        self.path = Path(path)
+        self.prefix = prefix
+
+    def _git(self, *args):
+        return cli.retrying_check_output(["git", *args], cwd=self.path, universal_newlines=True)
+
+    def _init(self):
+        if (self.path / "HEAD").exists():
+            return
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._git("init", "--bare", "-q")
+        self._git("remote", "add", "origin", self.url)
+        self._git("config", "remote.origin.promisor", "true")
+        self._git("config", "remote.origin.partialclonefilter", "tree:0")
+
+    def latest(self):
+        """
+            The latest tag fetched so far, or None.
+        """
+        refs = self._git("for-each-ref", "--sort=refname", "--format=%(refname)", self.prefix).split()
+        return refs[-1] if refs else None
+
+    def poll(self):
+        """
+            Fetch the tags that may have been added since the last poll, returns the latest tag.
+        """
+        self._init()
+        latest = self.latest()
+        year = latest[len(self.prefix):][:4] if latest else ""
+        if year.isdigit():
+            prefixes = [f"{self.prefix}{y}" for y in range(int(year), time.gmtime().tm_year + 1)]
+        else:
+            prefixes = [self.prefix]
+        refspecs = [f"+{prefix}*:{prefix}*" for prefix in prefixes]
+        self._git("-c", "protocol.version=2", "fetch", "-q", "--no-tags", "origin", *refspecs)
+        return self.latest()
+
+
+class Metrics:
+    """
+        Counters and gauges of the daemon, rendered in the Prometheus text format.
+    """
+
+    PREFIX = "nix_generator_"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.values = {
+            "polls_total": 0,
+            "poll_failures_total": 0,
+            "poll_duration_seconds": 0.0,
+            "generations_total": 0,
+            "generation_failures_total": 0,
+            "generation_duration_seconds": 0.0,
+            "tag_latency_seconds": 0.0,
+            "last_success_timestamp_seconds": 0.0,
+            "generation_started_timestamp_seconds": 0.0,
+        }
+        self.state = "starting"
+        self.ref = None
+        self.tag = None
+
+    def set(self, **values):
+        with self._lock:
+            self.values.update(values)
+
+    def increment(self, name):
+        with self._lock:
+            self.values[name] += 1
+
+    def set_state(self, state):
+        with self._lock:
+            self.state = state
+
+    def status(self):
+        with self._lock:
+            return {"state": self.state, "ref": self.ref, "tag": self.tag, **self.values}
+
+    def render(self):
+        with self._lock:
+            lines = [f"{self.PREFIX}{name} {value}" for name, value in sorted(self.values.items())]
+            lines.append(f'{self.PREFIX}state{{state="{self.state}"}} 1')
+            if self.ref is not None:
+                lines.append(f'{self.PREFIX}generated_info{{ref="{self.ref}",tag="{self.tag}"}} 1')
+        return "\n".join(lines) + "\n"
+
+
+def serve_metrics(metrics, address, port):
+    """
+        Serve /metrics in the Prometheus text format and /status as json from a background thread, returns the
+        server.
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == "/metrics":
+                body, content_type = metrics.render().encode(), "text/plain; version=0.0.4"
+            elif self.path == "/status":
+                body, content_type = json.dumps(metrics.status()).encode(), "application/json"
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug(f"{self.address_string()} {format % args}")
+
+    server = ThreadingHTTPServer((address, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f"Serving metrics on http://{address}:{server.server_port}/metrics")
+    return server
+
+
+class GeneratorService:
+    """
+        Generates every new snapshot tag found by the TagPoller into output_path. The rosdep resolver is kept
+        until the rosdistro commit of the rosdep branch moves, and the fingerprints of the previous generation make
+        each following one incremental as long as the resolver stays the same.
+    """
+
+    def __init__(self, args, nix_base_url, poller, metrics, cache=None, transport=None, hydra=None):
+        self.args = args
+        self.nix_base_url = nix_base_url
+        self.poller = poller
+        self.metrics = metrics
+        self.cache = cache
+        self.transport = transport
+        self.hydra = hydra
+        self.output_path = Path(args.output) if args.output else Path.cwd() / "build"
+        self.jobs = args.jobs if args.jobs > 0 else os.cpu_count()
+        self.ref = None
+        self.fingerprints = {}
+        self.rosdep_commit = None
+        self.resolver = None
+
+    def update_resolver(self):
+        rosdep_urls, rosdep_commit = cli.get_rosdep_urls(self.args.rosdep_branch)
+        if self.resolver is not None and rosdep_commit is not None and rosdep_commit == self.rosdep_commit:
+            return
+
+        async def load():
+            async with httpx.AsyncClient(transport=self.transport) as client:
+                return await cli.load_rosdep_resolver(rosdep_urls, client, rosdep_commit, self.cache)
+
+        self.resolver = asyncio.run(load())
+        self.rosdep_commit = rosdep_commit
+        # The fingerprints don't cover the rosdep mapping, so packages must be resolved again with the new one.
+        self.fingerprints.clear()
+
+    def seed_ref(self):
+        """
+            Take the snapshot of the latest tag pushed to the origin of the output as generated, so that a restarted
+            daemon doesn't generate it again and push it under the next unused tag.
+        """
+        cmd = ["git", "ls-remote", "--tags", "--refs", "origin"]
+        try:
+            remote_tags = cli.retrying_check_output(cmd, universal_newlines=True, cwd=self.output_path)
+        except (OSError, subprocess.CalledProcessError):
+            logger.warning(f"Unable to list the tags of the origin of {self.output_path}.")
+            return
+        published = []
+        for line in remote_tags.splitlines():
+            version, _, suffix = line.split("refs/tags/")[-1].rpartition("-")
+            if version and suffix.isdigit():
+                published.append((version, int(suffix)))
+        if not published:
+            return
+        version, suffix = max(published)
+        self.ref = f"{SNAPSHOT_TAG_PREFIX}{version}"
+        self.metrics.ref, self.metrics.tag = self.ref, f"{version}-{suffix}"
+        logger.info(f"Latest published tag is {version}-{suffix}, waiting for a snapshot newer than {self.ref}.")
+
+    def unchanged_since(self, tag):
+        """
+            Whether the output, as it would be committed, has the same tree as tag on its origin.
+        """
+        refspec = f"refs/tags/{tag}:refs/tags/{tag}"
+        cli.retrying_check_call(["git", "fetch", "-q", "--no-tags", "origin", refspec], cwd=self.output_path)
+        cli.traced_check_call(["git", "add", "-A"], cwd=self.output_path)
+        return subprocess.run(["git", "diff", "--cached", "--quiet", tag], cwd=self.output_path).returncode == 0
+
+    def poll(self):
+        """
+            Returns the latest snapshot tag if it hasn't been generated yet, otherwise None.
+        """
+        self.metrics.set_state("polling")
+        start = time.monotonic()
+        try:
+            ref = self.poller.poll()
+        except subprocess.CalledProcessError:
+            self.metrics.increment("poll_failures_total")
+            logger.exception("Polling for snapshot tags failed.")
+            return None
+        finally:
+            self.metrics.increment("polls_total")
+            self.metrics.set(poll_duration_seconds=time.monotonic() - start)
+            self.metrics.set_state("idle")
+        return ref if ref is not None and ref != self.ref else None
+
+    def generate(self, ref):
+        args = self.args
+        self.metrics.set_state("generating")
+        start = time.monotonic()
+        self.metrics.set(generation_started_timestamp_seconds=time.time())
+        version = ref.split("/")[-1]
+        tag = cli.find_unused_tag(self.output_path, version) if args.push_tag else f"{version}-dev"
+        if tag is None:
+            raise RuntimeError(f"Unable to find unused tag for version {version}.")
+        logger.info(f"Generating {ref} as {tag}.")
+
+        self.output_path.mkdir(parents=True, exist_ok=True)
+        Writer.write_base_files(self.output_path, self.nix_base_url, DISTRO_NAMES, flake_tag=tag, rosdistro_ref=ref)
+        self.update_resolver()
+        changes = asyncio.run(cli.generate_distros(
+            self.output_path, ref, None, self.jobs, self.cache, self.transport, output_format=args.format,
+            rosdep_resolver=self.resolver, base_fingerprints=self.fingerprints,
+        ))
+        changed = sum(len(c["packages"]["added"]) + len(c["packages"]["changed"]) for c in changes.values())
+        logger.info(f"Generated {ref}, {changed} packages added or changed.")
+
+        if args.push_tag:
+            self.metrics.set_state("publishing")
+            with trace.span("flake_update"):
+                cli.traced_check_call(["nix", "flake", "update"], cwd=self.output_path)
+            version, _, suffix = tag.rpartition("-")
+            previous = f"{version}-{int(suffix) - 1}" if int(suffix) > 0 else None
+            if previous is not None and self.unchanged_since(previous):
+                logger.info(f"The output is the same as {previous}, not pushing {tag}.")
+                tag = previous
+            else:
+                cli.commit_and_push(self.output_path, tag)
+                if self.hydra is not None:
+                    logger.info(f"Creating and evaluating jobset {args.hydra_project}:v{tag}")
+                    self.hydra.push_jobset_tag(args.hydra_project, tag)
+
+        self.ref = ref
+        duration = time.monotonic() - start
+        self.metrics.ref, self.metrics.tag = ref, tag
+        self.metrics.set(generation_duration_seconds=duration, last_success_timestamp_seconds=time.time())
+
+    def run_once(self):
+        """
+            Poll once and generate the new tag if there is one. Returns whether a tag was generated.
+        """
+        detected = time.monotonic()
+        ref = self.poll()
+        if ref is None:
+            return False
+        try:
+            self.generate(ref)
+        except (Exception, HydraException):
+            self.metrics.increment("generation_failures_total")
+            logger.exception(f"Generating {ref} failed, retrying on the next poll.")
+            # The output may have been partially written, so the next generation can't be incremental.
+            self.fingerprints.clear()
+            return False
+        finally:
+            self.metrics.increment("generations_total")
+            self.metrics.set_state("idle")
+        self.metrics.set(tag_latency_seconds=time.monotonic() - detected)
+        return True
+
+    def serve_forever(self, interval):
+        while True:
+            self.run_once()
+            time.sleep(interval)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="generate serve", description=__doc__)
+    parser.add_argument("-o", "--output", default=None, help="Output path, defaults to cwd/build.")
+    parser.add_argument("-n", "--nix-base", default=None, help="Flake URL for nix base repo, defaults to cwd.")
+    parser.add_argument("--nix-base-remote", action="store_true", help="Use remote URL for nix-base.")
+    parser.add_argument(
+        "-t", "--push-tag", action="store_true", help="Run flake update, tag, and git push each generation."
+    )
+    parser.add_argument(
+        "--create-hydra-job", action="store_true",
+        help="Create a hydra job for each tag, requires --push-tag, HYDRA_USERNAME and HYDRA_PASSWORD to be set."
+    )
+    parser.add_argument("--hydra-project", default="ros", help="Project on hydra to put the jobsets under.")
+    parser.add_argument(
+        "--rosdep-branch", default="master",
+        help="The branch in rosdistro to retrieve the rosdep entries from [defaults to %(default)s]."
+    )
+    parser.add_argument(
+        "--format", default="nix", choices=["nix", "json-index"],
+        help="Write a nix file per repository and package, or a single json index per distro [defaults to %(default)s]."
+    )
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=1,
+        help="Number of worker processes used to write package files, 0 uses all cores [defaults to %(default)s]."
+    )
+    parser.add_argument(
+        "--interval", type=float, default=300, help="Seconds between polls for new tags [defaults to %(default)s]."
+    )
+    parser.add_argument(
+        "--metrics-address", default="127.0.0.1", help="Address to serve metrics on [defaults to %(default)s]."
+    )
+    parser.add_argument(
+        "--metrics-port", type=int, default=9464,
+        help="Port to serve metrics on, 0 disables them [defaults to %(default)s]."
+    )
+    parser.add_argument(
+        "--cache-dir", default=CACHE_DIR, type=Path,
+        help="Directory for the snapshot and rosdep caches and the tags mirror [defaults to %(default)s]."
+    )
+    parser.add_argument(
+        "--cache-size", default=2048, type=int,
+        help="Size in MB the cache directory is limited to [defaults to %(default)s]."
+    )
+    parser.add_argument("--verbose", action="store_true", help="Additional log output.")
+    args = parser.parse_args(argv)
+
+    logging.getLogger("nix_generator").setLevel(logging.DEBUG if args.verbose else logging.INFO)
+
+    hydra = None
+    if args.create_hydra_job:
+        if not args.push_tag:
+            logger.error("--create-hydra-job requires --push-tag.")
+            return 1
+        hydra = Hydra(HYDRA_URL)
+        if not cli.hydra_login(hydra):
+            return 1
+
+    nix_base_url = cli.get_nix_base_url(args)
+    if nix_base_url is None:
+        return 1
+    if args.push_tag and str(nix_base_url).startswith("/"):
+        logger.error("Unwilling to create and push tag with nix-base on a local path.")
+        return 1
+
+    cache = DiskCache(args.cache_dir, max_size=args.cache_size * 1024 * 1024)
+    poller = TagPoller(DISTRO_SNAPSHOTS_URL, args.cache_dir / "snapshot-tags.git")
+    metrics = Metrics()
+    service = GeneratorService(args, nix_base_url, poller, metrics, cache, hydra=hydra)
+    if args.push_tag:
+        service.seed_ref()
+
+    if args.metrics_port:
+        serve_metrics(metrics, args.metrics_address, args.metrics_port)
+    metrics.set_state("idle")
+    try:
+        service.serve_forever(args.interval)
+    except KeyboardInterrupt:
+        logger.info("Stopping.")
+    finally:
+        if hydra is not None:
+            hydra.close()
+    return 0
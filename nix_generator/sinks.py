@@ -0,0 +1,347 @@
+import hashlib
+import io
+import logging
+import os
+import subprocess
+import tarfile
+import time
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+
+# Compression of the archive written by TarSink, keyed by file name suffix.
+ARCHIVE_SUFFIXES = {
+    ".tar": None,
+    ".tar.gz": "gz",
+    ".tgz": "gz",
+    ".tar.xz": "xz",
+    ".tar.bz2": "bz2",
+    ".tar.zst": "zst",
+}
+
+
+class SinkError(Exception):
+    pass
+
+
+class DirectorySink:
+    """
+        Writes the generated files to the filesystem below root. The other sinks follow the same interface; paths
+        passed to them are always below their root, and stat returns a [size, mtime_ns] list like the manifest
+        entries, or None for files that don't exist.
+    """
+
+    # Whether worker processes can write to the sink themselves, otherwise they pass the files back to the parent.
+    shared = True
+
+    def __init__(self, root):
+        self.root = root
+
+    def stat(self, path):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return [st.st_size, st.st_mtime_ns]
+
+    def read(self, path):
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def write(self, path, data):
+        path.parent.mkdir(exist_ok=True, parents=True)
+        with open(path, "wb") as output:
+            output.write(data)
+        return self.stat(path)
+
+    def unchanged(self, path, data=None):
+        """
+            Called for files the manifest finds unchanged since the previous generation, which aren't written again.
+            data is their content, if it was rendered.
+        """
+        pass
+
+    def tracked(self, root):
+        """
+            The posix paths relative to root of the files below it that are under version control, empty if it isn't
+            in a git repository.
+        """
+        try:
+            output = subprocess.check_output(["git", "ls-files", "-z"], cwd=root, stderr=subprocess.DEVNULL)
+        except (OSError, subprocess.CalledProcessError):
+            return []
+        return [path for path in output.decode().split("\0") if path]
+
+    def remove(self, path, stop):
+        """
+            Remove the file at path, and the directories below stop that became empty with it. Returns whether the
+            file existed.
+        """
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            return False
+        # Clean up directories that became empty, like those of repos with a slash in their name.
+        parent = path.parent
+        while parent != stop and not any(parent.iterdir()):
+            parent.rmdir()
+            parent = parent.parent
+        return True
+
+    def close(self):
+        pass
+
+
+class MemorySink:
+    """
+        Keeps the generated files in the files dict, as bytes keyed by their posix path relative to root. Meant for
+        tests and golden comparisons, and used to collect what the worker processes render for sinks they can't
+        write to themselves.
+    """
+
+    shared = False
+
+    def __init__(self, root):
+        self.root = root
+        self.files = {}
+
+    def key(self, path):
+        return path.relative_to(self.root).as_posix()
+
+    def stat(self, path):
+        data = self.files.get(self.key(path))
+        if data is None:
+            return None
+        return [len(data), 0]
+
+    def read(self, path):
+        return self.files.get(self.key(path))
+
+    def write(self, path, data):
+        self.files[self.key(path)] = data
+        return [len(data), 0]
+
+    def unchanged(self, path, data=None):
+        pass
+
+    def tracked(self, root):
+        return []
+
+    def remove(self, path, stop):
+        return self.files.pop(self.key(path), None) is not None
+
+    def close(self):
+        pass
+
+
+class TarSink:
+    """
+        Streams the generated files into a tar archive written to fileobj, compressed with gz, xz, bz2 or, if the
+        zstandard module is installed, zst. Nothing is buffered beyond the current file and nothing is read back,
+        so every file is written out. The manifest is stored in the archive as well, with the mtime the files get
+        when the archive is extracted, so that a later generation into the extracted tree is incremental again.
+    """
+
+    shared = False
+
+    def __init__(self, root, fileobj, compression=None, mtime=None):
+        self.root = root
+        self.mtime = int(time.time()) if mtime is None else int(mtime)
+        self._compressor = None
+        if compression == "zst":
+            try:
+                import zstandard
+            except ImportError:
+                raise SinkError("Writing zstd compressed archives requires the zstandard module of the zstd extra.")
+            self._compressor = zstandard.ZstdCompressor().stream_writer(fileobj, closefd=False)
+            fileobj, compression = self._compressor, None
+        self._tar = tarfile.open(fileobj=fileobj, mode=f"w|{compression or ''}", format=tarfile.PAX_FORMAT)
+        self.count = 0
+
+    @classmethod
+    def open(cls, root, archive_path, mtime=None):
+        """
+            Returns a TarSink writing to archive_path, compressed according to its suffix.
+        """
+        name = archive_path.name
+        for suffix, compression in ARCHIVE_SUFFIXES.items():
+            if name.endswith(suffix):
+                break
+        else:
+            raise SinkError(f"Unknown archive type of {archive_path}, expected one of {', '.join(ARCHIVE_SUFFIXES)}.")
+        fileobj = open(archive_path, "wb")
+        try:
+            sink = cls(root, fileobj, compression, mtime)
+        except BaseException:
+            fileobj.close()
+            raise
+        sink._fileobj = fileobj
+        return sink
+
+    def stat(self, path):
+        return None
+
+    def read(self, path):
+        return None
+
+    def write(self, path, data):
+        info = tarfile.TarInfo(path.relative_to(self.root).as_posix())
+        info.size = len(data)
+        info.mtime = self.mtime
+        info.mode = 0o644
+        self._tar.addfile(info, io.BytesIO(data))
+        self.count += 1
+        return [len(data), self.mtime * 1_000_000_000]
+
+    def unchanged(self, path, data=None):
+        pass
+
+    def tracked(self, root):
+        return []
+
+    def remove(self, path, stop):
+        return False
+
+    def close(self):
+        """
+            Finish the archive. The fileobj passed in is left open, only one opened by TarSink.open is closed.
+        """
+        self._tar.close()
+        if self._compressor is not None:
+            self._compressor.close()
+        fileobj = getattr(self, "_fileobj", None)
+        if fileobj is not None:
+            fileobj.close()
+        logger.info(f"Wrote {self.count} files to the archive.")
+
+
+class GitSink(DirectorySink):
+    """
+        Writes the files below root like DirectorySink, and streams them into a commit of the git repository root is
+        in with git fast-import at the same time, so that committing doesn't need git add to hash the whole tree.
+        Only the files whose blob differs from the parent commit end up in the stream, every other path keeps the
+        blob it has there. That is decided for the files the manifest finds unchanged as well, as those may not have
+        been committed by whatever generated them before. Files with a name in untracked are only written to disk.
+
+        The commit is made by commit, which moves HEAD to it and updates the index entries of the changed paths.
+    """
+
+    # Workers get a copy of the fast-import pipe and of the changes, so they pass their files back to the parent.
+    shared = False
+
+    def __init__(self, root, untracked=()):
+        super().__init__(root)
+        self.untracked = set(untracked)
+        self.prefix = self._git("rev-parse", "--show-prefix").strip()
+        try:
+            self.parent = self._git("rev-parse", "--verify", "-q", "HEAD").strip()
+        except subprocess.CalledProcessError:
+            # A repository without any commits yet.
+            self.parent = None
+        self.tree = self._read_tree(self.parent) if self.parent else {}
+        # Changed paths and their blob, None for removed paths.
+        self.changes = {}
+        self.blobs = {}
+        self._process = subprocess.Popen(
+            ["git", "fast-import", "--quiet"], cwd=self.root, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL
+        )
+
+    def _git(self, *args, **kwargs):
+        return subprocess.check_output(["git", *args], cwd=self.root, stderr=subprocess.DEVNULL, **kwargs).decode()
+
+    def _read_tree(self, commit):
+        tree = {}
+        for entry in self._git("ls-tree", "-r", "-z", "--full-tree", commit).split("\0"):
+            if not entry:
+                continue
+            info, path = entry.split("\t", 1)
+            mode, object_type, object_id = info.split()
+            if object_type == "blob":
+                tree[path] = (mode, object_id)
+        return tree
+
+    def _git_path(self, path):
+        return self.prefix + path.relative_to(self.root).as_posix()
+
+    def write(self, path, data):
+        stat = super().write(path, data)
+        if path.name not in self.untracked:
+            self._add_blob(self._git_path(path), data)
+        return stat
+
+    def unchanged(self, path, data=None):
+        if path.name in self.untracked:
+            return
+        if data is None:
+            with open(path, "rb") as f:
+                data = f.read()
+        self._add_blob(self._git_path(path), data)
+
+    def add(self, path):
+        """
+            Include a file written to disk by something else, like the flake lock, in the commit.
+        """
+        with open(path, "rb") as f:
+            self._add_blob(self._git_path(path), f.read())
+
+    def _add_blob(self, git_path, data):
+        blob_id = hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
+        if self.tree.get(git_path) == ("100644", blob_id):
+            self.changes.pop(git_path, None)
+            return
+        if blob_id not in self.blobs:
+            self.blobs[blob_id] = len(self.blobs) + 1
+            self._process.stdin.write(b"blob\nmark :%d\ndata %d\n" % (self.blobs[blob_id], len(data)) + data + b"\n")
+        self.changes[git_path] = blob_id
+
+    def remove(self, path, stop):
+        removed = super().remove(path, stop)
+        git_path = self._git_path(path)
+        if git_path in self.tree:
+            self.changes[git_path] = None
+        else:
+            self.changes.pop(git_path, None)
+        return removed
+
+    def commit(self, message):
+        """
+            Commit the changes on top of HEAD and move HEAD to the new commit, returns its id.
+        """
+        ref = "refs/generate/commit"
+        ident = self._git("var", "GIT_COMMITTER_IDENT").strip()
+        message = message.encode()
+        lines = [b"commit " + ref.encode(), b"committer " + ident.encode(), b"data %d" % len(message), message]
+        if self.parent:
+            lines.append(b"from " + self.parent.encode())
+        for git_path, blob_id in sorted(self.changes.items()):
+            if blob_id is None:
+                lines.append(b"D " + git_path.encode())
+            else:
+                lines.append(b"M 100644 :%d " % self.blobs[blob_id] + git_path.encode())
+        self._process.stdin.write(b"\n".join(lines) + b"\n\n")
+        self.close()
+        if self._process.returncode:
+            raise SinkError(f"git fast-import failed with exit code {self._process.returncode}.")
+
+        commit = self._git("rev-parse", ref).strip()
+        self._git("update-ref", "-m", f"generate: {message.decode()}", "HEAD", commit, self.parent or "")
+        self._git("update-ref", "-d", ref)
+        # Only the index entries of the changed paths are replaced, the others keep their stat information.
+        index_info = "".join(
+            f"100644 {blob_id}\t{git_path}\n" if blob_id else f"0 {'0' * 40}\t{git_path}\n"
+            for git_path, blob_id in sorted(self.changes.items())
+        )
+        self._git("update-index", "--index-info", input=index_info.encode())
+        logger.info(f"Committed {len(self.changes)} changed files as {commit}.")
+        return commit
+
+    def close(self):
+        """
+            End the fast-import stream, without a commit the blobs written so far are left for git gc.
+        """
+        if self._process.returncode is None:
+            self._process.stdin.close()
+            self._process.wait()
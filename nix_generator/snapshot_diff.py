@@ -0,0 +1,106 @@
+from collections import namedtuple
+import hashlib
+import json
+
+# The parts of a repository the generated files depend on, packages maps each package name to a digest of its dict.
+RepositoryFingerprint = namedtuple("RepositoryFingerprint", ("url", "version", "narhash", "packages"))
+
+
+def repository_fingerprint(repo_dict):
+    packages = {}
+    for package_dict in repo_dict.get("packages", []):
+        data = json.dumps(package_dict, sort_keys=True, separators=(",", ":")).encode()
+        packages[package_dict["name"]] = hashlib.sha256(data).hexdigest()
+    return RepositoryFingerprint(
+        url=repo_dict.get("url"),
+        version=repo_dict.get("version"),
+        narhash=repo_dict.get("metadata", {}).get("narhash"),
+        packages=packages,
+    )
+
+
+def fingerprint_repositories(repositories):
+    """
+        Fingerprint a dict of repositories, or an iterable of (repo_name, repo_dict) pairs like iter_repositories
+        produces, without holding on to the repository dicts.
+    """
+    if hasattr(repositories, "items"):
+        repositories = repositories.items()
+    return {repo_name: repository_fingerprint(repo_dict) for repo_name, repo_dict in repositories}
+
+
+class SnapshotDiff:
+    """
+        The differences between the repositories of a base snapshot and a new one, both given as dicts of
+        RepositoryFingerprint. A repository changed if its url, version, narhash or any of its package dicts did,
+        and a package changed if its dict did, including its depends, or if it moved to another repository.
+    """
+
+    FIELDS = ("url", "version", "narhash")
+
+    def __init__(self, base, current):
+        self.added_repositories = sorted(set(current) - set(base))
+        self.removed_repositories = sorted(set(base) - set(current))
+        # repo_name -> list of what changed about it
+        self.changed_repositories = {}
+        for repo_name in sorted(set(base) & set(current)):
+            old, new = base[repo_name], current[repo_name]
+            changes = [field for field in self.FIELDS if getattr(old, field) != getattr(new, field)]
+            if old.packages != new.packages:
+                changes.append("packages")
+            if changes:
+                self.changed_repositories[repo_name] = changes
+
+        base_packages = self._package_index(base)
+        current_packages = self._package_index(current)
+        self.added_packages = sorted(set(current_packages) - set(base_packages))
+        self.removed_packages = sorted(set(base_packages) - set(current_packages))
+        self.changed_packages = sorted(
+            name
+            for name in set(base_packages) & set(current_packages)
+            if base_packages[name] != current_packages[name]
+        )
+
+    @staticmethod
+    def _package_index(fingerprints):
+        return {
+            package_name: (repo_name, digest)
+            for repo_name, fingerprint in fingerprints.items()
+            for package_name, digest in fingerprint.packages.items()
+        }
+
+    def affected_repositories(self):
+        return set(self.added_repositories) | set(self.changed_repositories)
+
+    def affected_packages(self, packages):
+        """
+            Names of the packages among the given Package objects whose definitions need to be regenerated. Besides
+            added and changed packages, that is every package depending on a name which was added or removed, as
+            those dependencies switch between being workspace packages and rosdep keys.
+        """
+        affected = set(self.added_packages) | set(self.changed_packages)
+        toggled = set(self.added_packages) | set(self.removed_packages)
+        if toggled:
+            affected.update(p.name for p in packages if toggled.intersection(p.build + p.run + p.test))
+        return affected
+
+    def __bool__(self):
+        return bool(
+            self.added_repositories or self.removed_repositories or self.changed_repositories
+            or self.added_packages or self.removed_packages or self.changed_packages
+        )
+
+    def summary(self):
+        return {
+            "changed": bool(self),
+            "repositories": {
+                "added": self.added_repositories,
+                "removed": self.removed_repositories,
+                "changed": self.changed_repositories,
+            },
+            "packages": {
+                "added": self.added_packages,
+                "removed": self.removed_packages,
+                "changed": self.changed_packages,
+            },
+        }
@@ -0,0 +1,94 @@
+import em
+
+
+class TemplateError(Exception):
+    pass
+
+
+class Template:
+    """
+        An empy template which is scanned and compiled to Python bytecode once, and can then be rendered any number
+        of times. Only the subset of empy markup used by the generator templates is supported: plain expressions,
+        and if/elif/else and for control blocks. Output is identical to running the template through em.Interpreter.
+    """
+
+    def __init__(self, text, name="<template>"):
+        self.name = name
+        scanner = em.Scanner(em.DEFAULT_PREFIX, text)
+        if text and not text.endswith("\n"):
+            # Same as em.Interpreter.safe, a trailing terminator lets the final markup complete.
+            scanner.feed(em.DEFAULT_PREFIX + "\n")
+        tokens = []
+        while (token := scanner.one()) is not None:
+            tokens.append(token)
+
+        lines = []
+        self._compile_tokens(tokens, lines, indent="")
+        self.source = "\n".join(lines) + "\n"
+        self.code = compile(self.source, f"<template {name}>", "exec")
+
+    def render(self, **variables):
+        parts = []
+        namespace = dict(variables)
+        namespace["_write"] = parts.append
+        namespace["_str"] = _str
+        exec(self.code, namespace)
+        return "".join(parts)
+
+    def _compile_tokens(self, tokens, lines, indent):
+        start = len(lines)
+        for token in tokens:
+            self._compile_token(token, lines, indent)
+        if len(lines) == start:
+            lines.append(f"{indent}pass")
+
+    def _compile_token(self, token, lines, indent):
+        if isinstance(token, em.NullToken):
+            lines.append(f"{indent}_write({token.data!r})")
+        elif isinstance(token, (em.WhitespaceToken, em.CommentToken)):
+            pass
+        elif isinstance(token, em.LiteralToken):
+            lines.append(f"{indent}_write({token.first!r})")
+        elif isinstance(token, em.PrefixToken):
+            lines.append(f"{indent}_write({token.prefix!r})")
+        elif isinstance(token, em.SimpleExpressionToken):
+            lines.append(f"{indent}_write(_str({token.code}))")
+        elif isinstance(token, em.ExpressionToken):
+            if token.exceptCode:
+                raise TemplateError(f"{self.name}: unsupported except clause in @({token.string()})")
+            if token.thenCode:
+                else_code = token.elseCode if token.elseCode else "None"
+                lines.append(f"{indent}_write(_str(({token.thenCode}) if ({token.testCode}) else ({else_code})))")
+            else:
+                lines.append(f"{indent}_write(_str({token.testCode}))")
+        elif isinstance(token, em.ControlToken):
+            self._compile_control(token, lines, indent)
+        else:
+            raise TemplateError(f"{self.name}: unsupported markup {token.string()!r}")
+
+    def _compile_control(self, token, lines, indent):
+        if token.type == "if":
+            for secondary, subtokens in token.build(["elif", "else"]):
+                if secondary.type == "else":
+                    lines.append(f"{indent}else:")
+                else:
+                    lines.append(f"{indent}{secondary.type} {secondary.rest}:")
+                self._compile_tokens(subtokens, lines, indent + "    ")
+        elif token.type == "for":
+            sides = em.ControlToken.IN_RE.split(token.rest, 1)
+            if len(sides) != 2:
+                raise TemplateError(f"{self.name}: control expected 'for x in seq'")
+            iterator, sequence_code = sides
+            info = token.build(["else"])
+            lines.append(f"{indent}for {iterator.strip()} in {sequence_code.strip()}:")
+            self._compile_tokens(info[0][1], lines, indent + "    ")
+            if len(info) > 1:
+                lines.append(f"{indent}else:")
+                self._compile_tokens(info[1][1], lines, indent + "    ")
+        else:
+            raise TemplateError(f"{self.name}: unsupported control markup {token.type!r}")
+
+
+def _str(value):
+    # em.Interpreter writes nothing at all for expressions evaluating to None.
+    return "" if value is None else str(value)
@@ -0,0 +1,10 @@
+final: prev: {
+  # A static file containing the snapshot version.
+  bundleRelease = ../release;
+
+  # Dedicated scope for all ROS packages, built from the sources and packages in index.json.
+  @(scope_name) = final.colconScopeFromJsonIndex {
+    index = ./index.json;
+    scopeName = "@(scope_name)";
+  };
+}
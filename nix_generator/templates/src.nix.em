@@ -10,6 +10,6 @@ let
 in
 {
 @[for p in packages]@
-  @(p['name']) = pkg "@(p['metadata']['narhash'])" "@(p['path'])";
+  @(p.name) = pkg "@(p.narhash)" "@(p.path)";
 @[end for]@
 }
@@ -0,0 +1,121 @@
+import contextlib
+import contextvars
+import itertools
+import json
+import logging
+import threading
+import time
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+
+# The innermost open span of the current thread or asyncio task, which new spans become children of.
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+# The active tracer, spans are only recorded once tracing is enabled.
+_tracer = None
+
+
+class Span:
+    def __init__(self, span_id, name, parent_id, attributes):
+        self.id = span_id
+        self.name = name
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.start = time.time()
+        self.duration = None
+        self.error = None
+        self._start_counter = time.perf_counter()
+
+    def set(self, **attributes):
+        """
+            Add attributes like byte or item counts to the span.
+        """
+        self.attributes.update(attributes)
+
+    def finish(self):
+        self.duration = time.perf_counter() - self._start_counter
+
+    def to_dict(self):
+        d = {
+            "id": self.id,
+            "parent": self.parent_id,
+            "name": self.name,
+            "start": self.start,
+            "duration": self.duration,
+            "attributes": self.attributes,
+        }
+        if self.error is not None:
+            d["error"] = self.error
+        return d
+
+
+class _NullSpan:
+    def set(self, **attributes):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Tracer:
+    """
+        Collects the spans of a run. Spans opened within another span, in the same thread or asyncio task, record
+        that as their parent.
+    """
+
+    def __init__(self):
+        self.spans = []
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, name, **attributes):
+        parent = _current_span.get()
+        with self._lock:
+            span = Span(next(self._ids), name, parent.id if parent is not None else None, attributes)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            span.finish()
+            _current_span.reset(token)
+            with self._lock:
+                self.spans.append(span)
+
+    def save(self, path):
+        spans = sorted(self.spans, key=lambda s: s.id)
+        with open(path, "w") as f:
+            json.dump({"spans": [s.to_dict() for s in spans]}, f, indent=1)
+        logger.info(f"Wrote {len(spans)} trace spans to {path}")
+
+
+def enable():
+    """
+        Start recording spans, returns the Tracer they are recorded in.
+    """
+    global _tracer
+    _tracer = Tracer()
+    return _tracer
+
+
+def span(name, **attributes):
+    """
+        Context manager timing the enclosed code as a span with the given attributes, yields the span so more
+        attributes can be set on it. Does nothing unless tracing is enabled.
+    """
+    if _tracer is None:
+        return contextlib.nullcontext(_NULL_SPAN)
+    return _tracer.span(name, **attributes)
+
+
+def in_context(fun, *args):
+    """
+        Returns a callable running fun(*args) in a copy of the current context, for passing to run_in_executor so
+        that spans opened in the worker thread are children of the current span.
+    """
+    context = contextvars.copy_context()
+    return lambda: context.run(fun, *args)
@@ -1,125 +1,186 @@
-import em
+from concurrent.futures import ProcessPoolExecutor
+from fnmatch import fnmatchcase
+import functools
+import itertools
+import json
 import logging
-from operator import itemgetter
-import os
+import multiprocessing
 from pkgutil import get_data
-import re
+
+from .manifest import Manifest, MANIFEST_NAME
+from .model import Package, Repository
+from .snapshot_diff import SnapshotDiff, fingerprint_repositories, repository_fingerprint
+from .template import Template
 
 # Setup logging.
 logging.basicConfig()
 logger = logging.getLogger(__name__)
 
-URL_REGEX = re.compile(
-    r"(?:\w+:\/\/|git@)(?P<server>[\w.-]+)[:/](?P<owner>[\w/_.-]*)/(?P<repo>[\w_.-]*)(?:\.git)?$"
-)
-FETCHERS = {
-    "github.com": "fetchFromGitHub",
-    "gitlab.com": "fetchFromGitLab",
-    "bitbucket.org": "fetchFromBitbucket",
-}
-GITIGNORE_CONTENTS = """\
+GITIGNORE_CONTENTS = f"""\
 result*
 *.swp
+{MANIFEST_NAME}
 """
 
-def sanitize_store_name(name):
-    return name.replace("~", "-").replace("/", "-")
-
 
 class Writer:
-    def __init__(self, packages_path, repositories, exclude_packages=tuple()):
+    """
+        Writes the nix files of a distro to packages_path. The repositories are either a dict like the one in a
+        colcon-distro snapshot, or an iterable of (repo_name, repo_dict) pairs like iter_repositories produces.
+
+        Repositories are ingested one at a time into the Repository and Package objects of the model module, which
+        keep only what the generator uses, so with a streamed snapshot the peak memory is that compact model plus a
+        single raw repository, rather than the full snapshot json and its parsed tree.
+
+        If the repositories of the snapshot packages_path was last generated from are passed as base_repositories,
+        only the files of repositories and packages that differ from it are rendered, the rest are kept as they are
+        on disk. The differences are available as the SnapshotDiff in diff. Rather than the base repositories, the
+        base_fingerprints computed from them may be passed, like those in fingerprints of a previous Writer.
+
+        Files are written to the sink, see the sinks module, by default the directory at packages_path.
+
+        With glob patterns in only, the distro is restricted to the packages they select, see select_packages.
+    """
+
+    def __init__(
+        self, packages_path, repositories, exclude_packages=tuple(), jobs=1, base_repositories=None, sink=None,
+        only=None, base_fingerprints=None,
+    ):
         self.packages_path = packages_path
-        self.repositories = repositories
         self.exclude_packages = exclude_packages
+        self.jobs = jobs
+        self.manifest = Manifest.load(packages_path, sink, tracked=True)
+
+        self.repo_names = []
+        self.repositories = []
+        self.packages = []
+        self.fingerprints = None
+        self.diff = None
+        if base_repositories is not None:
+            base_fingerprints = fingerprint_repositories(base_repositories)
+        if base_fingerprints is not None:
+            self.fingerprints = {}
+
+        if hasattr(repositories, "items"):
+            repositories = repositories.items()
+        for repo_name, repo_dict in repositories:
+            self.ingest_repository(repo_name, repo_dict)
+
+        if base_fingerprints is not None:
+            self.diff = SnapshotDiff(base_fingerprints, self.fingerprints)
+        if only:
+            self.select_packages(only)
 
     @staticmethod
+    @functools.lru_cache(maxsize=None)
     def get_template(name):
-        return get_data(__package__, f"templates/{name}.em").decode()
+        """
+            Load and compile a template once, the returned Template is reused for every file rendered from it.
+        """
+        return Template(get_data(__package__, f"templates/{name}.em").decode(), name)
 
     @classmethod
-    def write_base_files(cls, output_path, nix_base_url, overlay_paths, flake_tag, rosdistro_ref):
-        with open(output_path / "flake.nix", "w") as output:
-            v = {
-                "nix_base_url": nix_base_url,
-                "overlay_paths": overlay_paths,
-                "rosdistro_ref": rosdistro_ref,
-                "flake_tag": flake_tag,
-            }
-            i = em.Interpreter(output=output, globals=v)
-            i.string(cls.get_template("flake.nix"))
-            i.shutdown()
-        with open(output_path / "release", "w") as output:
-            output.write(flake_tag)
-        with open(output_path / ".gitignore", "w") as output:
-            output.write(GITIGNORE_CONTENTS)
-
-        with open(output_path / "README.md", "w") as output:
-            output.write(get_data(__package__, f"templates/README.md").decode())
+    def write_base_files(cls, output_path, nix_base_url, overlay_paths, flake_tag, rosdistro_ref, sink=None):
+        manifest = Manifest.load(output_path, sink)
+        v = {
+            "nix_base_url": nix_base_url,
+            "overlay_paths": overlay_paths,
+            "rosdistro_ref": rosdistro_ref,
+            "flake_tag": flake_tag,
+        }
+        manifest.write_file(output_path / "flake.nix", cls.get_template("flake.nix").render(**v))
+        manifest.write_file(output_path / "release", flake_tag)
+        manifest.write_file(output_path / ".gitignore", GITIGNORE_CONTENTS)
+        manifest.write_file(output_path / "README.md", get_data(__package__, f"templates/README.md").decode())
 
         github_action_path = output_path / ".github" / "workflows" / "build.yml"
-        github_action_path.parent.mkdir(exist_ok=True, parents=True)
-        with open(github_action_path, "w") as output:
-            output.write(get_data(__package__, f"templates/github-workflows-build.yml").decode())
+        manifest.write_file(github_action_path, get_data(__package__, f"templates/github-workflows-build.yml").decode())
+        manifest.save()
 
-    def write_srcs_files(self):
-        for repo_name, repo_dict in self.repositories.items():
-            package_dicts = [
-                d
-                for d in repo_dict["packages"]
-                if d["name"] not in self.exclude_packages
-            ]
+    def ingest_repository(self, repo_name, repo_dict):
+        self.repo_names.append(repo_name)
+        if self.fingerprints is not None:
+            self.fingerprints[repo_name] = repository_fingerprint(repo_dict)
+        packages = [
+            Package.from_dict(repo_name, d)
+            for d in repo_dict["packages"]
+            if d["name"] not in self.exclude_packages
+        ]
+        self.packages.extend(packages)
 
-            repo_file = self.packages_path / "srcs" / f"{repo_name}.nix"
-            repo_file.parent.mkdir(exist_ok=True, parents=True)
-            try:
-                git_parts = URL_REGEX.match(repo_dict["url"])
-                host_repo = git_parts.group("repo").split(".git")[0]
-                package_dicts.sort(key=itemgetter("name"))
-                v = {
-                    "name": repo_name,
-                    "fetcher": FETCHERS[git_parts.group("server")],
-                    "owner": git_parts.group("owner"),
-                    "repo": host_repo,
-                    "rev": repo_dict["version"],
-                    "hash": repo_dict["metadata"]["narhash"],
-                    "safe_owner": sanitize_store_name(git_parts.group("owner")),
-                    "safe_repo": sanitize_store_name(host_repo),
-                    "safe_rev": sanitize_store_name(repo_dict["version"]),
-                    "packages": package_dicts,
-                }
-            except KeyError:
-                logger.exception(f"Skipping repo {repo_name} due to missing fields.")
-                continue
+        try:
+            repository = Repository.from_dict(repo_name, repo_dict, packages)
+        except KeyError:
+            logger.exception(f"Skipping repo {repo_name} due to missing fields.")
+            return
+        self.repositories.append(repository)
 
-            with open(repo_file, "w") as output:
-                i = em.Interpreter(output=output, globals=v)
-                i.string(self.get_template("src.nix"))
-                i.shutdown()
-        logger.info(f"Wrote {len(self.repositories)} repository source definitions.")
+    def srcs_file_path(self, repo_name):
+        return self.packages_path / "srcs" / f"{repo_name}.nix"
 
-        with open(self.packages_path / "srcs" / "default.nix", "w") as output:
-            v = {"repo_names": self.repositories.keys()}
-            i = em.Interpreter(output=output, globals=v)
-            i.string(self.get_template("src-default.nix"))
-            i.shutdown()
+    def select_packages(self, patterns):
+        """
+            Restrict the distro to the packages with a name or repository name matching one of the glob patterns,
+            along with every workspace package those need to build, run or test, directly or not. The srcs and
+            default.nix files then only list what is left, so the result is a consistent, if partial, distro.
+        """
+        packages_by_name = {p.name: p for p in self.packages}
+        selected = set()
+        for pattern in patterns:
+            matches = [
+                p.name for p in self.packages if fnmatchcase(p.name, pattern) or fnmatchcase(p.repo_name, pattern)
+            ]
+            if not matches:
+                logger.warning(f"No packages in {self.packages_path.name} match {pattern}.")
+            selected.update(matches)
 
-    def write_packages_files(self, rosdep_mapping):
-        # Remember these so we only warn once for each of them.
-        unresolved_rosdeps = set()
+        pending = list(selected)
+        while pending:
+            package = packages_by_name[pending.pop()]
+            for dep_name in itertools.chain(package.build, package.run, package.test):
+                if dep_name in packages_by_name and dep_name not in selected:
+                    selected.add(dep_name)
+                    pending.append(dep_name)
+
+        self.packages = [p for p in self.packages if p.name in selected]
+        repo_names = set(p.repo_name for p in self.packages)
+        self.repo_names = [name for name in self.repo_names if name in repo_names]
+        self.repositories = [r for r in self.repositories if r.name in repo_names]
+        for repository in self.repositories:
+            repository.packages = tuple(p for p in repository.packages if p.name in selected)
+        logger.info(f"Selected {len(self.packages)} packages from {len(self.repo_names)} repositories.")
 
-        all_package_dicts = []
-        for repo_name, repo_dict in self.repositories.items():
-            for package_dict in repo_dict["packages"]:
-                if package_dict["name"] in self.exclude_packages:
-                    continue
-                package_dict["repo_name"] = repo_name
-                all_package_dicts.append(package_dict)
+    def write_srcs_files(self):
+        repositories = self.repositories
+        if self.diff is not None:
+            affected = self.diff.affected_repositories()
+            repositories = [
+                r
+                for r in repositories
+                if r.name in affected or not self.manifest.keep(self.srcs_file_path(r.name))
+            ]
+        src_items = [(self.srcs_file_path(r.name), r.template_variables()) for r in repositories]
+        self.run_file_writer(TemplateFileWriter(self.manifest.shard(), "src.nix"), src_items)
+        logger.info(f"Wrote {len(self.repo_names)} repository source definitions.")
 
+        v = {"repo_names": self.repo_names}
+        content = self.get_template("src-default.nix").render(**v)
+        self.manifest.write_file(self.packages_path / "srcs" / "default.nix", content)
+
+    def resolve_packages(self, resolver):
+        """
+            Resolve the dependencies of every package with the given RosdepResolver. Returns a list with a tuple of
+            (package, inputs, buildDepends, runDepends, testDepends) per package.
+        """
         # A set containing all known package names, for the purposes of identifying
         # non-workspace dependencies, which then go to rosdep.
-        package_names = set(p["name"] for p in all_package_dicts)
+        package_names = set(p.name for p in self.packages)
 
-        for package_dict in all_package_dicts:
+        # Remember these so we only warn once for each of them.
+        unresolved_rosdeps = set()
+
+        resolved = []
+        for package in self.packages:
             inputs = set()
 
             def process_dependencies(dep_names):
@@ -128,53 +189,186 @@ class Writer:
                         # Dependency is just another workspace package.
                         inputs.add(dep_name)
                         yield dep_name
+                    elif (resolution := resolver.resolve(dep_name)) is not None:
+                        inputs.update(resolution.inputs)
+                        yield from resolution.attrs
                     else:
-                        # Many internal packages have not been updated for python3-xx rosdep keys, so
-                        # we provide a shim for that here. Explicit is not None check is needed here
-                        # because empty list is falsy to Python.
-                        if (mapped_py3 := rosdep_mapping.get(dep_name.replace("python-", "python3-", 1))) is not None:
-                            for mapped_dep in mapped_py3:
-                                inputs.add(mapped_dep.split(".")[0])
-                            yield from mapped_py3
-                        elif (mapped := rosdep_mapping.get(dep_name)) is not None:
-                            for mapped_dep in mapped:
-                                inputs.add(mapped_dep.split(".")[0])
-                            yield from mapped
-                        elif dep_name not in unresolved_rosdeps:
-                            unresolved_rosdeps.add(dep_name)
-                            logger.debug(f"Unable to resolve dependency: {dep_name}")
-
-            buildDepends = set(process_dependencies(package_dict["depends"].get("build", [])))
-            runDepends = set(process_dependencies(package_dict["depends"].get("run", [])))
-            testDepends = set(process_dependencies(package_dict["depends"].get("test", [])))
+                        unresolved_rosdeps.add(dep_name)
 
-            v = {
-                "name": package_dict["name"],
-                "repo_name": package_dict["repo_name"],
-                "inputs": sorted(inputs),
-                "buildDepends": sorted(buildDepends),
-                "runDepends": sorted(runDepends),
-                "testDepends": sorted(testDepends),
-                "binary": package_dict["metadata"].get("binary"),
-                "scope_name": self.packages_path.name,
-            }
-            filename = self.packages_path / f'{package_dict["name"]}.nix'
-            with open(filename, "w") as output:
-                i = em.Interpreter(output=output, globals=v)
-                i.string(self.get_template("package.nix"))
-                i.shutdown()
+            buildDepends = sorted(set(process_dependencies(package.build)))
+            runDepends = sorted(set(process_dependencies(package.run)))
+            testDepends = sorted(set(process_dependencies(package.test)))
+            resolved.append((package, inputs, buildDepends, runDepends, testDepends))
 
-        logger.info(f"Wrote {len(all_package_dicts)} package definitions.")
+        for dep_name in sorted(unresolved_rosdeps):
+            logger.debug(f"Unable to resolve dependency: {dep_name}")
         if unresolved_rosdeps:
             logger.warning(
                 f"Unable to resolve {len(unresolved_rosdeps)} ROS dependencies."
             )
 
-        with open(self.packages_path / "default.nix", "w") as output:
+        return resolved
+
+    def write_packages_files(self, resolver):
+        """
+            Write the package definitions, resolving non-workspace dependencies with the given RosdepResolver.
+        """
+        package_names = set(p.name for p in self.packages)
+        resolved = self.resolve_packages(resolver)
+        affected = self.diff.affected_packages(self.packages) if self.diff is not None else None
+
+        package_items = []
+        for package, inputs, buildDepends, runDepends, testDepends in resolved:
+            package_path = self.packages_path / f"{package.name}.nix"
+            if affected is not None and package.name not in affected and self.manifest.keep(package_path):
+                continue
             v = {
-                "package_names": sorted(package_names),
+                "name": package.name,
+                "repo_name": package.repo_name,
+                "inputs": sorted(inputs),
+                "buildDepends": buildDepends,
+                "runDepends": runDepends,
+                "testDepends": testDepends,
+                "binary": package.binary,
                 "scope_name": self.packages_path.name,
             }
-            i = em.Interpreter(output=output, globals=v)
-            i.string(self.get_template("package-default.nix"))
-            i.shutdown()
+            package_items.append((package_path, v))
+
+        self.run_file_writer(TemplateFileWriter(self.manifest.shard(), "package.nix"), package_items)
+
+        logger.info(f"Wrote {len(self.packages)} package definitions.")
+
+        v = {
+            "package_names": sorted(package_names),
+            "scope_name": self.packages_path.name,
+        }
+        content = self.get_template("package-default.nix").render(**v)
+        self.manifest.write_file(self.packages_path / "default.nix", content)
+
+    def write_json_index(self, resolver):
+        """
+            Write the sources and resolved packages of the whole distro as a single json document, index.json, along
+            with a default.nix overlay building the scope from it with colconScopeFromJsonIndex. This replaces the
+            srcs and package files of the default format; nix then reads and parses one file instead of one per
+            repository and package, and a regeneration rewrites a single file.
+        """
+        resolved = self.resolve_packages(resolver)
+
+        sources = {}
+        for repository in self.repositories:
+            sources[repository.name] = {
+                "fetcher": repository.fetcher,
+                "owner": repository.owner,
+                "repo": repository.repo,
+                "rev": repository.rev,
+                "hash": repository.hash,
+                "name": repository.store_name,
+                "packages": [p.name for p in repository.packages],
+            }
+
+        packages = {}
+        for package, _, buildDepends, runDepends, testDepends in resolved:
+            if package.repo_name not in sources:
+                # The repository was skipped, so there's no source to build the package from.
+                continue
+            packages[package.name] = {
+                "source": package.repo_name,
+                "path": package.path,
+                "narhash": package.narhash,
+                "binary": bool(package.binary),
+                "buildDepends": buildDepends,
+                "runDepends": runDepends,
+                "testDepends": testDepends,
+            }
+
+        scope_name = self.packages_path.name
+        index = {"scope": scope_name, "sources": sources, "packages": packages}
+        # One item per line and sorted keys, so that the changes between generations are readable diffs.
+        content = json.dumps(index, indent=1, sort_keys=True) + "\n"
+        self.manifest.write_file(self.packages_path / "index.json", content)
+        logger.info(f"Wrote index of {len(sources)} repositories and {len(packages)} packages.")
+
+        content = self.get_template("index-default.nix").render(scope_name=scope_name)
+        self.manifest.write_file(self.packages_path / "default.nix", content)
+
+    def finish(self):
+        """
+            Remove files of packages and repositories that are no longer part of the distro, and store the manifest
+            for the next generation. Call this once all files have been written.
+        """
+        removed = self.manifest.remove_stale()
+        self.manifest.save()
+        logger.info(
+            f"Updated {self.manifest.written} of {len(self.manifest.current)} files, removed {removed} stale files."
+        )
+
+    def run_file_writer(self, file_writer, items):
+        """
+            Run file_writer over all items, sharded across a process pool if more than one job is requested. Returns
+            the list of results from file_writer.write, one per shard.
+        """
+        if self.jobs <= 1 or len(items) < 2:
+            shard_results = [_write_shard(file_writer, items)]
+        else:
+            # Workers which can't write to the sink pass the rendered files back to be written here.
+            file_writer.manifest = self.manifest.shard(worker=True)
+            # A few shards per worker evens out the load when some shards turn out slower than others.
+            chunk_size = -(-len(items) // (self.jobs * 4))
+            chunks = [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+            with ProcessPoolExecutor(
+                max_workers=self.jobs, mp_context=_worker_context(), initializer=_init_worker, initargs=(file_writer,)
+            ) as executor:
+                shard_results = list(executor.map(_run_worker, chunks))
+
+        results = []
+        for result, manifest_entries, written, files in shard_results:
+            self.manifest.update(manifest_entries, written, files)
+            results.append(result)
+        return results
+
+
+class TemplateFileWriter:
+    """
+        Renders a template to a file for each (path, variables) item. This is what runs in the worker processes, so
+        the items only carry the variables the template needs.
+    """
+
+    def __init__(self, manifest, template_name):
+        self.manifest = manifest
+        self.template_name = template_name
+
+    def write(self, items):
+        template = Writer.get_template(self.template_name)
+        for path, v in items:
+            self.manifest.write_file(path, template.render(**v))
+
+
+# The file writer of the pool this worker process belongs to, set once by the pool initializer.
+_worker_file_writer = None
+
+
+def _worker_context():
+    # A forked child only has the thread that forked, and the locks the other threads held, like those of a running
+    # event loop or http client, stay locked in it. The workers are started from a clean process instead, which
+    # the file writer is pickled to.
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("forkserver")
+    return multiprocessing.get_context("spawn")
+
+
+def _init_worker(file_writer):
+    global _worker_file_writer
+    _worker_file_writer = file_writer
+
+
+def _run_worker(items):
+    return _write_shard(_worker_file_writer, items, worker=True)
+
+
+def _write_shard(file_writer, items, worker=False):
+    # Every shard starts with an empty set of entries, which the Writer merges back into its own manifest, along
+    # with the files of workers that can't write to the sink themselves.
+    file_writer.manifest = manifest = file_writer.manifest.shard(worker)
+    result = file_writer.write(items)
+    files = manifest.sink.files if worker and not manifest.sink.shared else None
+    return result, manifest.current, manifest.written, files
@@ -0,0 +1,75 @@
+import copy
+
+from nix_generator.manifest import MANIFEST_NAME
+from nix_generator.rosdeps import RosdepResolver
+from nix_generator.writer import Writer
+
+REPOSITORIES = {
+    "ros_comm": {
+        "url": "https://github.com/ros/ros_comm.git",
+        "version": "1.15.14",
+        "metadata": {"narhash": "sha256-repo"},
+        "packages": [
+            {
+                "name": "roscpp",
+                "path": "clients/roscpp",
+                "depends": {"build": ["cpp_common", "boost"], "run": ["cpp_common", "python-yaml"], "test": ["gtest"]},
+                "metadata": {"narhash": "sha256-roscpp", "binary": True},
+            },
+            {
+                "name": "cpp_common",
+                "path": "utilities/cpp_common",
+                "depends": {"build": ["boost", "no-such-key"]},
+                "metadata": {"narhash": "sha256-cpp_common"},
+            },
+            {
+                "name": "gtest",
+                "path": "gtest",
+                "depends": {},
+                "metadata": {"narhash": "sha256-gtest"},
+            },
+        ],
+    },
+    "ros/geometry2": {
+        "url": "git@github.com:ros/geometry2.git",
+        "version": "0.7.5~1",
+        "metadata": {"narhash": "sha256-geometry2"},
+        "packages": [
+            {
+                "name": "tf2",
+                "path": "tf2",
+                "depends": {"build": ["roscpp"], "run": ["roscpp"], "test": []},
+                "metadata": {"narhash": "sha256-tf2", "binary": True},
+            },
+        ],
+    },
+}
+
+ROSDEP_MAPPING = {
+    "boost": ["boost"],
+    "python3-yaml": ["python3Packages.pyyaml"],
+}
+
+
+def read_tree(path):
+    return {
+        str(p.relative_to(path)): p.read_text()
+        for p in sorted(path.rglob("*"))
+        if p.is_file() and p.name != MANIFEST_NAME
+    }
+
+
+def generate(path, repositories=REPOSITORIES, **kwargs):
+    """
+        Write the files of a distro of repositories to path like generate does, returns the Writer.
+    """
+    writer = Writer(path, copy.deepcopy(repositories), ("gtest",), **kwargs)
+    writer.write_srcs_files()
+    writer.write_packages_files(RosdepResolver(ROSDEP_MAPPING))
+    writer.finish()
+    return writer
+
+
+def write_tree(path, jobs=1):
+    generate(path, jobs=jobs)
+    return read_tree(path)
@@ -0,0 +1,34 @@
+# Compares propagateColconRunDepends with the lib.unique based propagation it replaced, on a small graph of stand-in
+# derivations with shared and diamond shaped run dependencies. Only needs builtins, run by tests/test_nix_lib.py.
+let
+  uniqueByOutPath = import ../../lib/unique-by-out-path.nix { lib = builtins; };
+  propagate = import ../../lib/propagate-colcon-run-depends.nix { lib = builtins; inherit uniqueByOutPath; };
+
+  # lib.unique of nixpkgs.
+  unique = builtins.foldl' (acc: e: if builtins.elem e acc then acc else acc ++ [ e ]) [];
+
+  baseline = with builtins; packages: let
+    validPackages = filter (d: d != null) packages;
+    propagatedColconRunDepends = unique (concatLists (catAttrs "colconRunDepends" validPackages));
+  in
+    if length validPackages > 0 then unique (baseline propagatedColconRunDepends ++ validPackages) else [];
+
+  pkg = name: colconRunDepends: {
+    type = "derivation";
+    outPath = "/nix/store/${name}";
+    inherit name colconRunDepends;
+  };
+
+  a = pkg "a" [];
+  b = pkg "b" [ a ];
+  c = pkg "c" [ a null ];
+  d = pkg "d" [ c b ];
+  e = pkg "e" [ b d a ];
+  f = pkg "f" [ e c e ];
+
+  names = map (p: p.name);
+  cases = [ [] [ null ] [ a ] [ f ] [ d e ] [ f a b null f ] [ c b d ] ];
+in map (packages: {
+  propagated = names (propagate packages);
+  baseline = names (baseline packages);
+}) cases
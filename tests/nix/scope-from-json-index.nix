@@ -0,0 +1,50 @@
+# Evaluates the scope that colconScopeFromJsonIndex builds from a distro written with --format=json-index, and the one
+# that the default.nix of the default format assembles for the same distro, against stand-ins for nixpkgs that record
+# what they are called with. Both are reduced to plain data, which tests/test_nix_lib.py compares. Needs the lib of
+# a nixpkgs in NIX_PATH.
+{ nixOverlay, jsonIndexOverlay, scopeName }:
+let
+  lib = import <nixpkgs/lib>;
+
+  drv = name: { type = "derivation"; outPath = "/nix/store/${name}"; inherit name; };
+
+  base = final: {
+    inherit lib;
+    pkgs = final;
+    callPackage = lib.callPackageWith final;
+    callPackages = lib.callPackagesWith final;
+
+    fetchFromGitHub = args: drv args.name // { inherit args; };
+    pkgSrc = src: narhash: path: drv "${src.name}-${narhash}" // { inherit src narhash path; };
+    buildColconPackage = args: drv args.name // { inherit args; inherit (args) pkgFinal src; };
+    colconScopeFromJsonIndex = final.callPackage ../../lib/colcon-scope-from-json-index.nix { };
+
+    boost = drv "boost";
+    python3Packages = { pyyaml = drv "python3Packages.pyyaml"; };
+  };
+
+  names = map (d: d.name);
+
+  src = s: { inherit (s) narhash path; inherit (s.src) args; };
+
+  package = p: {
+    inherit (p.args) name;
+    pkgFinal = p.args.pkgFinal.name;
+    src = src p.args.src;
+    separateDebugInfo = p.args.separateDebugInfo or false;
+    colconBuildDepends = names p.args.colconBuildDepends;
+    colconRunDepends = names p.args.colconRunDepends;
+    colconTestDepends = names p.args.colconTestDepends;
+  };
+
+  scope = overlay: let
+    s = (lib.fix (lib.extends (import overlay) base)).${scopeName};
+  in {
+    packages = lib.mapAttrs (_: package) (lib.filterAttrs (_: p: p ? args.pkgFinal) s);
+    srcs = lib.mapAttrs (_: lib.mapAttrs (_: src)) s.srcs;
+    by_repo = lib.mapAttrs (_: names) s.by_repo;
+  };
+in {
+  nix = scope nixOverlay;
+  jsonIndex = scope jsonIndexOverlay;
+}
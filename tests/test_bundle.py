@@ -0,0 +1,71 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+import yaml
+
+from nix_generator.bundle import Bundle, BundleTransport, RecordingTransport
+from nix_generator.cli import generate_distros
+
+from conftest import REPOSITORIES, read_tree
+
+ROSDEP_URLS = ["https://github.com/ros/rosdistro/raw/master/rosdep/base.yaml"]
+ROSDEP_YAML = {"boost": {"nixos": ["boost"], "ubuntu": ["libboost-all-dev"]}}
+
+
+def handler(request):
+    if request.url.host == "github.com":
+        return httpx.Response(302, headers={"Location": "https://raw.githubusercontent.com/rosdep/base.yaml"})
+    if request.url.host == "raw.githubusercontent.com":
+        return httpx.Response(200, headers=[("Vary", "Accept"), ("Vary", "Origin")], text=yaml.safe_dump(ROSDEP_YAML))
+    return httpx.Response(200, json={"repositories": REPOSITORIES})
+
+
+def test_bundle_roundtrip(tmp_path):
+    bundle = Bundle()
+    transport = RecordingTransport(bundle, httpx.MockTransport(handler))
+    asyncio.run(generate_distros(tmp_path / "online", "refs/tags/x", ROSDEP_URLS, 1, transport=transport))
+    bundle.ref = "refs/tags/x"
+    bundle.save(tmp_path / "bundle.tar.gz")
+    # Both distros, plus the rosdep redirect and its target.
+    assert len(bundle.responses) == 4
+
+    loaded = Bundle.load(tmp_path / "bundle.tar.gz")
+    assert loaded.ref == "refs/tags/x"
+    assert loaded.base_ref is None
+    assert loaded.responses == bundle.responses
+    # Repeated headers are kept as they came.
+    _, headers, _ = loaded.responses["https://raw.githubusercontent.com/rosdep/base.yaml"]
+    assert [v for k, v in headers if k == "vary"] == ["Accept", "Origin"]
+    transport = BundleTransport(loaded)
+    asyncio.run(generate_distros(tmp_path / "offline", "refs/tags/x", ROSDEP_URLS, 1, transport=transport))
+    assert read_tree(tmp_path / "online") == read_tree(tmp_path / "offline")
+
+
+def test_bundle_base_ref(tmp_path):
+    bundle = Bundle()
+    transport = RecordingTransport(bundle, httpx.MockTransport(handler))
+    asyncio.run(generate_distros(tmp_path / "online", "refs/tags/y", ROSDEP_URLS, 1, transport=transport))
+    asyncio.run(generate_distros(
+        tmp_path / "online", "refs/tags/y", ROSDEP_URLS, 1, transport=transport, base_ref="refs/tags/x"
+    ))
+    bundle.ref, bundle.base_ref = "refs/tags/y", "refs/tags/x"
+    bundle.save(tmp_path / "bundle.tar.gz")
+
+    # The snapshots of the base ref are in the bundle as well, so the changes since it are found offline.
+    loaded = Bundle.load(tmp_path / "bundle.tar.gz")
+    assert loaded.base_ref == "refs/tags/x"
+    changes = asyncio.run(generate_distros(
+        tmp_path / "online", "refs/tags/y", ROSDEP_URLS, 1, transport=BundleTransport(loaded), base_ref="refs/tags/x"
+    ))
+    assert not any(c["changed"] for c in changes.values())
+
+
+def test_bundle_missing_response():
+    async def run():
+        async with httpx.AsyncClient(transport=BundleTransport(Bundle())) as client:
+            await client.get("http://example.com/")
+
+    with pytest.raises(httpx.ConnectError):
+        asyncio.run(run())
@@ -0,0 +1,29 @@
+import os
+
+from nix_generator.cache import DiskCache
+
+
+def test_get_put(tmp_path):
+    cache = DiskCache(tmp_path)
+    assert cache.get("a") is None
+    cache.put("a", b"data", {"etag": "x"})
+    assert cache.get("a") == (b"data", {"etag": "x"})
+    cache.put("a", b"other")
+    assert cache.get("a") == (b"other", {})
+    assert DiskCache(tmp_path).get("a").data == b"other"
+
+
+def test_evict_least_recently_used(tmp_path):
+    cache = DiskCache(tmp_path, max_size=10)
+    cache.put("a", b"aaaa")
+    cache.put("b", b"bbbb")
+    # Make the entries clearly ordered by age, then use "a" so that "b" is the least recently used.
+    for i, key in enumerate(("a", "b")):
+        os.utime(cache._paths(key)[0], (i, i))
+    assert cache.get("a") is not None
+
+    cache.put("c", b"cccc")
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    assert cache.get("c") is not None
+    assert not any(tmp_path.glob(".tmp-*"))
@@ -0,0 +1,111 @@
+import asyncio
+import io
+import json
+
+import httpx
+import pytest
+
+from nix_generator.cache import DiskCache
+from nix_generator.distro_cache import DistroCacheError, fetch_distro, iter_repositories
+
+
+def mock_client(handler):
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+
+def test_fetch_distro():
+    payload = {"repositories": {"ros_comm": {"version": "1.15.14"}}}
+    requested = []
+
+    def handler(request):
+        requested.append(str(request.url))
+        return httpx.Response(200, content=json.dumps(payload).encode())
+
+    async def run():
+        async with mock_client(handler) as client:
+            with await fetch_distro(client, "noetic", "refs/tags/snapshot/20220329") as snapshot:
+                return json.load(snapshot)
+
+    assert asyncio.run(run()) == payload
+    assert requested == ["http://colcon-distro.ext.ottomotors.com/get/noetic/refs/tags/snapshot/20220329.json"]
+
+
+def test_fetch_distro_missing():
+    async def run():
+        async with mock_client(lambda request: httpx.Response(404)) as client:
+            return await fetch_distro(client, "noetic", "refs/tags/nope")
+
+    with pytest.raises(DistroCacheError):
+        asyncio.run(run())
+
+
+def test_fetch_distro_cached(tmp_path):
+    cache = DiskCache(tmp_path)
+    payload = {"repositories": {}}
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        if request.headers.get("If-None-Match") == '"v1"':
+            return httpx.Response(304)
+        return httpx.Response(200, content=json.dumps(payload).encode(), headers={"ETag": '"v1"'})
+
+    async def run(ref):
+        async with mock_client(handler) as client:
+            with await fetch_distro(client, "rolling", ref, cache) as snapshot:
+                return json.load(snapshot)
+
+    # A mutable ref is revalidated with the etag of the cached response.
+    assert asyncio.run(run("refs/heads/master")) == payload
+    assert asyncio.run(run("refs/heads/master")) == payload
+    assert len(requests) == 2
+    assert requests[1].headers["If-None-Match"] == '"v1"'
+
+    # A tag is only downloaded once.
+    assert asyncio.run(run("refs/tags/snapshot/20220329")) == payload
+    assert asyncio.run(run("refs/tags/snapshot/20220329")) == payload
+    assert len(requests) == 3
+
+
+def test_fetch_distro_revalidation_failed(tmp_path):
+    cache = DiskCache(tmp_path)
+    cache.put("distro/rolling/refs/heads/master", b"{}", {"etag": '"v1"'})
+    opened = []
+    open_entry = cache.open
+    cache.open = lambda key: opened.append(open_entry(key)) or opened[-1]
+
+    def handler(request):
+        raise httpx.ConnectError("unreachable", request=request)
+
+    async def run():
+        async with mock_client(handler) as client:
+            return await fetch_distro(client, "rolling", "refs/heads/master", cache)
+
+    # The cached copy isn't leaked when the request fails.
+    with pytest.raises(httpx.ConnectError):
+        asyncio.run(run())
+    assert opened[0].data.closed
+
+
+def test_iter_repositories():
+    repositories = {
+        "ros_comm": {"version": "1.15.14", "packages": [{"name": "roscpp", "depends": {"run": ["rosconsole"]}}]},
+        "geometry2": {"version": "0.7.5", "metadata": {"narhash": "sha256-\u00e9", "stars": 12345, "score": 1.5e3}},
+        "empty": {},
+        "tricky": {"description": 'brackets } ] { [ in "quoted" strings, escapes \\ \\" \n\u2603'},
+    }
+    snapshot = {"distro": "noetic", "repositories": repositories, "packages": [1, 2, 3]}
+    data = json.dumps(snapshot, indent=2).encode()
+
+    # Tiny chunks split strings, numbers and multibyte characters across reads.
+    for chunk_size in (1, 2, 3, 7, 1 << 16):
+        assert list(iter_repositories(io.BytesIO(data), chunk_size)) == list(repositories.items())
+
+    assert list(iter_repositories(io.BytesIO(b'{"repositories": {}}'))) == []
+
+
+def test_iter_repositories_invalid():
+    with pytest.raises(ValueError):
+        list(iter_repositories(io.BytesIO(b'["repositories"]')))
+    with pytest.raises(ValueError):
+        list(iter_repositories(io.BytesIO(b'{"repositories": {"ros_comm": {"version": ')))
@@ -0,0 +1,50 @@
+from nix_generator.graph import cycles, dependency_levels, strongly_connected_components, transitive_closures
+
+
+def test_strongly_connected_components():
+    edges = {"a": ["b", "c"], "b": ["c"], "c": ["d"], "d": ["c"], "e": []}
+    components = strongly_connected_components(edges)
+    assert sorted(map(sorted, components)) == [["a"], ["b"], ["c", "d"], ["e"]]
+    # Dependencies come before their dependents.
+    index = {node: i for i, component in enumerate(components) for node in component}
+    assert index["c"] < index["b"] < index["a"]
+
+
+def test_transitive_closures():
+    edges = {
+        "tf2": ["roscpp", "boost"],
+        "roscpp": ["cpp_common", "python3Packages.pyyaml"],
+        "cpp_common": ["boost"],
+        "rostest": [],
+    }
+    closures = transitive_closures(edges)
+    assert set(closures) == set(edges)
+    assert set(closures["tf2"]) == {"roscpp", "cpp_common", "boost", "python3Packages.pyyaml"}
+    assert closures["tf2"].index("cpp_common") < closures["tf2"].index("roscpp")
+    assert closures["tf2"].index("boost") < closures["tf2"].index("cpp_common")
+    assert closures["cpp_common"] == ["boost"]
+    assert closures["rostest"] == []
+
+
+def test_transitive_closures_cycle():
+    closures = transitive_closures({"a": ["b"], "b": ["a", "c"], "c": [], "d": ["d"]})
+    assert sorted(closures["a"]) == ["b", "c"]
+    assert sorted(closures["b"]) == ["a", "c"]
+    assert closures["d"] == []
+
+
+def test_transitive_closures_deep():
+    # Longer than the recursion limit.
+    edges = {i: [i + 1] for i in range(1200)}
+    assert transitive_closures(edges)[0] == list(range(1200, 0, -1))
+
+
+def test_dependency_levels():
+    edges = {"a": ["b", "c"], "b": ["c"], "c": [], "d": ["e"], "e": ["d", "c"], "f": ["d"]}
+    levels = dependency_levels(edges)
+    assert levels == {"a": 2, "b": 1, "c": 0, "d": 1, "e": 1, "f": 2}
+
+
+def test_cycles():
+    edges = {"a": ["b"], "b": ["a", "c"], "c": [], "d": ["d"]}
+    assert cycles(edges) == [["a", "b"], ["d"]]
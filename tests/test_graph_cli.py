@@ -0,0 +1,35 @@
+import json
+
+from nix_generator.graph_cli import analyze, format_report, package_graph, to_dot, to_json
+
+from conftest import REPOSITORIES
+
+
+def test_package_graph():
+    edges = package_graph(REPOSITORIES.items())
+    # System dependencies and excluded packages are left out.
+    assert edges == {"roscpp": ["cpp_common"], "cpp_common": [], "tf2": ["roscpp"]}
+    assert package_graph(REPOSITORIES.items(), kinds=("test",), exclude_packages=())["roscpp"] == ["gtest"]
+
+
+def test_analyze():
+    edges = package_graph(REPOSITORIES.items())
+    report = analyze(edges, top=2)
+    assert report["packages"] == 3
+    assert report["edges"] == 2
+    assert report["depth"] == 3
+    assert report["width"] == [1, 1, 1]
+    assert report["critical_path"] == ["tf2", "roscpp", "cpp_common"]
+    assert report["largest_closures"] == [["tf2", 2], ["roscpp", 1]]
+    assert report["most_dependents"] == [["cpp_common", 1], ["roscpp", 1]]
+    assert report["most_transitive_dependents"] == [["cpp_common", 2], ["roscpp", 1]]
+    assert report["cycles"] == []
+    assert "depth 3" in format_report("noetic", report)
+
+
+def test_export():
+    edges = package_graph(REPOSITORIES.items())
+    assert json.loads(to_json(edges))["tf2"] == {"level": 2, "depends": ["roscpp"]}
+    dot = to_dot(edges, "noetic")
+    assert dot.startswith('digraph "noetic" {')
+    assert '  "tf2" -> "roscpp";' in dot.splitlines()
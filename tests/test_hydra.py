@@ -1,4 +1,9 @@
-from nix_generator.hydra import Hydra
+import asyncio
+import httpx
+
+from nix_generator.cache import DiskCache
+from nix_generator.hydra import Hydra, HydraResponseException
+from nix_generator.hydra_cli import JobsetState, get_jobset_jobs, jobset_trees
 
 def test_push_jobset_tag():
     client = Hydra("http://hydra", dry_run=True)
@@ -26,3 +31,133 @@ def test_push_jobset_url():
     assert client.client_cls.requests[0].url == f"/jobset/my_project/{jobset_name}"
     assert client.client_cls.requests[0].kwargs["data"]["flake"] == my_flake_url
     assert client.client_cls.requests[1].url == f"/api/push?jobsets={project}:{jobset_name}&force=1"
+
+def test_pooled_client_keeps_cookies():
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        if request.url.path == "/login":
+            return httpx.Response(200, headers={"Set-Cookie": "hydra_session=abc; Path=/"}, json={})
+        return httpx.Response(200, json={"id": 1, "finished": 1})
+
+    client = Hydra("http://hydra", transport=httpx.MockTransport(handler))
+    with client:
+        client.login("user", "password")
+        with client.client() as c:
+            pooled = c
+        assert client.get_build(1) == {"id": 1, "finished": 1}
+        with client.client() as c:
+            assert c is pooled
+    assert requests[1].headers["Cookie"] == "hydra_session=abc"
+    assert client._client is None
+
+    # The cookies outlive closing the connections.
+    client.get_build(1)
+    assert requests[2].headers["Cookie"] == "hydra_session=abc"
+    client.close()
+
+
+def test_async_jobset_jobs_fan_out():
+    in_flight = []
+    peak = []
+
+    async def handler(request):
+        path = request.url.path
+        if path == "/jobset/p/j/evals":
+            return httpx.Response(200, json={"evals": [{"id": 1, "builds": [1, 2]}, {"id": 2, "builds": [3, 2]}]})
+        in_flight.append(path)
+        peak.append(len(in_flight))
+        await asyncio.sleep(0.01)
+        in_flight.remove(path)
+        return httpx.Response(200, json={"id": int(path.split("/")[2]), "buildstatus": None, "steps": []})
+
+    client = Hydra("http://hydra", transport=httpx.MockTransport(handler))
+
+    async def run():
+        async with client.asynchronous(max_concurrency=2) as async_client:
+            return await get_jobset_jobs(async_client, "p", "j")
+
+    info = asyncio.run(run())
+    # Builds of all evals are retrieved, each only once, and no more than two at a time.
+    assert sorted(info["builds_retrieved"]) == [1, 2, 3]
+    assert max(peak) == 2
+    # Without a limit, as many requests as the pool has connections.
+    assert Hydra("http://hydra", max_connections=3).asynchronous().max_concurrency == 3
+    # A transport for sync requests only isn't handed to the async client.
+    assert Hydra("http://hydra", transport=httpx.HTTPTransport()).asynchronous().client_args["transport"] is None
+
+
+def test_cache_finished_builds(tmp_path):
+    requests = []
+
+    def handler(request):
+        requests.append(request.url.path)
+        build_id = int(request.url.path.split("/")[2])
+        finished = build_id == 1
+        return httpx.Response(200, json={"id": build_id, "finished": int(finished), "buildstatus": 0 if finished else None})
+
+    for i in range(2):
+        client = Hydra("http://hydra", transport=httpx.MockTransport(handler), cache=DiskCache(tmp_path))
+        with client:
+            assert client.get_build(1)["buildstatus"] == 0
+            assert client.get_build(2)["buildstatus"] is None
+    # The finished build is only requested the first time, the unfinished one every time.
+    assert requests == ["/build/1", "/build/2", "/build/2"]
+
+    # Records are per hydra server.
+    client = Hydra("http://other", transport=httpx.MockTransport(handler), cache=DiskCache(tmp_path))
+    client.get_build(1)
+    assert requests[-1] == "/build/1"
+    client.close()
+
+
+def test_jobset_state_refreshes_unfinished_builds():
+    requests = []
+    status = {1: 0, 2: None}
+
+    def handler(request):
+        requests.append(request.url.path)
+        if request.url.path == "/jobset/p/j/evals":
+            return httpx.Response(200, json={"evals": [{"id": 1, "builds": [1, 2]}]})
+        build_id = int(request.url.path.split("/")[2])
+        return httpx.Response(
+            200, json={"id": build_id, "nixname": f"build{build_id}", "buildstatus": status[build_id], "steps": []}
+        )
+
+    client = Hydra("http://hydra", transport=httpx.MockTransport(handler))
+    state = JobsetState("p", "j")
+
+    async def run():
+        async with client.asynchronous() as async_client:
+            changes = [await state.refresh(async_client)]
+            requests.clear()
+            changes.append(await state.refresh(async_client))
+            status[2] = 1
+            changes.append(await state.refresh(async_client))
+            return changes
+
+    assert asyncio.run(run()) == [{1, 2}, set(), {2}]
+    # The finished build is only requested once.
+    assert "/build/1/api/get-info" not in requests
+    assert state.info["builds_retrieved"][2]["buildstatus"] == 1
+    trees = jobset_trees(None, state.info, build_ids={2})
+    assert len(trees) == 1 and len(trees[0].children) == 1
+
+
+def test_throttled_requests_are_not_retried():
+    requests = []
+
+    def handler(request):
+        requests.append(request.url.path)
+        return httpx.Response(429, headers={"Retry-After": "10"})
+
+    client = Hydra("http://hydra", transport=httpx.MockTransport(handler))
+    try:
+        client.get_build(1)
+    except HydraResponseException as e:
+        assert e.status_code == 429
+    else:
+        assert False
+    assert requests == ["/build/1"]
+    client.close()
@@ -0,0 +1,47 @@
+import copy
+import json
+from pathlib import Path
+import shutil
+import subprocess
+
+import pytest
+
+from nix_generator.rosdeps import RosdepResolver
+from nix_generator.writer import Writer
+
+from conftest import REPOSITORIES, ROSDEP_MAPPING, generate
+
+NIX_DIR = Path(__file__).parent / "nix"
+
+pytestmark = pytest.mark.skipif(shutil.which("nix-instantiate") is None, reason="nix is not installed")
+
+
+def nix_eval(name, *args):
+    cmd = ["nix-instantiate", "--eval", "--strict", "--json", str(NIX_DIR / name), *args]
+    return json.loads(subprocess.check_output(cmd))
+
+
+def test_propagate_colcon_run_depends_order():
+    for case in nix_eval("propagate-order.nix"):
+        assert case["propagated"] == case["baseline"]
+
+
+def has_nixpkgs():
+    return subprocess.run(["nix-instantiate", "--find-file", "nixpkgs"], capture_output=True).returncode == 0
+
+
+@pytest.mark.skipif(shutil.which("nix-instantiate") is None or not has_nixpkgs(), reason="nixpkgs is not in NIX_PATH")
+def test_scope_from_json_index(tmp_path):
+    generate(tmp_path / "nix" / "noetic")
+    writer = Writer(tmp_path / "json-index" / "noetic", copy.deepcopy(REPOSITORIES), ("gtest",))
+    writer.write_json_index(RosdepResolver(ROSDEP_MAPPING))
+
+    scopes = nix_eval(
+        "scope-from-json-index.nix",
+        "--arg", "nixOverlay", str(tmp_path / "nix" / "noetic" / "default.nix"),
+        "--arg", "jsonIndexOverlay", str(tmp_path / "json-index" / "noetic" / "default.nix"),
+        "--argstr", "scopeName", "noetic",
+    )
+    assert sorted(scopes["jsonIndex"]["packages"]) == ["cpp_common", "roscpp", "tf2"]
+    assert scopes["jsonIndex"]["packages"]["roscpp"]["colconRunDepends"] == ["cpp_common", "python3Packages.pyyaml"]
+    assert scopes["jsonIndex"] == scopes["nix"]
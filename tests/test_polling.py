@@ -0,0 +1,44 @@
+from email.utils import formatdate
+import time
+
+import httpx
+
+from nix_generator.polling import PollScheduler, retry_after
+
+
+def test_backoff_and_reset():
+    scheduler = PollScheduler(5, 60, random=lambda: 0.5)
+    assert scheduler.next_interval() == 5
+    intervals = []
+    for i in range(5):
+        scheduler.update(False)
+        intervals.append(scheduler.next_interval())
+    assert intervals == [10, 20, 40, 60, 60]
+    scheduler.update(True)
+    assert scheduler.next_interval() == 5
+
+
+def test_jitter():
+    assert PollScheduler(10, 60, jitter=0.2, random=lambda: 0.0).next_interval() == 8
+    assert PollScheduler(10, 60, jitter=0.2, random=lambda: 1.0).next_interval() == 12
+
+
+def test_throttle_honors_retry_after():
+    scheduler = PollScheduler(5, 60, random=lambda: 0.0)
+    scheduler.throttle(120)
+    assert scheduler.next_interval() == 120
+    # Only the poll right after is held back that long, the backoff continues from where it was.
+    assert scheduler.next_interval() == 8
+    # A server asking for more than max_retry_after_factor times max_interval is polled again after that.
+    scheduler.throttle(86400)
+    assert scheduler.next_interval() == 600
+
+
+def test_retry_after():
+    assert retry_after(httpx.Response(429, headers={"Retry-After": "30"})) == 30
+    date = formatdate(time.time() + 100, usegmt=True)
+    assert 90 < retry_after(httpx.Response(503, headers={"Retry-After": date})) <= 100
+    assert retry_after(httpx.Response(503, headers={"Retry-After": "soon"})) is None
+    assert retry_after(httpx.Response(503, headers={"Retry-After": "inf"})) is None
+    assert retry_after(httpx.Response(503, headers={"Retry-After": "nan"})) is None
+    assert retry_after(httpx.Response(503)) is None
@@ -0,0 +1,60 @@
+import asyncio
+
+import httpx
+import yaml
+
+from nix_generator.cache import DiskCache
+from nix_generator.rosdeps import RosdepResolver, fetch_rosdep_index
+
+
+def test_resolver():
+    resolver = RosdepResolver({
+        "boost": ["boost"],
+        "python3-yaml": ["python3Packages.pyyaml"],
+        "python-yaml": ["python2Packages.pyyaml"],
+        "python3-qt5-bindings": ["python3Packages.pyqt5", "python3Packages.sip_4"],
+        "empty": [],
+    })
+    assert resolver.resolve("boost") == (("boost",), frozenset(["boost"]))
+    # The python3 key takes precedence over the python one.
+    assert resolver.resolve("python-yaml").attrs == ("python3Packages.pyyaml",)
+    assert resolver.resolve("python3-qt5-bindings").inputs == frozenset(["python3Packages"])
+    # A key mapping to nothing still resolves.
+    assert resolver.resolve("empty") == ((), frozenset())
+    assert resolver.resolve("missing") is None
+    assert resolver.resolve("missing") is None
+    assert resolver.resolve("boost").attrs == ("boost",)
+    assert resolver.stats() == {"keys": 5, "hits": 2, "misses": 5, "unresolved": 1}
+
+
+def test_resolver_null_mapping():
+    resolver = RosdepResolver({"python3-foo": None, "python-foo": ["python2Packages.foo"], "bar": None})
+    # A null mapping is unresolved, so the shim falls back to the key itself.
+    assert resolver.resolve("python-foo").attrs == ("python2Packages.foo",)
+    assert resolver.resolve("bar") is None
+    assert resolver.stats()["keys"] == 1
+
+
+def test_fetch_rosdep_index(tmp_path):
+    requests = []
+
+    def handler(request):
+        requests.append(request.url.path)
+        return httpx.Response(200, text=yaml.safe_dump({
+            "boost": {"nixos": ["boost"], "ubuntu": ["libboost-all-dev"]},
+            "windows-only": {"windows": ["thing"]},
+        }))
+
+    async def fetch(commit, cache):
+        urls = [f"https://github.com/ros/rosdistro/raw/{commit}/rosdep/base.yaml"]
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            return await fetch_rosdep_index(urls, client, commit, cache)
+
+    cache = DiskCache(tmp_path)
+    assert asyncio.run(fetch("abc", cache)) == {"boost": ["boost"]}
+    assert asyncio.run(fetch("abc", cache)) == {"boost": ["boost"]}
+    assert len(requests) == 1
+    # A new rosdistro commit, or no cache, means fetching again.
+    assert asyncio.run(fetch("def", cache)) == {"boost": ["boost"]}
+    assert asyncio.run(fetch("abc", None)) == {"boost": ["boost"]}
+    assert len(requests) == 3
@@ -0,0 +1,169 @@
+import argparse
+import copy
+import subprocess
+
+import httpx
+import yaml
+
+from nix_generator import cli
+from nix_generator.hydra import HydraException
+from nix_generator.serve import GeneratorService, Metrics, TagPoller, serve_metrics
+
+from conftest import REPOSITORIES, read_tree
+
+ROSDEP_URLS = ["https://github.com/ros/rosdistro/raw/abc/rosdep/base.yaml"]
+
+
+def git(path, *args):
+    return subprocess.check_output(["git", *args], cwd=path, universal_newlines=True)
+
+
+def test_tag_poller(tmp_path):
+    origin = tmp_path / "origin"
+    origin.mkdir()
+    git(origin, "init", "-q")
+    git(origin, "-c", "user.name=a", "-c", "user.email=a@b", "commit", "-q", "--allow-empty", "-m", "snapshot")
+    git(origin, "tag", "snapshot/20211231")
+    git(origin, "tag", "snapshot/20220105")
+    git(origin, "tag", "other")
+
+    poller = TagPoller(origin.as_uri(), tmp_path / "tags.git")
+    assert poller.poll() == "refs/tags/snapshot/20220105"
+    assert poller.poll() == "refs/tags/snapshot/20220105"
+    git(origin, "tag", "snapshot/20220301")
+    assert poller.poll() == "refs/tags/snapshot/20220301"
+    # Once a tag is known, only the tags of its year and later are fetched.
+    git(origin, "tag", "snapshot/20210601")
+    poller.poll()
+    assert "refs/tags/snapshot/20210601" not in git(tmp_path / "tags.git", "for-each-ref")
+
+
+def test_metrics():
+    metrics = Metrics()
+    metrics.increment("polls_total")
+    metrics.set_state("idle")
+    server = serve_metrics(metrics, "127.0.0.1", 0)
+    try:
+        url = f"http://127.0.0.1:{server.server_port}"
+        text = httpx.get(f"{url}/metrics").text
+        assert "nix_generator_polls_total 1\n" in text
+        assert 'nix_generator_state{state="idle"} 1\n' in text
+        assert httpx.get(f"{url}/status").json()["polls_total"] == 1
+        assert httpx.get(f"{url}/other").status_code == 404
+    finally:
+        server.shutdown()
+
+
+class FakePoller:
+    def __init__(self):
+        self.ref = None
+
+    def poll(self):
+        return self.ref
+
+
+def test_generator_service(tmp_path, monkeypatch):
+    repositories = copy.deepcopy(REPOSITORIES)
+    rosdep = {"commit": "abc", "boost": "boost"}
+    requests = []
+
+    def handler(request):
+        requests.append(request.url.host)
+        if request.url.host == "github.com":
+            return httpx.Response(200, text=yaml.safe_dump({"boost": {"nixos": [rosdep["boost"]]}}))
+        return httpx.Response(200, json={"repositories": repositories})
+
+    monkeypatch.setattr(cli, "get_rosdep_urls", lambda branch, pin=True: (ROSDEP_URLS, rosdep["commit"]))
+    args = argparse.Namespace(
+        output=str(tmp_path / "output"), jobs=1, format="nix", rosdep_branch="master", push_tag=False,
+        hydra_project="ros",
+    )
+    poller = FakePoller()
+    metrics = Metrics()
+    service = GeneratorService(
+        args, "github:org/base", poller, metrics, transport=httpx.MockTransport(handler)
+    )
+
+    assert not service.run_once()
+    poller.ref = "refs/tags/snapshot/20220329"
+    assert service.run_once()
+    tree = read_tree(tmp_path / "output")
+    assert "noetic/tf2.nix" in tree
+    assert '20220329-dev' in tree["flake.nix"]
+    assert requests.count("github.com") == 1
+    # The same tag isn't generated twice.
+    assert not service.run_once()
+
+    # The next tag only rewrites what changed, and reuses the rosdep resolver.
+    repositories["ros/geometry2"]["version"] = "0.7.6"
+    poller.ref = "refs/tags/snapshot/20220330"
+    assert service.run_once()
+    assert requests.count("github.com") == 1
+    assert "0.7.6" in read_tree(tmp_path / "output")["noetic/srcs/ros/geometry2.nix"]
+    status = metrics.status()
+    assert status["generations_total"] == 2 and status["generation_failures_total"] == 0
+    assert status["tag"] == "20220330-dev"
+
+    # A new rosdep commit reloads the resolver, and the packages are resolved again even if their repository
+    # didn't change.
+    rosdep.update(commit="def", boost="boost179")
+    poller.ref = "refs/tags/snapshot/20220331"
+    assert service.run_once()
+    assert requests.count("github.com") == 2
+    assert "boost179" in read_tree(tmp_path / "output")["noetic/roscpp.nix"]
+
+
+def test_generator_service_published_tags(tmp_path):
+    origin = tmp_path / "origin"
+    origin.mkdir()
+    git(origin, "init", "-q")
+    (origin / "flake.nix").write_text("{}")
+    git(origin, "add", "-A")
+    git(origin, "-c", "user.name=a", "-c", "user.email=a@b", "commit", "-q", "-m", "20220329-0")
+    for tag in ("20220329-0", "20220330-0", "20220330-1", "other"):
+        git(origin, "tag", tag)
+    git(tmp_path, "clone", "-q", "--no-tags", str(origin), "output")
+
+    args = argparse.Namespace(output=str(tmp_path / "output"), jobs=1)
+    service = GeneratorService(args, "github:org/base", FakePoller(), Metrics())
+    service.seed_ref()
+    assert service.ref == "refs/tags/snapshot/20220330"
+    assert service.metrics.tag == "20220330-1"
+
+    # Only a change of the output makes it worth a new tag.
+    assert service.unchanged_since("20220330-1")
+    (tmp_path / "output" / "flake.nix").write_text("{ }")
+    assert not service.unchanged_since("20220330-1")
+
+
+class FailingHydra:
+    def push_jobset_tag(self, project, tag):
+        raise HydraException("jobset creation failed")
+
+
+def test_generator_service_hydra_failure(tmp_path, monkeypatch):
+    def handler(request):
+        if request.url.host == "github.com":
+            return httpx.Response(200, text=yaml.safe_dump({"boost": {"nixos": ["boost"]}}))
+        return httpx.Response(200, json={"repositories": REPOSITORIES})
+
+    monkeypatch.setattr(cli, "get_rosdep_urls", lambda branch, pin=True: (ROSDEP_URLS, "abc"))
+    monkeypatch.setattr(cli, "find_unused_tag", lambda path, version: f"{version}-0")
+    monkeypatch.setattr(cli, "traced_check_call", lambda *args, **kwargs: None)
+    monkeypatch.setattr(cli, "commit_and_push", lambda path, tag: None)
+    args = argparse.Namespace(
+        output=str(tmp_path / "output"), jobs=1, format="nix", rosdep_branch="master", push_tag=True,
+        hydra_project="ros",
+    )
+    poller = FakePoller()
+    metrics = Metrics()
+    service = GeneratorService(
+        args, "github:org/base", poller, metrics, transport=httpx.MockTransport(handler), hydra=FailingHydra()
+    )
+
+    # A Hydra error is not an Exception, but the service keeps running and retries on the next poll.
+    poller.ref = "refs/tags/snapshot/20220329"
+    assert not service.run_once()
+    status = metrics.status()
+    assert status["generations_total"] == 1 and status["generation_failures_total"] == 1
+    assert service.ref is None
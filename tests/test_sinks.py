@@ -0,0 +1,143 @@
+import copy
+import io
+import os
+import subprocess
+import tarfile
+
+import pytest
+
+from nix_generator.manifest import MANIFEST_NAME
+from nix_generator.sinks import GitSink, MemorySink, SinkError, TarSink
+
+from conftest import REPOSITORIES, generate, read_tree, write_tree
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_memory_sink(tmp_path, jobs):
+    expected = write_tree(tmp_path / "noetic")
+    sink = MemorySink(tmp_path / "memory")
+    generate(tmp_path / "memory" / "noetic", sink=sink, jobs=jobs)
+    assert not (tmp_path / "memory").exists()
+    files = {k.split("/", 1)[1]: v.decode() for k, v in sink.files.items() if not k.endswith(MANIFEST_NAME)}
+    assert files == expected
+
+    # Unchanged files are not written again, the sink keeps the state of the previous generation.
+    writer = generate(tmp_path / "memory" / "noetic", sink=sink, jobs=jobs)
+    assert writer.manifest.written == 0
+
+
+def test_tar_sink(tmp_path):
+    expected = write_tree(tmp_path / "noetic")
+    output = io.BytesIO()
+    sink = TarSink(tmp_path / "archive", output, "gz", mtime=1600000000)
+    generate(tmp_path / "archive" / "noetic", sink=sink)
+    sink.close()
+    assert not (tmp_path / "archive").exists()
+
+    output.seek(0)
+    with tarfile.open(fileobj=output, mode="r:gz") as tar:
+        assert "noetic/srcs/ros/geometry2.nix" in tar.getnames()
+        tar.extractall(tmp_path / "extracted")
+    assert {k: v for k, v in read_tree(tmp_path / "extracted" / "noetic").items()} == expected
+
+    # The manifest stored in the archive matches the extracted files, so generating into them is incremental.
+    assert os.stat(tmp_path / "extracted" / "noetic" / "tf2.nix").st_mtime == 1600000000
+    writer = generate(tmp_path / "extracted" / "noetic")
+    assert writer.manifest.written == 0
+
+
+def test_tar_sink_open(tmp_path):
+    with pytest.raises(SinkError):
+        TarSink.open(tmp_path, tmp_path / "output.zip")
+
+    sink = TarSink.open(tmp_path / "archive", tmp_path / "output.tar.xz")
+    generate(tmp_path / "archive" / "noetic", sink=sink, jobs=2)
+    sink.close()
+    with tarfile.open(tmp_path / "output.tar.xz") as tar:
+        assert "noetic/tf2.nix" in tar.getnames()
+
+
+def test_tar_sink_zstd(tmp_path):
+    zstandard = pytest.importorskip("zstandard")
+    sink = TarSink.open(tmp_path / "archive", tmp_path / "output.tar.zst")
+    generate(tmp_path / "archive" / "noetic", sink=sink)
+    sink.close()
+    with open(tmp_path / "output.tar.zst", "rb") as f:
+        with zstandard.ZstdDecompressor().stream_reader(f) as reader:
+            with tarfile.open(fileobj=reader, mode="r|") as tar:
+                assert "noetic/tf2.nix" in tar.getnames()
+
+
+def git(path, *args):
+    return subprocess.check_output(["git", *args], cwd=path, universal_newlines=True)
+
+
+def git_repo(path):
+    path.mkdir()
+    git(path, "init", "-q")
+    git(path, "config", "user.name", "Generator")
+    git(path, "config", "user.email", "generator@example.com")
+    (path / "README.md").write_text("readme\n")
+    git(path, "add", "README.md")
+    git(path, "commit", "-q", "-m", "initial")
+    return path
+
+
+def test_git_sink(tmp_path):
+    repo = git_repo(tmp_path / "repo")
+
+    sink = GitSink(repo, untracked=[MANIFEST_NAME])
+    generate(repo / "noetic", sink=sink)
+    commit = sink.commit("20220329-0")
+    assert git(repo, "rev-parse", "HEAD").strip() == commit
+    assert git(repo, "log", "--format=%s", "-1").strip() == "20220329-0"
+    files = git(repo, "ls-tree", "-r", "--name-only", "HEAD").split()
+    assert "README.md" in files and "noetic/srcs/ros/geometry2.nix" in files
+    assert f"noetic/{MANIFEST_NAME}" not in files
+    # The committed tree matches what was written, and the index matches the commit.
+    assert git(repo, "status", "--porcelain", "--untracked-files=no") == ""
+    assert git(repo, "diff", "HEAD", "--stat") == ""
+
+    # A repository removed from the distro is deleted in the next commit, unchanged files are left out.
+    repositories = copy.deepcopy(REPOSITORIES)
+    del repositories["ros/geometry2"]
+    sink = GitSink(repo, untracked=[MANIFEST_NAME])
+    writer = generate(repo / "noetic", repositories, sink=sink)
+    sink.commit("20220330-0")
+    changed = git(repo, "diff", "--name-status", "HEAD~1", "HEAD").splitlines()
+    assert changed == [
+        "M\tnoetic/default.nix",
+        "M\tnoetic/srcs/default.nix",
+        "D\tnoetic/srcs/ros/geometry2.nix",
+        "D\tnoetic/tf2.nix",
+    ]
+    assert git(repo, "status", "--porcelain", "--untracked-files=no") == ""
+
+
+def test_git_sink_jobs(tmp_path):
+    expected = write_tree(tmp_path / "noetic")
+    repo = git_repo(tmp_path / "repo")
+    sink = GitSink(repo, untracked=[MANIFEST_NAME])
+    generate(repo / "noetic", sink=sink, jobs=4)
+    sink.commit("20220329-0")
+    # The files rendered by the worker processes are committed as well.
+    files = git(repo, "ls-tree", "-r", "--name-only", "HEAD").split()
+    assert sorted(files) == sorted(["README.md"] + [f"noetic/{path}" for path in expected])
+
+
+def test_git_sink_after_uncommitted_generation(tmp_path):
+    repo = git_repo(tmp_path / "repo")
+    # A generation that was never committed leaves a manifest saying every file is up to date.
+    generate(repo / "noetic")
+    sink = GitSink(repo, untracked=[MANIFEST_NAME])
+    writer = generate(repo / "noetic", sink=sink)
+    assert writer.manifest.written == 0
+    sink.commit("20220329-0")
+    assert "noetic/tf2.nix" in git(repo, "ls-tree", "-r", "--name-only", "HEAD").split()
+    assert git(repo, "status", "--porcelain", "--untracked-files=no") == ""
+
+    # Generating again commits nothing new.
+    sink = GitSink(repo, untracked=[MANIFEST_NAME])
+    generate(repo / "noetic", sink=sink)
+    assert sink.changes == {}
+    sink.close()
@@ -0,0 +1,41 @@
+import copy
+
+from nix_generator.snapshot_diff import SnapshotDiff, fingerprint_repositories
+from nix_generator.model import Package
+
+from conftest import REPOSITORIES
+
+
+def test_snapshot_diff_unchanged():
+    diff = SnapshotDiff(fingerprint_repositories(REPOSITORIES), fingerprint_repositories(iter(REPOSITORIES.items())))
+    assert not diff
+    assert diff.affected_repositories() == set()
+
+
+def test_snapshot_diff():
+    repositories = copy.deepcopy(REPOSITORIES)
+    # gtest moves to a repo of its own, and tf2 is removed with its repo.
+    gtest = repositories["ros_comm"]["packages"].pop()
+    repositories["googletest"] = {"url": "https://github.com/google/googletest.git", "packages": [gtest]}
+    del repositories["ros/geometry2"]
+    repositories["ros_comm"]["metadata"]["narhash"] = "sha256-new"
+
+    diff = SnapshotDiff(fingerprint_repositories(REPOSITORIES), fingerprint_repositories(repositories))
+    assert diff.summary() == {
+        "changed": True,
+        "repositories": {
+            "added": ["googletest"],
+            "removed": ["ros/geometry2"],
+            "changed": {"ros_comm": ["narhash", "packages"]},
+        },
+        "packages": {"added": [], "removed": ["tf2"], "changed": ["gtest"]},
+    }
+    assert diff.affected_repositories() == {"googletest", "ros_comm"}
+
+    # Packages depending on the removed tf2 now get it from rosdep instead.
+    packages = [
+        Package("gtest", "googletest"),
+        Package("tf2_ros", "geometry2", build=("tf2",)),
+        Package("roscpp", "ros_comm", build=("cpp_common",), test=("gtest",)),
+    ]
+    assert diff.affected_packages(packages) == {"gtest", "tf2_ros"}
@@ -0,0 +1,93 @@
+import io
+from pkgutil import get_data
+
+import em
+import pytest
+
+from nix_generator.model import Package
+from nix_generator.template import Template, TemplateError
+
+
+class _CapturingOutput(io.StringIO):
+    def close(self):
+        pass
+
+
+@pytest.fixture(autouse=True)
+def no_stdout_proxy(monkeypatch):
+    # The em sys.stdout proxy does not survive pytest swapping sys.stdout for output capture.
+    monkeypatch.setattr(em.Interpreter, "installProxy", lambda self: None)
+
+
+def render_interpreter(text, variables):
+    output = _CapturingOutput()
+    i = em.Interpreter(output=output, globals=dict(variables), options={em.OVERRIDE_OPT: False})
+    i.string(text)
+    i.shutdown()
+    return output.getvalue()
+
+
+TEMPLATE_VARIABLES = [
+    ("flake.nix", {
+        "nix_base_url": "github:clearpathrobotics/nix-ros-base",
+        "overlay_paths": ("noetic", "rolling"),
+        "rosdistro_ref": "refs/tags/snapshot/20220329",
+        "flake_tag": "20220329-0",
+    }),
+    ("package.nix", {
+        "name": "roscpp",
+        "repo_name": "ros/ros_comm",
+        "inputs": ["boost", "cpp_common"],
+        "buildDepends": ["boost", "cpp_common"],
+        "runDepends": [],
+        "testDepends": ["rosbash"],
+        "binary": True,
+        "scope_name": "noetic",
+    }),
+    ("package.nix", {
+        "name": "msgs",
+        "repo_name": "msgs",
+        "inputs": [],
+        "buildDepends": [],
+        "runDepends": [],
+        "testDepends": [],
+        "binary": None,
+        "scope_name": "rolling",
+    }),
+    ("package-default.nix", {"package_names": ["a", "b"], "scope_name": "noetic"}),
+    ("src.nix", {
+        "name": "ros_comm",
+        "fetcher": "fetchFromGitHub",
+        "owner": "ros",
+        "repo": "ros_comm",
+        "rev": "1.15.14",
+        "hash": "sha256-AAAA",
+        "safe_owner": "ros",
+        "safe_repo": "ros_comm",
+        "safe_rev": "1.15.14",
+        "packages": [Package("roscpp", "ros_comm", path="clients/roscpp", narhash="sha256-BBBB")],
+    }),
+    ("src-default.nix", {"repo_names": ["ros/ros_comm", "geometry2"]}),
+    ("index-default.nix", {"scope_name": "noetic"}),
+]
+
+
+@pytest.mark.parametrize("name,variables", TEMPLATE_VARIABLES)
+def test_template_matches_interpreter(name, variables):
+    text = get_data("nix_generator", f"templates/{name}.em").decode()
+    template = Template(text, name)
+    assert template.render(**variables) == render_interpreter(text, variables)
+    # Rendering again must not be affected by the previous render.
+    assert template.render(**variables) == render_interpreter(text, variables)
+
+
+def test_template_markup():
+    text = "@[if a]@\nyes @(b)@@\n@[elif c]@\nmaybe\n@[else]@\nno\n@[end if]@\n@(a ? 'x' ! 'y')@(None)"
+    template = Template(text)
+    for variables in ({"a": 1, "b": 2, "c": 0}, {"a": 0, "b": 2, "c": 1}, {"a": 0, "b": 2, "c": 0}):
+        assert template.render(**variables) == render_interpreter(text, variables)
+
+
+def test_template_unsupported():
+    with pytest.raises(TemplateError):
+        Template("@{x = 1}")
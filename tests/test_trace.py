@@ -0,0 +1,63 @@
+import asyncio
+import json
+import subprocess
+
+import pytest
+
+from nix_generator import trace
+from nix_generator.cli import retry_subprocess_errors
+
+
+@pytest.fixture
+def tracer(monkeypatch):
+    monkeypatch.setattr(trace, "_tracer", None)
+    return trace.enable()
+
+
+def test_span_disabled(monkeypatch):
+    monkeypatch.setattr(trace, "_tracer", None)
+    with trace.span("phase") as span:
+        span.set(items=1)
+
+
+def test_spans(tracer, tmp_path):
+    def work(count):
+        with trace.span("worker", items=count):
+            pass
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        with trace.span("phase", distro="noetic") as span:
+            span.set(items=3)
+            await loop.run_in_executor(None, trace.in_context(work, 3))
+            with pytest.raises(ValueError):
+                with trace.span("failing"):
+                    raise ValueError("nope")
+
+    asyncio.run(run())
+    tracer.save(tmp_path / "trace.json")
+    spans = {s["name"]: s for s in json.loads((tmp_path / "trace.json").read_text())["spans"]}
+
+    assert spans["phase"]["parent"] is None
+    assert spans["phase"]["attributes"] == {"distro": "noetic", "items": 3}
+    assert spans["phase"]["duration"] >= spans["failing"]["duration"]
+    assert spans["failing"]["parent"] == spans["phase"]["id"]
+    # Spans in executor threads are nested as well.
+    assert spans["worker"]["parent"] == spans["phase"]["id"]
+    assert spans["failing"]["error"] == "ValueError: nope"
+    assert "error" not in spans["phase"]
+
+
+def test_retry_spans(tracer, monkeypatch):
+    monkeypatch.setattr("time.sleep", lambda seconds: None)
+    attempts = []
+
+    def flaky(cmd):
+        attempts.append(cmd)
+        if len(attempts) < 2:
+            raise subprocess.CalledProcessError(1, cmd)
+        return "ok\n"
+
+    assert retry_subprocess_errors(flaky, args=(["git", "ls-remote"],)) == "ok\n"
+    assert [(s.attributes["attempt"], s.error is not None) for s in tracer.spans] == [(1, True), (2, False)]
+    assert tracer.spans[1].attributes["bytes"] == 3
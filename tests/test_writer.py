@@ -0,0 +1,164 @@
+import copy
+import json
+import subprocess
+
+from nix_generator.manifest import MANIFEST_NAME
+from nix_generator.rosdeps import RosdepResolver
+from nix_generator.writer import TemplateFileWriter, Writer
+
+from conftest import REPOSITORIES, ROSDEP_MAPPING, generate, read_tree, write_tree
+
+
+def test_write_files(tmp_path):
+    tree = write_tree(tmp_path / "noetic")
+    assert sorted(tree) == [
+        "cpp_common.nix",
+        "default.nix",
+        "roscpp.nix",
+        "srcs/default.nix",
+        "srcs/ros/geometry2.nix",
+        "srcs/ros_comm.nix",
+        "tf2.nix",
+    ]
+    roscpp = tree["roscpp.nix"]
+    assert "  boost,\n  cpp_common,\n  python3Packages,\n" in roscpp
+    assert "src = srcs.ros_comm.roscpp;" in roscpp
+    assert "separateDebugInfo = true;" in roscpp
+    assert "python3Packages.pyyaml" in roscpp
+    assert "gtest" not in roscpp
+    assert "separateDebugInfo" not in tree["cpp_common.nix"]
+    assert 'rev = "0.7.5~1";' in tree["srcs/ros/geometry2.nix"]
+    assert 'name = "ros-geometry2-0.7.5-1";' in tree["srcs/ros/geometry2.nix"]
+    assert "ros_geometry2 = callPackages ./ros/geometry2.nix {};" in tree["srcs/default.nix"]
+
+
+def test_write_files_parallel(tmp_path):
+    assert write_tree(tmp_path / "serial" / "noetic") == write_tree(tmp_path / "parallel" / "noetic", jobs=2)
+
+
+def test_write_files_incremental(tmp_path):
+    path = tmp_path / "noetic"
+    repositories = copy.deepcopy(REPOSITORIES)
+    writer = generate(path, repositories)
+    assert writer.manifest.written == 7
+    mtimes = {p: p.stat().st_mtime_ns for p in path.rglob("*.nix")}
+
+    # Drop the geometry2 repo and change a dependency of roscpp.
+    del repositories["ros/geometry2"]
+    repositories["ros_comm"]["packages"][0]["depends"]["run"] = ["cpp_common"]
+    writer = generate(path, repositories)
+
+    # Only roscpp and the two aggregators changed.
+    assert writer.manifest.written == 3
+    assert not (path / "tf2.nix").exists()
+    assert not (path / "srcs" / "ros").exists()
+    assert (path / "cpp_common.nix").stat().st_mtime_ns == mtimes[path / "cpp_common.nix"]
+    assert "python3Packages" not in (path / "roscpp.nix").read_text()
+
+    # A file modified on disk is rewritten even though the generated content didn't change.
+    (path / "cpp_common.nix").write_text("garbage")
+    writer = generate(path, repositories)
+    assert writer.manifest.written == 1
+    assert (path / "cpp_common.nix").read_text() != "garbage"
+
+
+def test_write_files_without_manifest(tmp_path):
+    # The manifest is gitignored, so a fresh clone of the output only has the committed files.
+    path = tmp_path / "noetic"
+    generate(path)
+    (path / MANIFEST_NAME).unlink()
+    subprocess.check_call(["git", "init", "-q"], cwd=path)
+    subprocess.check_call(["git", "add", "-A"], cwd=path)
+
+    repositories = copy.deepcopy(REPOSITORIES)
+    del repositories["ros/geometry2"]
+    writer = generate(path, repositories)
+    assert not (path / "tf2.nix").exists()
+    assert not (path / "srcs" / "ros").exists()
+    assert writer.manifest.written == 5
+
+
+def test_write_files_base_repositories(tmp_path, monkeypatch):
+    path = tmp_path / "noetic"
+    generate(path)
+
+    # Bump geometry2 and add a package which cpp_common depends on.
+    repositories = copy.deepcopy(REPOSITORIES)
+    repositories["ros/geometry2"]["version"] = "0.7.6"
+    repositories["ros_comm"]["packages"].append({
+        "name": "no-such-key", "path": "no_such_key", "depends": {}, "metadata": {"narhash": "sha256-nsk"},
+    })
+
+    rendered = []
+    write = TemplateFileWriter.write
+    monkeypatch.setattr(TemplateFileWriter, "write", lambda self, items: write(self, rendered.extend(items) or items))
+    writer = generate(path, repositories, base_repositories=copy.deepcopy(REPOSITORIES))
+
+    assert writer.diff.summary() == {
+        "changed": True,
+        "repositories": {"added": [], "removed": [], "changed": {"ros/geometry2": ["version"], "ros_comm": ["packages"]}},
+        "packages": {"added": ["no-such-key"], "removed": [], "changed": []},
+    }
+    assert sorted(path.relative_to(tmp_path).as_posix() for path, v in rendered) == [
+        "noetic/cpp_common.nix",
+        "noetic/no-such-key.nix",
+        "noetic/srcs/ros/geometry2.nix",
+        "noetic/srcs/ros_comm.nix",
+    ]
+
+    # The result is the same as that of a full generation.
+    full_path = tmp_path / "full" / "noetic"
+    generate(full_path, repositories)
+    assert read_tree(path) == read_tree(full_path)
+
+
+def test_write_json_index(tmp_path):
+    generate(tmp_path / "noetic")
+    writer = Writer(tmp_path / "noetic", copy.deepcopy(REPOSITORIES), ("gtest",))
+    writer.write_json_index(RosdepResolver(ROSDEP_MAPPING))
+    writer.finish()
+
+    # The files of the nix format are replaced by the index.
+    tree = read_tree(tmp_path / "noetic")
+    assert sorted(tree) == ["default.nix", "index.json"]
+    assert 'final.colconScopeFromJsonIndex' in tree["default.nix"]
+
+    index = json.loads(tree["index.json"])
+    assert index["scope"] == "noetic"
+    assert index["sources"]["ros/geometry2"] == {
+        "fetcher": "fetchFromGitHub",
+        "owner": "ros",
+        "repo": "geometry2",
+        "rev": "0.7.5~1",
+        "hash": "sha256-geometry2",
+        "name": "ros-geometry2-0.7.5-1",
+        "packages": ["tf2"],
+    }
+    assert index["sources"]["ros_comm"]["packages"] == ["cpp_common", "roscpp"]
+    assert index["packages"]["tf2"] == {
+        "source": "ros/geometry2",
+        "path": "tf2",
+        "narhash": "sha256-tf2",
+        "binary": True,
+        "buildDepends": ["roscpp"],
+        "runDepends": ["roscpp"],
+        "testDepends": [],
+    }
+    assert index["packages"]["cpp_common"]["binary"] is False
+    assert index["packages"]["cpp_common"]["buildDepends"] == ["boost"]
+
+
+def test_write_files_only(tmp_path):
+    writer = Writer(tmp_path / "noetic", copy.deepcopy(REPOSITORIES), ("gtest",), only=["cpp_*"])
+    assert [p.name for p in writer.packages] == ["cpp_common"]
+    writer.write_srcs_files()
+    writer.write_packages_files(RosdepResolver(ROSDEP_MAPPING))
+    tree = read_tree(tmp_path / "noetic")
+    assert sorted(tree) == ["cpp_common.nix", "default.nix", "srcs/default.nix", "srcs/ros_comm.nix"]
+    assert "roscpp" not in tree["srcs/ros_comm.nix"]
+    assert "roscpp" not in tree["default.nix"]
+
+    # Repositories are matched as well, and the packages depended on come along.
+    writer = Writer(tmp_path / "rolling", copy.deepcopy(REPOSITORIES), ("gtest",), only=["ros/*"])
+    assert sorted(p.name for p in writer.packages) == ["cpp_common", "roscpp", "tf2"]
+    assert writer.repo_names == ["ros_comm", "ros/geometry2"]